@@ -0,0 +1,200 @@
+import math
+import time
+import asyncio
+import itertools
+import threading
+import contextlib
+
+INTERACTIVE = 0
+BULK = 1
+
+
+class AdmissionRejected(Exception):
+    """Raised when a render job can't be admitted; `retry_after` is in seconds."""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(f'{reason}, retry after {retry_after}s')
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """Admits render jobs into a fixed number of slots, in priority order.
+
+    Interactive jobs go ahead of bulk jobs, and bulk jobs never take the last
+    `reserved_interactive` slots (though they always get at least one), so
+    a single edit doesn't wait behind a batch. Waiting jobs of the same
+    priority are admitted round-robin between users: fewest running jobs
+    first, then whoever was served least recently. A job is rejected with
+    an estimated retry-after when the queue is full, when its user already
+    holds their share of the queue, or when it has waited `max_wait` seconds.
+    """
+
+    def __init__(self, slots=3, max_queue=16, max_wait=20, reserved_interactive=1):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.reserved_interactive = reserved_interactive
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._active = {} # user -> running jobs
+        self._served = {} # user -> admission number of their latest job
+        self._admissions = itertools.count()
+        self._active_total = 0
+        self._active_bulk = 0
+        self._rejected = 0
+        # Running average job time per priority, used for retry-after estimates
+        self._durations = {INTERACTIVE: 2.0, BULK: 30.0}
+
+    def _eligible(self, ticket):
+        if self._active_total >= self.slots:
+            return False
+        if ticket['priority'] == BULK:
+            return self._active_bulk < max(1, self.slots - self.reserved_interactive)
+        return True
+
+    def _head(self):
+        eligible = [ticket for ticket in self._waiting if self._eligible(ticket)]
+        return min(
+            eligible, default=None,
+            key=lambda t: (t['priority'], self._active.get(t['user'], 0), self._served.get(t['user'], -1), t['seq']),
+        )
+
+    def _retry_after(self, priority):
+        ahead = sum(1 for ticket in self._waiting if ticket['priority'] <= priority) + 1
+        estimate = self._durations[priority] * ahead / self.slots
+        return min(300, max(1, math.ceil(estimate)))
+
+    def _reject(self, priority, reason):
+        self._rejected += 1
+        return AdmissionRejected(self._retry_after(priority), reason)
+
+    def _enqueue(self, user, priority):
+        """Queues a new ticket, or raises AdmissionRejected. Call with the lock held."""
+        users = {ticket['user'] for ticket in self._waiting} | {user}
+        # Leave room for one more user so a single client can't fill the queue
+        share = max(1, self.max_queue // (len(users) + 1))
+        queued_by_user = sum(1 for ticket in self._waiting if ticket['user'] == user)
+        if len(self._waiting) >= self.max_queue:
+            raise self._reject(priority, 'render queue is full')
+        if queued_by_user >= share:
+            raise self._reject(priority, 'too many queued renders for this user')
+
+        ticket = {'user': user, 'priority': priority, 'seq': next(self._seq)}
+        self._waiting.append(ticket)
+        return ticket
+
+    def _admit(self, ticket):
+        """Moves a queued ticket into a slot. Call with the lock held."""
+        user = ticket['user']
+        self._waiting.remove(ticket)
+        self._active[user] = self._active.get(user, 0) + 1
+        self._served[user] = next(self._admissions)
+        self._active_total += 1
+        if ticket['priority'] == BULK:
+            self._active_bulk += 1
+        ticket['started'] = time.monotonic()
+
+    def _wake(self):
+        """Hands free slots to waiters after a change. Call with the lock held.
+
+        Async waiters at the head of the queue are admitted here and their
+        futures resolved on their own loop; blocked threads are woken to
+        admit themselves.
+        """
+        while (head := self._head()) is not None and 'future' in head:
+            self._admit(head)
+            head['loop'].call_soon_threadsafe(self._resolve, head)
+        self._cond.notify_all()
+
+    @staticmethod
+    def _resolve(ticket):
+        if not ticket['future'].done():
+            ticket['future'].set_result(ticket)
+
+    def acquire(self, user, priority):
+        """Blocks until the job may run and returns its ticket, or raises AdmissionRejected."""
+        with self._cond:
+            ticket = self._enqueue(user, priority)
+            deadline = time.monotonic() + self.max_wait
+            while self._head() is not ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    self._wake()
+                    raise self._reject(priority, 'timed out waiting for a render slot')
+                self._cond.wait(remaining)
+            self._admit(ticket)
+            self._wake()
+            return ticket
+
+    async def acquire_async(self, user, priority):
+        """Like `acquire`, but waits on the running event loop instead of in a thread."""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            ticket = self._enqueue(user, priority)
+            ticket['loop'], ticket['future'] = loop, loop.create_future()
+            self._wake()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket['future']), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._cond:
+                if 'started' in ticket:
+                    self.release(ticket)
+                else:
+                    self._waiting.remove(ticket)
+                    self._wake()
+            raise
+        with self._cond:
+            if 'started' in ticket: # Admitted, possibly just as the wait ran out
+                return ticket
+            self._waiting.remove(ticket)
+            self._wake()
+            raise self._reject(priority, 'timed out waiting for a render slot')
+
+    def release(self, ticket):
+        with self._cond:
+            user, priority = ticket['user'], ticket['priority']
+            self._active[user] -= 1
+            if not self._active[user]:
+                del self._active[user]
+                if not any(t['user'] == user for t in self._waiting):
+                    del self._served[user]
+            self._active_total -= 1
+            if priority == BULK:
+                self._active_bulk -= 1
+            elapsed = time.monotonic() - ticket['started']
+            self._durations[priority] = 0.8 * self._durations[priority] + 0.2 * elapsed
+            self._wake()
+
+    @contextlib.contextmanager
+    def admit(self, user, priority):
+        ticket = self.acquire(user, priority)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self, user, priority):
+        """Like `admit`, for async handlers; a queued job holds no thread while it waits."""
+        ticket = await self.acquire_async(user, priority)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def status(self):
+        with self._cond:
+            return {
+                'slots': self.slots,
+                'active': self._active_total,
+                'active_bulk': self._active_bulk,
+                'queued_interactive': sum(1 for t in self._waiting if t['priority'] == INTERACTIVE),
+                'queued_bulk': sum(1 for t in self._waiting if t['priority'] == BULK),
+                'rejected': self._rejected,
+                'average_seconds': {'interactive': self._durations[INTERACTIVE], 'bulk': self._durations[BULK]},
+            }
@@ -0,0 +1,97 @@
+import io
+import shutil
+import subprocess
+from PIL import Image
+
+ANIMATION_FORMATS = {'mp4': '.mp4', 'webp': '.webp', 'gif': '.gif'}
+
+
+class FrameEncoder:
+    """Builds an animated GIF or WebP from PNG frames, converting each as it arrives.
+
+    Pillow writes animations in one call, so converted frames are held until
+    `finish` and callers must keep the frame count small; GIF frames are
+    reduced to a palette first, a third of the size.
+    Runs of identical frames become one longer frame, so the part of an
+    animation that has settled costs nothing.
+    """
+
+    def __init__(self, image_format, output_path, fps, quality=80):
+        self.image_format = image_format
+        self.output_path = output_path
+        self.frame_ms = 1000 / fps
+        self.quality = quality
+        self._frames = []
+        self._durations = []
+        self._last = None
+
+    def add_frame(self, png_bytes):
+        if png_bytes == self._last:
+            self._durations[-1] += self.frame_ms
+            return
+        self._last = png_bytes
+        with Image.open(io.BytesIO(png_bytes)) as image:
+            frame = image.convert('RGB')
+        if self.image_format == 'GIF':
+            frame = frame.quantize(colors=256)
+        self._frames.append(frame)
+        self._durations.append(self.frame_ms)
+
+    def finish(self):
+        if not self._frames:
+            raise RuntimeError('The animation has no frames to write.')
+        first, *rest = self._frames
+        first.save(
+            self.output_path, format=self.image_format, save_all=True, append_images=rest,
+            duration=[round(ms) for ms in self._durations], loop=0, quality=self.quality,
+        )
+        self.close()
+
+    def close(self):
+        self._frames.clear()
+        self._last = None
+
+
+class Mp4Encoder:
+    """Streams PNG frames into ffmpeg as they arrive and writes an H.264 MP4.
+
+    Only the frame being written is held in memory; ffmpeg's pipe applies
+    backpressure when encoding falls behind.
+    """
+
+    def __init__(self, output_path, fps, ffmpeg='ffmpeg', crf=23):
+        binary = shutil.which(ffmpeg)
+        if not binary:
+            raise RuntimeError(f'MP4 output needs ffmpeg, and "{ffmpeg}" was not found.')
+        self.output_path = output_path
+        self._process = subprocess.Popen(
+            [
+                binary, '-y', '-loglevel', 'error',
+                '-f', 'image2pipe', '-framerate', str(fps), '-c:v', 'png', '-i', '-',
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', # yuv420p needs even dimensions
+                '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', str(crf),
+                '-movflags', '+faststart', output_path,
+            ],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+
+    def add_frame(self, png_bytes):
+        self._process.stdin.write(png_bytes)
+
+    def finish(self):
+        self._process.stdin.close()
+        errors = self._process.stderr.read().decode('utf-8', 'replace')
+        if self._process.wait():
+            raise RuntimeError(f'ffmpeg failed: {errors.strip()[-500:]}')
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+
+def make_encoder(image_format, output_path, fps, quality=80, ffmpeg='ffmpeg'):
+    """Returns an encoder for 'mp4', 'webp' or 'gif' output written to `output_path`."""
+    if image_format == 'mp4':
+        return Mp4Encoder(output_path, fps, ffmpeg=ffmpeg)
+    return FrameEncoder(image_format.upper(), output_path, fps, quality=quality)
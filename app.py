@@ -1,5 +1,6 @@
 import os
 import csv
+import atexit
 import asyncio
 import uuid
 import json
@@ -7,6 +8,11 @@ import zipfile
 import io
 import re
 import random
+import hashlib
+import threading
+import shutil
+import functools
+import contextlib
 from flask import (
     Flask,
     render_template,
@@ -17,9 +23,27 @@ from flask import (
     flash,
     render_template_string,
     jsonify,
+    abort,
+    send_file,
+    g,
 )
-from playwright.async_api import async_playwright
 from werkzeug.utils import secure_filename
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+try:
+    import fcntl
+except ImportError: # Windows: db_locked only serializes threads of one process
+    fcntl = None
+from storage import LocalStorage, LocalObjectClient, ObjectStorage
+from search import SearchIndex
+from animation import ANIMATION_FORMATS, make_encoder
+from profiler import Profiler
+from admission import BULK, INTERACTIVE, AdmissionController, AdmissionRejected
+from publisher import PublishPipelines
+from registry import TemplateRegistry
+from renderer import (
+    VARIANT_EXTENSIONS, RenderLimitError, Renderer, RenderLoop, encode_image, parse_animation, parse_variants,
+    render_label, supports_binding,
+)
 
 # --- App Initialization ---
 app = Flask(__name__)
@@ -31,28 +55,204 @@ GENERATED_FOLDER = 'generated'
 TEMPLATE_FOLDER = 'thumbnail_templates'
 IMAGE_UPLOAD_FOLDER = 'image_uploads' # New folder for uploaded images
 DB_FILE = 'db.json'
+DB_LOCK_FILE = 'db.json.lock' # flock'd by every read-modify-write of DB_FILE
+SEARCH_INDEX_FILE = 'search_index.db' # Rebuilt from db.json whenever it's missing or stale
 ALLOWED_EXTENSIONS = {'csv', 'html', 'png', 'jpg', 'jpeg', 'gif'}
 VIDEO_EXTENSIONS = [".mp4", ".mov", ".avi", ".webm", ".mkv"]
+# Row used for previews in the template editor, matching the template guide
+PREVIEW_SAMPLE_ROW = {
+    'badge': 'Part 2',
+    'main_title': "Another <span class='highlight'>AWESOME</span> Video",
+    'sub_title': 'From Scratch in 2025',
+    'image_url': 'https://i.ibb.co.com/Nd6mC2g2/PERSON.png',
+}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['GENERATED_FOLDER'] = GENERATED_FOLDER
 app.config['TEMPLATE_FOLDER'] = TEMPLATE_FOLDER
 app.config['IMAGE_UPLOAD_FOLDER'] = IMAGE_UPLOAD_FOLDER # Add to app config
 
+# Garbage collection of unreferenced files, per folder config key
+app.config['GC_INTERVAL_SECONDS'] = 3600
+app.config['GC_MIN_AGE_SECONDS'] = 3600 # Never touch files younger than this, even over quota
+app.config['GC_RETENTION_SECONDS'] = {
+    'UPLOAD_FOLDER': 24 * 3600,
+    'IMAGE_UPLOAD_FOLDER': 7 * 24 * 3600,
+    'GENERATED_FOLDER': 24 * 3600,
+    'PROFILE_FOLDER': 7 * 24 * 3600,
+}
+app.config['GC_QUOTA_BYTES'] = {
+    'UPLOAD_FOLDER': 1024 ** 3,
+    'IMAGE_UPLOAD_FOLDER': 1024 ** 3,
+    'GENERATED_FOLDER': 5 * 1024 ** 3,
+    'PROFILE_FOLDER': 256 * 1024 ** 2,
+}
+app.config['GC_ARCHIVE_FOLDER'] = None # Set to a folder to archive instead of delete
+app.config['RERENDER_DELAY_SECONDS'] = 2 # Quiet period after a template save, so quick re-saves coalesce
+app.config['RERENDER_CHUNK_SIZE'] = 4 # Small chunks keep background work to about one page at a time
+app.config['RERENDER_PAUSE_SECONDS'] = 0.5 # Gap between chunks, leaving the renderer free for requests
+
+# Where generated images are kept: 'local' (sharded folders) or 'object'
+app.config['STORAGE_BACKEND'] = 'local'
+app.config['STORAGE_SHARD_DEPTH'] = 1
+app.config['OBJECT_STORE_ROOT'] = 'object_store' # Local stand-in used when no client is configured
+app.config['OBJECT_STORE_BUCKET'] = 'generated'
+app.config['OBJECT_STORE_CLIENT'] = None # e.g. boto3.client('s3')
+
+app.config['RENDER_BIND_MIN_ROWS_PER_PAGE'] = 16
+app.config['PUBLISH_IMAGE_FORMAT'] = 'PNG' # 'JPEG' uploads a smaller re-encoded copy when publishing a fresh render
+app.config['PUBLISH_IMAGE_QUALITY'] = 90
+app.config['PREVIEW_SCALE'] = 0.5 # Live previews are rendered at half resolution
+app.config['PREVIEW_JPEG_QUALITY'] = 70
+
+# Chromium resource limits, applied to every page the renderer opens
+app.config['RENDER_MAX_PAGES'] = 4 # Concurrent pages per worker process
+app.config['RENDER_BUDGET_SECONDS'] = 30 # Wall-clock limit per render step before the page is killed
+app.config['RENDER_MAX_PAGE_MEMORY_MB'] = 512 # JS heap cap per page
+app.config['RENDER_BLOCKED_RESOURCE_TYPES'] = ['media', 'websocket', 'eventsource', 'manifest', 'texttrack']
+app.config['RENDER_BLOCKED_HOSTS'] = ['google-analytics.com', 'googletagmanager.com', 'doubleclick.net']
+app.config['RENDER_ALLOWED_HOSTS'] = None # e.g. ['fonts.googleapis.com', 'fonts.gstatic.com', 'i.ibb.co']; the app itself is always allowed
+
+# Admission control for render requests, shared by every route in a worker process
+app.config['ADMISSION_SLOTS'] = 3 # Render jobs running at once
+app.config['ADMISSION_RESERVED_INTERACTIVE'] = 1 # Slots bulk jobs may never take
+app.config['ADMISSION_MAX_QUEUE'] = 16
+app.config['ADMISSION_MAX_WAIT_SECONDS'] = 20
+
+app.config['LIBRARY_PAGE_SIZE'] = 24
+
+# On-demand profiling of a route or background job
+app.config['PROFILE_FOLDER'] = 'profiles'
+app.config['PROFILE_MAX_SECONDS'] = 300
+app.config['PROFILE_INTERVAL_MS'] = 5 # Stack sampling interval
+
+# Animated output; templates can set their own fps and length with a render-animation meta tag
+app.config['ANIMATION_FPS'] = 12
+app.config['ANIMATION_SECONDS'] = 3
+app.config['ANIMATION_MAX_FPS'] = 30
+app.config['ANIMATION_MAX_SECONDS'] = 10
+app.config['ANIMATION_QUEUE_FRAMES'] = 4 # Captured frames waiting for the encoder
+app.config['ANIMATION_MAX_HELD_FRAMES'] = 48 # GIF/WebP frames are held until encoded, ~2.7MB each at 1280x720
+app.config['ANIMATION_QUALITY'] = 80 # WebP quality
+app.config['FFMPEG_BINARY'] = 'ffmpeg' # Needed for MP4 output only
+
+app.config['GRAPH_API_URL'] = 'https://graph.facebook.com' # load_test.py points this at its fake server
+app.config['PUBLISH_PAGE_CONCURRENCY'] = 2 # Uploads in flight per Facebook page
+app.config['PUBLISH_USAGE_LIMIT'] = 90 # Usage percent at which a page's uploads pause for a minute
+app.config['PUBLISH_TOKEN_TTL_SECONDS'] = 3600 # How long a page token is reused
+
+# Startup warm-up: launch Chromium and render each template once before taking traffic
+app.config['WARMUP_TRIAL_RENDERS'] = True
+app.config['WARMUP_WAIT_SECONDS'] = 20 # How long a starting worker holds off requests; the rest warms in the background
+
 # --- Helper Functions ---
 
+def build_storage():
+    """Creates the storage backend for generated images from the app config."""
+    if app.config['STORAGE_BACKEND'] == 'object':
+        client = app.config['OBJECT_STORE_CLIENT'] or LocalObjectClient(app.config['OBJECT_STORE_ROOT'])
+        return ObjectStorage(
+            client,
+            app.config['OBJECT_STORE_BUCKET'],
+            shard_depth=app.config['STORAGE_SHARD_DEPTH'],
+            legacy_root=app.config['GENERATED_FOLDER'],
+        )
+    return LocalStorage(app.config['GENERATED_FOLDER'], shard_depth=app.config['STORAGE_SHARD_DEPTH'])
+
+image_store = build_storage()
+profiler = Profiler(app.config['PROFILE_FOLDER'])
+search_index = SearchIndex(SEARCH_INDEX_FILE)
+
+render_violations_lock = threading.Lock()
+render_violations = {} # template name -> {'counts': {kind: n}, 'last': {...}, 'last_blocked': {...}}
+
+def record_render_violation(label, kind, detail):
+    """Counts a renderer limit hit against the template that caused it."""
+    with render_violations_lock:
+        entry = render_violations.setdefault(label or 'unknown', {'counts': {}, 'last': None, 'last_blocked': None})
+        entry['counts'][kind] = entry['counts'].get(kind, 0) + 1
+        # Blocked requests are routine; keep them from hiding the last real failure
+        entry['last_blocked' if kind == 'blocked_request' else 'last'] = {'kind': kind, 'detail': detail, 'at': time.time()}
+    if kind != 'blocked_request':
+        app.logger.warning(f'Render of {label or "unknown"} stopped: {kind}, {detail}')
+
+# One warm Chromium per process, driven from a shared event loop
+renderer = Renderer(
+    max_pages=app.config['RENDER_MAX_PAGES'],
+    preview_scale=app.config['PREVIEW_SCALE'],
+    preview_quality=app.config['PREVIEW_JPEG_QUALITY'],
+    budget_seconds=app.config['RENDER_BUDGET_SECONDS'],
+    max_page_memory_mb=app.config['RENDER_MAX_PAGE_MEMORY_MB'],
+    blocked_resource_types=app.config['RENDER_BLOCKED_RESOURCE_TYPES'],
+    blocked_hosts=app.config['RENDER_BLOCKED_HOSTS'],
+    allowed_hosts=app.config['RENDER_ALLOWED_HOSTS'],
+    on_violation=record_render_violation,
+)
+render_loop = RenderLoop()
+admission = AdmissionController(
+    slots=app.config['ADMISSION_SLOTS'],
+    max_queue=app.config['ADMISSION_MAX_QUEUE'],
+    max_wait=app.config['ADMISSION_MAX_WAIT_SECONDS'],
+    reserved_interactive=app.config['ADMISSION_RESERVED_INTERACTIVE'],
+)
+publish_pipelines = PublishPipelines(
+    concurrency=app.config['PUBLISH_PAGE_CONCURRENCY'],
+    usage_limit=app.config['PUBLISH_USAGE_LIMIT'],
+    token_ttl=app.config['PUBLISH_TOKEN_TTL_SECONDS'],
+)
+atexit.register(publish_pipelines.shutdown)
+template_registry = TemplateRegistry(app.config['TEMPLATE_FOLDER'])
+
+db_lock = threading.RLock()
+db_lock_state = {'depth': 0, 'file': None}
+
+@contextlib.contextmanager
+def db_locked():
+    """Holds the database lock for a read-modify-write of db.json.
+
+    Threads of a process share `db_lock`; worker processes (gunicorn runs
+    several) also take an exclusive flock on DB_LOCK_FILE. Reentrant, so
+    helpers that write can be called with the lock held. Renders never run
+    under it: they go to scratch files and are filed by `commit_renders`.
+    """
+    with db_lock:
+        if db_lock_state['depth'] == 0 and fcntl:
+            lock_file = open(DB_LOCK_FILE, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            db_lock_state['file'] = lock_file
+        db_lock_state['depth'] += 1
+        try:
+            yield
+        finally:
+            db_lock_state['depth'] -= 1
+            if db_lock_state['depth'] == 0 and db_lock_state['file']:
+                db_lock_state['file'].close() # Releases the flock
+                db_lock_state['file'] = None
+
 def init_db():
-    """Initializes the JSON database if it doesn't exist."""
-    if not os.path.exists(DB_FILE):
-        with open(DB_FILE, 'w') as f:
-            json.dump({"thumbnails": [], "social_media_credentials": {}}, f)
+    """Initializes the JSON database if it doesn't exist, and migrates older layouts.
+
+    The migration runs once per start and is written back, so reads never
+    have to redo it.
+    """
+    with db_locked():
+        if not os.path.exists(DB_FILE):
+            write_db({"thumbnails": [], "social_media_credentials": {}})
+        with open(DB_FILE, 'r') as f:
+            data = json.load(f)
+        before = json.dumps(data, sort_keys=True)
+        normalize_credentials(data)
+        normalize_library(data)
+        if json.dumps(data, sort_keys=True) != before:
+            write_db(data)
 
 def get_page_access_token(user_token, page_id):
     """Exchange user token for page token."""
-    url = f"https://graph.facebook.com/v19.0/{page_id}"
+    url = f"{app.config['GRAPH_API_URL']}/v19.0/{page_id}"
     params = {"fields": "access_token", "access_token": user_token}
     try:
         r = requests.get(url, params=params)
+        publish_pipelines.record(page_id, r)
         r.raise_for_status()  # Raise an exception for bad status codes
         data = r.json()
         if "access_token" in data:
@@ -67,14 +267,109 @@ def get_db():
     """Reads the entire database, ensuring default keys exist."""
     with open(DB_FILE, 'r') as f:
         data = json.load(f)
-    if 'social_media_credentials' not in data:
-        data['social_media_credentials'] = {}
+    credentials = data.setdefault('social_media_credentials', {})
+    credentials.setdefault('facebook_accounts', {})
+    credentials.setdefault('facebook_pages', {})
+    library = data.setdefault('library', {})
+    library.setdefault('folders', {})
+    library.setdefault('items', {})
     return data
 
+def normalize_credentials(data):
+    """Makes sure credentials hold Facebook accounts and the pages each one manages.
+
+    Older databases kept a single token and page id; they become an
+    account named 'Default' with that one page. Run by `init_db`.
+    """
+    credentials = data.setdefault('social_media_credentials', {})
+    accounts = credentials.setdefault('facebook_accounts', {})
+    pages = credentials.setdefault('facebook_pages', {})
+    token = credentials.pop('facebook_access_token', None)
+    page_id = credentials.pop('facebook_page_id', None)
+    if token:
+        accounts.setdefault('default', {'name': 'Default', 'access_token': token, 'created_at': time.time()})
+        if page_id:
+            pages.setdefault(page_id, {'name': '', 'account': 'default'})
+
+def facebook_pages(db):
+    """Returns the configured pages for templates, sorted by name, each with its account name."""
+    credentials = db['social_media_credentials']
+    accounts = credentials['facebook_accounts']
+    pages = [
+        {'id': page_id, 'name': page.get('name') or page_id,
+         'account': page.get('account'), 'account_name': accounts.get(page.get('account'), {}).get('name', '')}
+        for page_id, page in credentials['facebook_pages'].items()
+    ]
+    return sorted(pages, key=lambda page: page['name'].lower())
+
+def normalize_library(data):
+    """Makes sure the library holds folders and references by thumbnail id.
+
+    Older databases kept a full copy of each saved thumbnail in
+    `library['images']`. Those become references; a copy whose thumbnail
+    has since been deleted is restored as a thumbnail so it isn't lost.
+    Run by `init_db`, which writes the result back: folder ids are new on
+    every run.
+    """
+    library = data.setdefault('library', {})
+    if not isinstance(library.get('folders'), dict):
+        library['folders'] = {
+            str(uuid.uuid4()): {'name': folder if isinstance(folder, str) else folder.get('name', 'Folder'), 'created_at': time.time()}
+            for folder in library.get('folders') or []
+        }
+    items = library.setdefault('items', {})
+    snapshots = library.pop('images', None)
+    if snapshots:
+        thumbnail_ids = {item['id'] for item in data['thumbnails']}
+        for snapshot in snapshots:
+            if not isinstance(snapshot, dict) or not snapshot.get('id'):
+                continue
+            if snapshot['id'] not in thumbnail_ids:
+                data['thumbnails'].append(snapshot)
+                thumbnail_ids.add(snapshot['id'])
+            items.setdefault(snapshot['id'], {'folder': None, 'added_at': snapshot.get('created_at') or time.time()})
+
 def write_db(data):
-    """Writes data to the database."""
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+    """Writes data to the database and brings the search index up to date.
+
+    The new file replaces the old one in a single step, so a concurrent
+    `get_db` never reads a partial write.
+    """
+    with db_locked():
+        temp_path = f'{DB_FILE}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(temp_path, DB_FILE)
+        search_index.sync(data.get('thumbnails', []), data.get('library'), db_stamp())
+
+def db_stamp():
+    """Identifies the current version of db.json by its mtime and size."""
+    st = os.stat(DB_FILE)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+def refresh_search_index():
+    """Resyncs the search index if db.json changed since it was last indexed."""
+    stamp = db_stamp()
+    if search_index.stamp() != stamp:
+        db = get_db()
+        search_index.sync(db['thumbnails'], db['library'], stamp)
+
+def parse_search_time(value, end=False):
+    """Reads a search date bound given as YYYY-MM-DD or a Unix timestamp.
+
+    A date used as an end bound covers that whole day.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        day = datetime.strptime(value, "%Y-%m-%d")
+        return (day + timedelta(days=1 if end else 0)).timestamp()
+
+def get_templates():
+    """Returns the names of the thumbnail templates, sorted, from the in-memory registry."""
+    return template_registry.names()
 
 def allowed_file(filename):
     """Checks if the file extension is allowed."""
@@ -90,36 +385,865 @@ def generate_slug(text):
     slug = re.sub(r'[\s-]+', '-', slug).strip('-') # replace spaces and hyphens with a single hyphen
     return slug
 
-async def create_thumbnail(html_content, output_filename):
-    """Renders HTML content using Playwright and saves a screenshot."""
-    output_path = os.path.join(app.config['GENERATED_FOLDER'], output_filename)
-    async with async_playwright() as p:
-        browser = await p.chromium.launch()
-        page = await browser.new_page(viewport={"width": 1280, "height": 720})
-        
-        # Get the base URL for resolving local paths and inject it into the HTML.
-        base_url = url_for('index', _external=True)
-        if '<head>' in html_content:
-            html_with_base = html_content.replace('<head>', f'<head>\n    <base href="{base_url}">')
+def parse_selection(source):
+    """Builds a selection spec from request form/args.
+
+    A selection may name a saved set (`selection`), list ad-hoc ids (`ids`,
+    repeated or comma-separated) and filter on fields (`filter_<field>`,
+    case-insensitive substring match on the thumbnail data or `template`).
+    `all=1` confirms that an empty selection means the whole library.
+    Returns None if selection fields were submitted but all of them were
+    blank, so a cleared filter can't widen to every thumbnail.
+    """
+    ids = []
+    for value in source.getlist('ids'):
+        ids.extend(part.strip() for part in value.split(',') if part.strip())
+    query = {}
+    for key in source.keys():
+        if key.startswith('filter_') and source.get(key, '').strip():
+            query[key[len('filter_'):]] = source.get(key).strip()
+    name = source.get('selection', '').strip()
+    submitted = any(key in ('selection', 'ids') or key.startswith('filter_') for key in source.keys())
+    if submitted and not (name or ids or query):
+        return None
+    return {
+        'selection': name,
+        'ids': ids,
+        'query': query,
+        'all': source.get('all') == '1',
+    }
+
+def selection_error(spec):
+    """Returns why a destructive bulk change can't run on a selection, or None.
+
+    Changing the whole library takes an explicit `all=1`.
+    """
+    if spec is None:
+        return 'The selection filters were empty, so nothing was changed.'
+    if not (spec['selection'] or spec['ids'] or spec['query'] or spec['all']):
+        return 'Select some thumbnails, or confirm the change applies to all of them.'
+    return None
+
+def matches_query(thumbnail, query):
+    """Checks a thumbnail against a field query from a selection."""
+    for field, needle in query.items():
+        if field == 'template':
+            value = thumbnail.get('template', '')
         else:
-            html_with_base = f'<base href="{base_url}">{html_content}'
+            value = thumbnail.get('data', {}).get(field, '')
+        if needle.lower() not in str(value or '').lower():
+            return False
+    return True
+
+def select_thumbnails(db, spec):
+    """Returns the thumbnails matched by a selection spec.
+
+    An empty spec matches the whole library; routes that change thumbnails
+    check `selection_error` first, so that only happens with `all=1`.
+    Returns None if the spec names a selection that doesn't exist.
+    """
+    ids = set(spec.get('ids', []))
+    query = dict(spec.get('query', {}))
+    name = spec.get('selection')
+    if name:
+        saved = db.get('selections', {}).get(name)
+        if saved is None:
+            return None
+        ids.update(saved.get('ids', []))
+        query.update(saved.get('query', {}))
+        if not ids and not saved.get('query'):
+            return []
+
+    thumbnails = db['thumbnails']
+    if ids:
+        thumbnails = [item for item in thumbnails if item['id'] in ids]
+    if query:
+        thumbnails = [item for item in thumbnails if matches_query(item, query)]
+    return thumbnails
+
+def skipped_note(count):
+    """Notes thumbnails a bulk change left alone because they were edited while it rendered."""
+    return f' {count} edited meanwhile were left as they are.' if count else ''
+
+def describe_selection(spec):
+    """Returns a short human-readable label for a selection spec."""
+    if spec.get('selection'):
+        return f'selection "{spec["selection"]}"'
+    if spec.get('ids') or spec.get('query'):
+        return 'selected thumbnails'
+    return 'all thumbnails'
+
+async def create_thumbnail(html_content, output_filename, base_url):
+    """Renders HTML content on the shared renderer and saves a screenshot.
+
+    `base_url` is injected as a <base> tag so local paths in the template
+    resolve against the app.
+    """
+    output_path = os.path.join(app.config['GENERATED_FOLDER'], output_filename)
+    await renderer.render(html_content, base_url=base_url, path=output_path)
+
+def slug_for_row(row):
+    """Builds the human-readable part of an output filename from row data."""
+    full_main_title = row.get('main_title', 'untitled')
+    match = re.search(r"<span class='highlight'>(.*?)</span>", full_main_title)
+    product_name_for_slug = match.group(1) if match else full_main_title
+
+    badge_text = row.get('badge', '')
+    sub_title_text = row.get('sub_title', '')
+
+    combined_text = f"{badge_text} {product_name_for_slug} {sub_title_text}".strip()
+    return generate_slug(combined_text)
+
+def find_thumbnail(db, thumbnail_id):
+    """Returns the record with `thumbnail_id`, or None."""
+    return next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
+
+def template_exists(template_name):
+    """Checks that a template name taken from a request is a file in the template folder."""
+    return bool(template_name) and os.path.isfile(os.path.join(app.config['TEMPLATE_FOLDER'], template_name))
+
+def render_row(template_name, data):
+    """Renders a thumbnail template with row data; needs an app context."""
+    return render_template_string(template_registry.source(template_name), **data)
+
+def hash_file(path):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def record_files(item):
+    """Returns every generated file a record uses: its main image, variants and animations."""
+    files = {item.get('filename')}
+    files.update(item.get('variants', {}).values())
+    files.update(item.get('animations', {}).values())
+    files.discard(None)
+    return files
+
+def is_file_referenced(db, filename):
+    """Checks whether any thumbnail still uses a generated file."""
+    for item in db['thumbnails']:
+        if filename in record_files(item):
+            return True
+    return False
+
+def release_file(db, filename):
+    """Deletes a generated file once no record refers to it any more."""
+    if not filename or is_file_referenced(db, filename):
+        return
+    image_store.delete(filename)
+
+def file_render(temp_filename, slug):
+    """Moves a scratch render into the store as `<slug>-<hash><ext>`; returns (name, hash)."""
+    temp_path = os.path.join(app.config['GENERATED_FOLDER'], temp_filename)
+    content_hash = hash_file(temp_path)
+    filename = f"{slug}-{content_hash[:12]}{os.path.splitext(temp_filename)[1]}"
+
+    if image_store.exists(filename):
+        os.remove(temp_path) # Same image already stored, share it
+    else:
+        image_store.put_file(filename, temp_path)
+    return filename, content_hash
+
+def release_files(db, filenames):
+    """Deletes replaced files that no record in `db` uses; call only once `db` is written."""
+    for filename in filenames:
+        release_file(db, filename)
+
+def store_render(thumbnail, temp_filename, variant_temps=None):
+    """Files a finished render under its content-addressed name.
+
+    Output names are `<slug>-<hash>.png`: readable, unique per distinct
+    image, and identical renders resolve to the same file so they share
+    storage. Variants are filed the same way as `<slug>-<variant>-<hash>`
+    and kept on the record by name. Animations show the old render, so they
+    are dropped. Returns the files the thumbnail no longer uses, for
+    `release_files` once the database has been written.
+    """
+    slug = slug_for_row(thumbnail['data'])
+    old_files = record_files(thumbnail)
+    filename, content_hash = file_render(temp_filename, slug)
+    thumbnail['filename'] = filename
+    thumbnail['content_hash'] = content_hash
+    if variant_temps:
+        thumbnail['variants'] = {
+            name: file_render(variant_temp, f"{slug}-{name}")[0] for name, variant_temp in variant_temps.items()
+        }
+    else:
+        thumbnail.pop('variants', None)
+    thumbnail.pop('animations', None)
+    return old_files - record_files(thumbnail)
 
-        await page.set_content(html_with_base, timeout=60000)
-        await page.screenshot(path=output_path, type="png")
-        await browser.close()
+def discard_temp_files(temp_filenames):
+    """Removes render scratch files from the generated folder."""
+    for temp_filename in temp_filenames:
+        try:
+            os.remove(os.path.join(app.config['GENERATED_FOLDER'], temp_filename))
+        except OSError:
+            pass
+
+async def render_to_temp(rendered_html, base_url):
+    """Renders HTML to a scratch file in the generated folder and returns its name."""
+    temp_filename = f".render-{uuid.uuid4().hex}.png"
+    try:
+        await create_thumbnail(rendered_html, temp_filename, base_url)
+    except Exception:
+        discard_temp_files([temp_filename])
+        raise
+    return temp_filename
+
+async def render_outputs(rendered_html, base_url):
+    """Renders a row to memory: the main PNG bytes and a dict of variant name to (bytes, extension)."""
+    variants = parse_variants(rendered_html)
+    if not variants:
+        return await renderer.render(rendered_html, base_url=base_url), {}
+    main, outputs = await renderer.render_variants(rendered_html, variants, base_url=base_url)
+    return main, {v['name']: (outputs[v['name']], VARIANT_EXTENSIONS[v['format']]) for v in variants}
+
+def write_temp_outputs(main, variant_outputs):
+    """Writes rendered outputs to scratch files; returns (main temp name, {variant: temp name})."""
+    temp_filename = f".render-{uuid.uuid4().hex}.png"
+    variant_temps = {name: f".render-{uuid.uuid4().hex}{ext}" for name, (_, ext) in variant_outputs.items()}
+    contents = [(temp_filename, main)] + [(variant_temps[name], data) for name, (data, _) in variant_outputs.items()]
+    try:
+        for name, data in contents:
+            with open(os.path.join(app.config['GENERATED_FOLDER'], name), 'wb') as f:
+                f.write(data)
+    except OSError:
+        discard_temp_files([name for name, _ in contents])
+        raise
+    return temp_filename, variant_temps
+
+def animation_timing(rendered_html, image_format):
+    """Returns (fps, seconds) for an animated render, within the configured limits.
+
+    GIF and WebP frames stay in memory until the file is written, so those
+    formats drop their frame rate to keep under ANIMATION_MAX_HELD_FRAMES.
+    MP4 frames stream through ffmpeg and aren't limited.
+    """
+    settings = parse_animation(rendered_html)
+    fps = min(settings.get('fps', app.config['ANIMATION_FPS']), app.config['ANIMATION_MAX_FPS'])
+    seconds = max(0.1, min(settings.get('seconds', app.config['ANIMATION_SECONDS']), app.config['ANIMATION_MAX_SECONDS']))
+    if image_format != 'mp4':
+        fps = min(fps, app.config['ANIMATION_MAX_HELD_FRAMES'] / seconds)
+    return max(1, fps), seconds
+
+async def render_animation_to_temp(rendered_html, base_url, image_format):
+    """Renders an animation to a scratch file in the generated folder and returns its name."""
+    fps, seconds = animation_timing(rendered_html, image_format)
+    temp_filename = f".render-{uuid.uuid4().hex}{ANIMATION_FORMATS[image_format]}"
+    temp_path = os.path.join(app.config['GENERATED_FOLDER'], temp_filename)
+    encoder = make_encoder(image_format, temp_path, fps, quality=app.config['ANIMATION_QUALITY'],
+                           ffmpeg=app.config['FFMPEG_BINARY'])
+    try:
+        await renderer.render_animation(rendered_html, encoder, base_url=base_url, fps=fps, seconds=seconds,
+                                        queue_frames=app.config['ANIMATION_QUEUE_FRAMES'])
+    except Exception:
+        encoder.close()
+        discard_temp_files([temp_filename])
+        raise
+    return temp_filename
+
+def render_outputs_to_temp(rendered_html, base_url, label):
+    """Renders a row, with any variants, to scratch files; returns (main temp name, {variant: temp name})."""
+    outputs = render_loop.run(render_outputs(rendered_html, base_url), label=label)
+    return write_temp_outputs(*outputs)
+
+async def render_bound_to_temp(skeleton_html, rows, base_url):
+    """Renders rows of a data-binding template to scratch files, one page per chunk."""
+    temp_filenames = [f".render-{uuid.uuid4().hex}.png" for _ in rows]
+    temp_paths = [os.path.join(app.config['GENERATED_FOLDER'], name) for name in temp_filenames]
+    # Spread the rows over the page pool, but keep enough per page to amortize the template load
+    chunk_size = max(-(-len(rows) // renderer.max_pages), app.config['RENDER_BIND_MIN_ROWS_PER_PAGE'])
+    try:
+        await asyncio.gather(*(
+            renderer.render_bound(skeleton_html, rows[i:i + chunk_size], base_url=base_url,
+                                  paths=temp_paths[i:i + chunk_size])
+            for i in range(0, len(rows), chunk_size)
+        ))
+    except Exception:
+        discard_temp_files(temp_filenames)
+        raise
+    return temp_filenames
+
+def render_batch_to_temp(thumbnails):
+    """Renders many thumbnails to scratch files, grouped by template.
+
+    Returns {thumbnail id: (main temp name, {variant: temp name})}; nothing
+    is filed or released, so callers can file the renders against the
+    database as it is once they finish. If any group fails, the scratch
+    files made so far are removed. Templates that declare variants render
+    each row in its own page session. Templates that opt into data binding
+    are loaded once per group and patched per row, and the rest fall back to
+    a full render per thumbnail.
+    """
+    base_url = url_for('index', _external=True)
+    renders = {}
+    by_template = {}
+    for thumbnail in thumbnails:
+        by_template.setdefault(thumbnail['template'], []).append(thumbnail)
+
+    try:
+        for template_name, group in by_template.items():
+            html_template_str = template_registry.source(template_name)
+
+            if parse_variants(html_template_str):
+                for thumbnail in group:
+                    rendered_html = render_template_string(html_template_str, **thumbnail['data'])
+                    renders[thumbnail['id']] = render_outputs_to_temp(rendered_html, base_url, template_name)
+                continue
+
+            if supports_binding(html_template_str):
+                skeleton_html = render_template_string(html_template_str, **group[0]['data'])
+                rows = [thumbnail['data'] for thumbnail in group]
+                temp_filenames = render_loop.run(render_bound_to_temp(skeleton_html, rows, base_url), label=template_name)
+                renders.update((thumbnail['id'], (temp_filename, {})) for thumbnail, temp_filename in zip(group, temp_filenames))
+            else:
+                for thumbnail in group:
+                    rendered_html = render_template_string(html_template_str, **thumbnail['data'])
+                    temp_filename = render_loop.run(render_to_temp(rendered_html, base_url), label=template_name)
+                    renders[thumbnail['id']] = (temp_filename, {})
+    except Exception:
+        discard_temp_files([name for temp_filename, variant_temps in renders.values()
+                            for name in (temp_filename, *variant_temps.values())])
+        raise
+    return renders
+
+def render_state(thumbnail):
+    """Returns what a thumbnail's render depends on, (data, template), copied so later edits don't touch it."""
+    return dict(thumbnail['data']), thumbnail['template']
+
+def commit_renders(thumbnails, renders, rendered_from):
+    """Files finished renders onto the current database in one locked read-modify-write.
+
+    `thumbnails` are records as they were rendered, `renders` maps their ids
+    to scratch files, and `rendered_from` maps ids to the `render_state` each
+    change was made from; ids missing from it are new thumbnails, which are
+    added. A record edited or deleted meanwhile keeps its newer state and
+    its render is discarded. Replaced files are released only after the
+    database is written. Returns the records that were committed.
+    """
+    committed, replaced, stale = [], set(), []
+    with db_locked():
+        db = get_db()
+        current = {item['id']: item for item in db['thumbnails']}
+        for thumbnail in thumbnails:
+            temp_filename, variant_temps = renders[thumbnail['id']]
+            record = current.get(thumbnail['id'])
+            if thumbnail['id'] not in rendered_from:
+                record = thumbnail
+                db['thumbnails'].append(record)
+            elif record is None or render_state(record) != rendered_from[thumbnail['id']]:
+                stale += [temp_filename, *variant_temps.values()]
+                continue
+            else:
+                record['data'], record['template'] = thumbnail['data'], thumbnail['template']
+            replaced |= store_render(record, temp_filename, variant_temps)
+            committed.append(record)
+        if committed:
+            write_db(db)
+            release_files(db, replaced)
+    discard_temp_files(stale)
+    return committed
+
+def commit_outputs(thumbnail, outputs, data, template_name):
+    """Files a render of `thumbnail` with new data and template.
+
+    `thumbnail` is the record as read before rendering and `outputs` what
+    `render_outputs` returned. Returns the stored record, or None if it was
+    edited or deleted meanwhile.
+    """
+    renders = {thumbnail['id']: write_temp_outputs(*outputs)}
+    committed = commit_renders([dict(thumbnail, data=data, template=template_name)], renders,
+                               {thumbnail['id']: render_state(thumbnail)})
+    return committed[0] if committed else None
+
+def render_batch_to_store(thumbnails, rendered_from):
+    """Renders many thumbnails and commits them in one write; returns the records committed."""
+    return commit_renders(thumbnails, render_batch_to_temp(thumbnails), rendered_from)
+
+def reconcile_generated(db):
+    """Cross-checks the generated image store against the database.
+
+    Reports files nobody references, records whose file is missing, and
+    files shared by several records without matching content hashes
+    (collisions left over from the old slug-only naming).
+    """
+    on_disk = {name for name, _, _ in image_store.list()}
+
+    owners = {}
+    for item in db['thumbnails']:
+        owners.setdefault(item.get('filename'), []).append(item)
+
+    dangling = [
+        {'id': item['id'], 'filename': filename}
+        for filename, items in owners.items() if filename not in on_disk
+        for item in items
+    ]
+    variant_files = set()
+    for item in db['thumbnails']:
+        for variant, filename in item.get('variants', {}).items():
+            variant_files.add(filename)
+            if filename not in on_disk:
+                dangling.append({'id': item['id'], 'filename': filename, 'variant': variant})
+        for image_format, filename in item.get('animations', {}).items():
+            variant_files.add(filename)
+            if filename not in on_disk:
+                dangling.append({'id': item['id'], 'filename': filename, 'animation': image_format})
+    collisions = {
+        filename: [item['id'] for item in items]
+        for filename, items in owners.items()
+        if len(items) > 1 and len({item.get('content_hash') for item in items}) > 1
+    }
+    shared = {
+        filename: [item['id'] for item in items]
+        for filename, items in owners.items()
+        if len(items) > 1 and filename not in collisions
+    }
+    orphaned = sorted(on_disk - set(owners) - variant_files)
+    return {
+        'orphaned_files': orphaned,
+        'dangling_records': dangling,
+        'collisions': collisions,
+        'shared_files': shared,
+    }
+
+# --- Garbage Collection ---
+
+gc_lock = threading.Lock()
+gc_state = {'thread': None, 'last_report': None}
+
+def referenced_files(db):
+    """Returns the filenames the store still needs, keyed by folder config key."""
+    generated = set()
+    for item in db['thumbnails']:
+        generated.update(record_files(item))
+    image_prefix = '/uploads/image/'
+    image_uploads = set()
+    for item in db['thumbnails']:
+        image_url = item.get('data', {}).get('image_url') or ''
+        if image_prefix in image_url:
+            image_uploads.add(image_url.split(image_prefix, 1)[1].split('?', 1)[0])
+    return {
+        'UPLOAD_FOLDER': set(), # Zips, saved CSVs and custom media are all transient
+        'IMAGE_UPLOAD_FOLDER': image_uploads,
+        'GENERATED_FOLDER': generated,
+        'PROFILE_FOLDER': set(), # Kept for download until retention runs out
+    }
+
+def gc_entries(folder_key):
+    """Yields the files GC may consider in a folder.
+
+    Generated images are listed through the storage backend; only render
+    scratch files are read from the generated folder directly. Entries with
+    no `path` live in the backend.
+    """
+    folder = app.config[folder_key]
+    is_generated = folder_key == 'GENERATED_FOLDER'
+    if is_generated:
+        for name, size, mtime in image_store.list():
+            yield {'name': name, 'path': None, 'size': size, 'mtime': mtime}
+    if not os.path.isdir(folder):
+        return
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or (is_generated and not entry.name.startswith('.')):
+                continue
+            stat = entry.stat()
+            yield {'name': entry.name, 'path': entry.path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def remove_unreferenced(folder_key, entry):
+    """Deletes or archives one file and returns how many bytes it freed."""
+    archive_folder = app.config['GC_ARCHIVE_FOLDER']
+    try:
+        if archive_folder:
+            target_dir = os.path.join(archive_folder, os.path.basename(app.config[folder_key]))
+            os.makedirs(target_dir, exist_ok=True)
+            target_path = os.path.join(target_dir, entry['name'])
+            if entry['path'] is None:
+                body = image_store.open(entry['name'])
+                try:
+                    with open(target_path, 'wb') as f:
+                        shutil.copyfileobj(body, f)
+                finally:
+                    body.close()
+                image_store.delete(entry['name'])
+            else:
+                shutil.move(entry['path'], target_path)
+        elif entry['path'] is None:
+            image_store.delete(entry['name'])
+        else:
+            os.remove(entry['path'])
+    except OSError:
+        return 0
+    return entry['size']
+
+def collect_garbage(now=None):
+    """Removes unreferenced files past retention and enforces folder quotas.
+
+    Referenced files are never touched. Unreferenced files older than the
+    folder's retention window go first; if the folder is still over quota,
+    the oldest remaining unreferenced files (past GC_MIN_AGE_SECONDS) follow.
+    Folders are scanned without the database lock. The files picked are
+    checked again against the records under the lock just before they go,
+    so a commit that took one up meanwhile (identical renders share a file)
+    keeps it.
+    """
+    now = now or time.time()
+    with gc_lock:
+        with db_locked():
+            referenced = referenced_files(get_db())
+        report = {'started_at': now, 'folders': {}, 'reclaimed_bytes': 0}
+
+        for folder_key, keep in referenced.items():
+            folder = app.config[folder_key]
+            folder_report = {'scanned': 0, 'removed': [], 'reclaimed_bytes': 0, 'total_bytes': 0}
+            report['folders'][folder] = folder_report
+
+            candidates = []
+            for entry in gc_entries(folder_key):
+                folder_report['scanned'] += 1
+                folder_report['total_bytes'] += entry['size']
+                if entry['name'] not in keep:
+                    candidates.append(entry)
+
+            candidates.sort(key=lambda c: c['mtime'])
+            retention = app.config['GC_RETENTION_SECONDS'].get(folder_key)
+            quota = app.config['GC_QUOTA_BYTES'].get(folder_key)
+            doomed, remaining_bytes = [], folder_report['total_bytes']
+            for candidate in candidates:
+                age = now - candidate['mtime']
+                expired = retention is not None and age > retention
+                over_quota = (quota is not None and remaining_bytes > quota
+                              and age > app.config['GC_MIN_AGE_SECONDS'])
+                if expired or over_quota:
+                    doomed.append(candidate)
+                    remaining_bytes -= candidate['size']
+            if not doomed:
+                continue
+
+            with db_locked():
+                keep = referenced_files(get_db())[folder_key]
+                for candidate in doomed:
+                    if candidate['name'] in keep:
+                        continue
+                    freed = remove_unreferenced(folder_key, candidate)
+                    if freed or candidate['size'] == 0:
+                        folder_report['removed'].append(candidate['name'])
+                        folder_report['reclaimed_bytes'] += freed
+                        folder_report['total_bytes'] -= freed
+
+            report['reclaimed_bytes'] += folder_report['reclaimed_bytes']
+
+        report['finished_at'] = time.time()
+        gc_state['last_report'] = report
+        return report
+
+def gc_loop():
+    """Runs garbage collection forever at the configured interval."""
+    try:
+        moved = image_store.migrate_legacy()
+        if moved:
+            app.logger.info(f'Migrated {moved} generated image(s) to the sharded layout.')
+    except Exception as e:
+        app.logger.warning(f'Storage migration failed: {e}')
+    while True:
+        time.sleep(app.config['GC_INTERVAL_SECONDS'])
+        token = profiler.track('gc')
+        try:
+            collect_garbage()
+        except Exception as e:
+            app.logger.warning(f'Garbage collection failed: {e}')
+        finally:
+            profiler.untrack(token)
+
+def start_gc_thread():
+    """Starts the background garbage collector once per process."""
+    with gc_lock:
+        if gc_state['thread'] is None:
+            gc_state['thread'] = threading.Thread(target=gc_loop, name='gc', daemon=True)
+            gc_state['thread'].start()
+
+# --- Background Re-render ---
+
+rerender_lock = threading.Lock()
+rerender_wakeup = threading.Event()
+rerender_state = {'thread': None, 'jobs': {}, 'generations': {}, 'last_report': None}
+
+def schedule_rerender(template_name):
+    """Queues a background re-render of the thumbnails that use a template.
+
+    A job already waiting or running for the same template is superseded:
+    it stops at its next chunk and the new job starts over against the
+    latest template source. Returns how many thumbnails were scheduled.
+    """
+    count = sum(1 for item in get_db()['thumbnails'] if item['template'] == template_name)
+    if not count:
+        return 0
+    with rerender_lock:
+        generation = rerender_state['generations'].get(template_name, 0) + 1
+        rerender_state['generations'][template_name] = generation
+        rerender_state['jobs'][template_name] = {
+            'generation': generation,
+            'base_url': request.host_url,
+            'due_at': time.time() + app.config['RERENDER_DELAY_SECONDS'],
+            'total': count,
+            'done': 0,
+        }
+        if rerender_state['thread'] is None:
+            rerender_state['thread'] = threading.Thread(target=rerender_loop, name='rerender', daemon=True)
+            rerender_state['thread'].start()
+    rerender_wakeup.set()
+    return count
+
+def next_rerender_job():
+    """Blocks until a queued job is due and returns (template name, job)."""
+    while True:
+        with rerender_lock:
+            jobs = rerender_state['jobs']
+            template_name = min(jobs, key=lambda name: jobs[name]['due_at'], default=None)
+            delay = jobs[template_name]['due_at'] - time.time() if template_name else None
+            if template_name and delay <= 0:
+                return template_name, jobs[template_name]
+            rerender_wakeup.clear()
+        rerender_wakeup.wait(delay)
+
+def rerender_job_current(template_name, job):
+    with rerender_lock:
+        return rerender_state['jobs'].get(template_name) is job
+
+def merge_renders(rendered, renders):
+    """Files background renders onto the current database records.
+
+    `renders` maps each id in `rendered` to its scratch files. Records
+    edited or deleted while their render was in flight are skipped and
+    their scratch files removed; the edit rendered them already. Replaced
+    files are released against the database just written, so a file that
+    another record took up meanwhile is kept.
+    """
+    commit_renders(rendered, renders, {item['id']: render_state(item) for item in rendered})
+
+def run_rerender_job(template_name, job):
+    """Re-renders a template's thumbnails a few at a time until done or superseded."""
+    done_ids = set()
+    while rerender_job_current(template_name, job):
+        with app.test_request_context(base_url=job['base_url']):
+            db = get_db()
+            chunk = [
+                item for item in db['thumbnails']
+                if item['template'] == template_name and item['id'] not in done_ids
+            ][:app.config['RERENDER_CHUNK_SIZE']]
+            if not chunk:
+                break
+            try:
+                # Background work queues like any bulk job and backs off when turned away
+                with admission.admit('background', BULK):
+                    renders = render_batch_to_temp(chunk)
+            except AdmissionRejected as e:
+                time.sleep(e.retry_after)
+                continue
+            merge_renders(chunk, renders)
+        done_ids.update(item['id'] for item in chunk)
+        job['done'] = len(done_ids)
+        time.sleep(app.config['RERENDER_PAUSE_SECONDS'])
+
+    with rerender_lock:
+        if rerender_state['jobs'].get(template_name) is job:
+            del rerender_state['jobs'][template_name]
+            rerender_state['last_report'] = {'template': template_name, 'rendered': len(done_ids), 'finished_at': time.time()}
+
+def rerender_loop():
+    """Runs queued template re-renders forever, one job at a time."""
+    while True:
+        template_name, job = next_rerender_job()
+        token = profiler.track('rerender', f'rerender {template_name}')
+        try:
+            run_rerender_job(template_name, job)
+        except Exception as e:
+            app.logger.warning(f'Background re-render of {template_name} failed: {e}')
+            with rerender_lock:
+                if rerender_state['jobs'].get(template_name) is job:
+                    del rerender_state['jobs'][template_name]
+        finally:
+            profiler.untrack(token)
+
+# --- Render Admission ---
+
+def admitted(priority):
+    """Runs a view inside a render admission slot for the requesting client."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with admission.admit(request.remote_addr, priority):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@app.errorhandler(AdmissionRejected)
+def render_busy(e):
+    """Turns away a render request with a Retry-After instead of queueing it."""
+    message = f'The renderer is busy ({e.reason}). Please try again in {e.retry_after} seconds.'
+    headers = {'Retry-After': str(e.retry_after)}
+    if 'text/html' in request.headers.get('Accept', ''):
+        flash(message)
+        return redirect(request.referrer or url_for('index')), 303, headers
+    return jsonify({'status': 'error', 'message': message}), 429, headers
+
+# --- Startup Warm-up ---
+
+warm_lock = threading.Lock()
+warm_done = threading.Event()
+warm_state = {'phase': 'not started', 'ready': False, 'started_at': None, 'seconds': None,
+              'templates': 0, 'failed': {}, 'error': None}
+
+async def trial_renders(pages):
+    """Renders each (template name, html) pair once, concurrently; returns the results or exceptions."""
+    async def trial(name, rendered_html):
+        render_label.set(name)
+        return await render_outputs(rendered_html, None)
+    return await asyncio.gather(*(trial(name, rendered_html) for name, rendered_html in pages), return_exceptions=True)
+
+def warm_up():
+    """Loads the template registry, launches Chromium and renders every template once.
+
+    Launching the browser and opening the first pages is most of what a cold
+    worker's first render costs; the trial renders also fill the font and
+    image caches. A template that fails its trial render is reported but
+    doesn't hold up readiness; a browser that won't start does.
+    """
+    started = time.perf_counter()
+    try:
+        warm_state['phase'] = 'loading templates'
+        names = template_registry.load()
+        warm_state['phase'] = 'starting renderer'
+        render_loop.run(renderer.start(), label='warm-up')
+        if app.config['WARMUP_TRIAL_RENDERS']:
+            warm_state['phase'] = 'trial renders'
+            pages, failed = [], {}
+            with app.app_context():
+                for name in names:
+                    try:
+                        pages.append((name, render_template_string(template_registry.source(name), **PREVIEW_SAMPLE_ROW)))
+                    except Exception as e:
+                        failed[name] = f'Template error: {e}'
+            results = render_loop.run(trial_renders(pages), label='warm-up')
+            failed.update({name: str(result) for (name, _), result in zip(pages, results) if isinstance(result, Exception)})
+            warm_state.update(templates=len(names) - len(failed), failed=failed)
+        warm_state.update(phase='ready', ready=True)
+    except Exception as e:
+        app.logger.warning(f'Warm-up failed: {e}')
+        warm_state.update(phase='failed', error=str(e))
+    finally:
+        warm_state['seconds'] = round(time.perf_counter() - started, 3)
+        warm_done.set()
+
+def start_warm_up(wait=0):
+    """Starts the warm-up in the background once per process, then waits up to `wait` seconds for it."""
+    with warm_lock:
+        if warm_state['started_at'] is None:
+            warm_state.update(started_at=time.time(), phase='starting')
+            threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+    return warm_done.wait(wait)
+
+# --- Thumbnail Edits ---
+# The single-thumbnail edits are served by the Flask routes below and, natively
+# async, by asgi.py. Both work out the edit here; only rendering and replying differ.
+
+CHANGED_MEANWHILE = 'The thumbnail changed while it was being rendered.'
+
+def swap_edit(db, thumbnail_id, form):
+    """Works out a template swap; returns (edit, error), one of them None.
+
+    An edit holds the record as read, the template and data to render it
+    with, and the success message. An error is (message, HTTP status).
+    """
+    thumbnail = find_thumbnail(db, thumbnail_id)
+    if not thumbnail:
+        return None, ('Thumbnail not found.', 404)
+    new_template = form.get('new_template')
+    if not template_exists(new_template):
+        return None, ('Invalid template selected.', 400)
+    return {'thumbnail': thumbnail, 'template': new_template, 'data': thumbnail['data'],
+            'message': f'Design swapped to {new_template} successfully!'}, None
+
+def spin_edit(db, thumbnail_id):
+    """Works out a random image for one thumbnail; returns (edit, error) like `swap_edit`."""
+    image_urls = db.get('image_urls', [])
+    if not image_urls:
+        return None, ('No image URLs saved. Please add some in Settings.', 400)
+    thumbnail = find_thumbnail(db, thumbnail_id)
+    if not thumbnail:
+        return None, ('Thumbnail not found.', 404)
+    return {'thumbnail': thumbnail, 'template': thumbnail['template'],
+            'data': dict(thumbnail['data'], image_url=random.choice(image_urls)),
+            'message': 'Thumbnail image randomly updated!'}, None
+
+def update_edit(db, thumbnail_id, form):
+    """Works out an edit from the edit form; returns (edit, error) like `swap_edit`.
+
+    The form's text fields become the data. The caller saves an uploaded
+    image at `image_upload_path` and points the data's image_url at it.
+    """
+    thumbnail = find_thumbnail(db, thumbnail_id)
+    if not thumbnail:
+        return None, ('Thumbnail not found.', 404)
+    template_name = form.get('template_select') or thumbnail['template']
+    if not template_exists(template_name):
+        return None, ('Invalid template selected.', 400)
+    data = {key: value for key, value in form.items() if isinstance(value, str)}
+    return {'thumbnail': thumbnail, 'template': template_name, 'data': data,
+            'message': 'Thumbnail updated successfully!'}, None
+
+def image_upload_path(thumbnail_id, filename):
+    """Returns (stored name, path) for an image uploaded with an edit, or None if it isn't an allowed file."""
+    if not filename or not allowed_file(filename):
+        return None
+    image_filename = secure_filename(f"{thumbnail_id}_{filename}")
+    return image_filename, os.path.join(app.config['IMAGE_UPLOAD_FOLDER'], image_filename)
+
+def edit_reply(edit, image_url):
+    """Returns the JSON body for a finished edit."""
+    return {'status': 'success', 'message': edit['message'], 'new_image_url': f'{image_url}?v={uuid.uuid4()}'} # Add cache-buster
+
+def apply_edit(edit):
+    """Renders and commits an edit from a Flask route and returns the JSON response."""
+    try:
+        rendered_html = render_row(edit['template'], edit['data'])
+        outputs = render_loop.run(render_outputs(rendered_html, url_for('index', _external=True)), label=edit['template'])
+        thumbnail = commit_outputs(edit['thumbnail'], outputs, edit['data'], edit['template'])
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'An error occurred: {e}'}), 500
+    if not thumbnail:
+        return jsonify({'status': 'error', 'message': CHANGED_MEANWHILE}), 409
+    return jsonify(edit_reply(edit, url_for('generated_file', filename=thumbnail['filename'], _external=True)))
 
 # --- Routes ---
 
+@app.before_request
+def start_background_tasks():
+    """Makes sure each worker process runs its background garbage collector and has warmed up."""
+    if gc_state['thread'] is None:
+        start_gc_thread()
+    if warm_state['started_at'] is None:
+        start_warm_up()
+
+@app.before_request
+def start_profiling_request():
+    """Lets a running profiling session sample this request if it targets the route."""
+    g.profile_token = profiler.track(request.endpoint)
+
+@app.teardown_request
+def stop_profiling_request(_):
+    profiler.untrack(g.pop('profile_token', None))
+
 @app.route('/')
 def index():
     """Main page: displays templates and generated thumbnails."""
     db = get_db()
     thumbnails = sorted(db['thumbnails'], key=lambda x: x.get('created_at', 0), reverse=True)
-    
-    template_files = os.listdir(app.config['TEMPLATE_FOLDER'])
-    templates = [f for f in template_files if f.endswith('.html')]
-    
-    return render_template('index.html', thumbnails=thumbnails, templates=templates)
+    return render_template('index.html', thumbnails=thumbnails, templates=get_templates())
 
 @app.route('/post_to_facebook/<thumbnail_id>')
 def post_to_facebook(thumbnail_id):
@@ -130,7 +1254,7 @@ def post_to_facebook(thumbnail_id):
         flash('Thumbnail not found.')
         return redirect(url_for('index'))
     
-    return render_template('facebook_post.html', thumbnail=thumbnail)
+    return render_template('facebook_post.html', thumbnail=thumbnail, pages=facebook_pages(db))
 
 @app.route('/social_hub/<thumbnail_id>')
 def social_hub(thumbnail_id):
@@ -140,36 +1264,87 @@ def social_hub(thumbnail_id):
     if not thumbnail:
         flash('Thumbnail not found.')
         return redirect(url_for('index'))
-    return render_template('social_hub.html', thumbnail=thumbnail)
+    return render_template('social_hub.html', thumbnail=thumbnail, pages=facebook_pages(db))
 
 @app.route('/settings')
 def settings():
     """Displays the settings page for social media credentials."""
     db = get_db()
-    credentials = db.get('social_media_credentials', {})
+    accounts = db['social_media_credentials']['facebook_accounts']
     image_urls = db.get('image_urls', [])
-    return render_template('settings.html', credentials=credentials, image_urls=image_urls)
+    return render_template('settings.html', accounts=accounts, pages=facebook_pages(db), image_urls=image_urls)
 
 @app.route('/save_image_urls', methods=['POST'])
 def save_image_urls():
     """Saves the list of image URLs to the database."""
-    db = get_db()
-    urls = request.form.get('image_urls', '').splitlines()
-    # Filter out any empty lines
-    db['image_urls'] = [url.strip() for url in urls if url.strip()]
-    write_db(db)
-    flash('Image URLs saved successfully!', 'success')
-    return redirect(url_for('settings'))
+    with db_locked():
+        db = get_db()
+        urls = request.form.get('image_urls', '').splitlines()
+        # Filter out any empty lines
+        db['image_urls'] = [url.strip() for url in urls if url.strip()]
+        write_db(db)
+        flash('Image URLs saved successfully!', 'success')
+        return redirect(url_for('settings'))
 
 @app.route('/save_settings', methods=['POST'])
 def save_settings():
-    """Saves social media credentials to the database."""
-    db = get_db()
-    db['social_media_credentials']['facebook_access_token'] = request.form.get('facebook_access_token')
-    db['social_media_credentials']['facebook_page_id'] = request.form.get('facebook_page_id')
-    write_db(db)
-    flash('Facebook credentials saved successfully!', 'success')
-    return redirect(url_for('settings'))
+    """Adds a Facebook account and its pages, or updates the account with the same name.
+
+    Pages are given one per line (or comma separated) as a page id,
+    optionally followed by the page's name.
+    """
+    with db_locked():
+        db = get_db()
+        credentials = db['social_media_credentials']
+        token = (request.form.get('facebook_access_token') or '').strip()
+        name = (request.form.get('account_name') or '').strip() or 'Default'
+        entries = [line.split(None, 1) for line in re.split(r'[\n,]+', request.form.get('facebook_page_id', '')) if line.strip()]
+        if not token or not entries:
+            flash('An access token and at least one page ID are required.', 'error')
+            return redirect(url_for('settings'))
+
+        accounts = credentials['facebook_accounts']
+        account_id = next((key for key, account in accounts.items() if account.get('name') == name), None)
+        if account_id is None:
+            account_id = str(uuid.uuid4())
+            accounts[account_id] = {'name': name, 'created_at': time.time()}
+        accounts[account_id]['access_token'] = token
+        for entry in entries:
+            page = credentials['facebook_pages'].setdefault(entry[0], {'name': ''})
+            page['account'] = account_id
+            if len(entry) > 1:
+                page['name'] = entry[1].strip()
+        write_db(db)
+        flash(f'Facebook account "{name}" saved with {len(entries)} page(s).', 'success')
+        return redirect(url_for('settings'))
+
+@app.route('/delete_facebook_account/<account_id>', methods=['POST'])
+def delete_facebook_account(account_id):
+    """Removes a Facebook account and the pages it manages."""
+    with db_locked():
+        db = get_db()
+        credentials = db['social_media_credentials']
+        account = credentials['facebook_accounts'].pop(account_id, None)
+        if account:
+            removed = [page_id for page_id, page in credentials['facebook_pages'].items() if page.get('account') == account_id]
+            for page_id in removed:
+                del credentials['facebook_pages'][page_id]
+            write_db(db)
+            for page_id in removed:
+                publish_pipelines.forget(page_id)
+            flash(f'Facebook account "{account.get("name")}" removed.', 'success')
+        return redirect(url_for('settings'))
+
+@app.route('/delete_facebook_page/<page_id>', methods=['POST'])
+def delete_facebook_page(page_id):
+    """Removes one page from the publish targets."""
+    with db_locked():
+        db = get_db()
+        if db['social_media_credentials']['facebook_pages'].pop(page_id, None) is not None:
+            write_db(db)
+            publish_pipelines.forget(page_id)
+            flash('Facebook page removed.', 'success')
+        return redirect(url_for('settings'))
 
 import requests
 from datetime import datetime, timedelta
@@ -178,119 +1353,269 @@ import pytz # For timezone handling
 
 # ... (other imports)
 
-@app.route('/publish_facebook_post/<thumbnail_id>', methods=['POST'])
-def publish_facebook_post(thumbnail_id):
-    """Handles publishing or scheduling a Facebook post, with optional custom media."""
-    db = get_db()
-    credentials = db.get('social_media_credentials', {})
-    user_access_token = credentials.get('facebook_access_token')
-    page_id = credentials.get('facebook_page_id')
+def parse_schedule_time(schedule_datetime_str):
+    """Converts a Dhaka-local schedule string to a Unix timestamp for the Graph API."""
+    if not schedule_datetime_str:
+        return None, 'A schedule time is required.'
+
+    dhaka_tz = pytz.timezone('Asia/Dhaka')
+    schedule_dt_naive = datetime.strptime(schedule_datetime_str, "%Y-%m-%d %H:%M")
+    schedule_dt_dhaka = dhaka_tz.localize(schedule_dt_naive)
+    scheduled_publish_time = int(schedule_dt_dhaka.timestamp())
+
+    if scheduled_publish_time < int(time.time()) + 600:
+        return None, 'Scheduled time must be at least 10 minutes in the future.'
+    return scheduled_publish_time, None
+
+def graph_request(page_id, method, url, **kwargs):
+    """Makes a Graph API call for a page and records its usage and throttling."""
+    response = requests.request(method, url, **kwargs)
+    publish_pipelines.record(page_id, response)
+    return response
+
+def publish_media(page_id, page_access_token, media_name, media, form):
+    """Uploads media to a page and posts it, returning (message, error)."""
+    # Determine if the file is a video
+    _, ext = os.path.splitext(media_name.lower())
+    is_video = ext in VIDEO_EXTENSIONS
+
+    # Step 1: Upload the media to get an ID.
+    endpoint = 'videos' if is_video else 'photos'
+    upload_url = f"{app.config['GRAPH_API_URL']}/{page_id}/{endpoint}"
+    
+    payload = {
+        'access_token': page_access_token,
+        'published': False
+    }
+    
+    files = {'source': (media_name, media)}
+    if is_video:
+        upload_response = graph_request(page_id, 'post', upload_url, data=payload, files=files, timeout=600) # 10 minute timeout for videos
+    else:
+        upload_response = graph_request(page_id, 'post', upload_url, data=payload, files=files)
+    
+    upload_response_data = upload_response.json()
 
-    if not user_access_token or not page_id:
-        return jsonify({'status': 'error', 'message': 'Facebook credentials not set. Please go to Settings.'})
+    if upload_response.status_code != 200 or 'id' not in upload_response_data:
+        return None, upload_response_data.get('error', {}).get('message', 'Failed to upload media to Facebook.')
 
-    page_access_token, error = get_page_access_token(user_access_token, page_id)
-    if error:
-        return jsonify({'status': 'error', 'message': f'Facebook Auth Error: {error}'})
+    media_id = upload_response_data['id']
 
-    thumbnail = next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
+    # Step 2: Create the post on the page's feed using the media ID.
+    post_url = f"{app.config['GRAPH_API_URL']}/{page_id}/feed"
+    post_params, error = feed_post_params(page_access_token, media_id, form)
+    if error:
+        return None, error
+
+    response = graph_request(page_id, 'post', post_url, params=post_params)
+    response_data = response.json()
+
+    if response.status_code != 200 or 'id' not in response_data:
+        error_message = response_data.get('error', {}).get('message', 'Unknown Facebook API error.')
+        return None, f'Failed to publish/schedule post: {error_message}'
+
+    post_id = response_data['id']
+    first_comment = form.get('first_comment', '')
+    if first_comment:
+        comment_url = f"{app.config['GRAPH_API_URL']}/{post_id}/comments"
+        comment_params = {'access_token': page_access_token, 'message': first_comment}
+        graph_request(page_id, 'post', comment_url, params=comment_params)
+
+    return published_message(post_id, form), None
+
+def feed_post_params(page_access_token, media_id, form):
+    """Returns (params, error) for the feed post that publishes uploaded media, scheduled if the form asks."""
+    post_params = {
+        'access_token': page_access_token,
+        'message': form.get('caption', ''),
+        'attached_media[0]': f"{{'media_fbid': '{media_id}'}}"
+    }
+    if form.get('schedule_option', 'now') == 'schedule':
+        scheduled_publish_time, error = parse_schedule_time(form.get('schedule_datetime'))
+        if error:
+            return None, error
+        post_params['scheduled_publish_time'] = scheduled_publish_time
+        post_params['published'] = 'false'
+    return post_params, None
+
+def published_message(post_id, form):
+    return f"Post {'scheduled' if form.get('schedule_option', 'now') == 'schedule' else 'published'} successfully! Post ID: {post_id}"
+
+def publish_targets(db, page_ids):
+    """Returns the pages chosen for a post, each with its account's token, or (None, error).
+
+    With no pages chosen, a post goes to the only configured page, if there is just one.
+    """
+    credentials = db['social_media_credentials']
+    pages = credentials['facebook_pages']
+    if not pages:
+        return None, 'Facebook credentials not set. Please go to Settings.'
+    page_ids = list(dict.fromkeys(page_id for page_id in page_ids if page_id))
+    if not page_ids:
+        if len(pages) > 1:
+            return None, 'Choose at least one Facebook page to post to.'
+        page_ids = list(pages)
+
+    targets = []
+    for page_id in page_ids:
+        page = pages.get(page_id)
+        if page is None:
+            return None, f'Unknown Facebook page {page_id}.'
+        account = credentials['facebook_accounts'].get(page.get('account'), {})
+        if not account.get('access_token'):
+            return None, f'No access token for page {page.get("name") or page_id}. Please go to Settings.'
+        targets.append({'page_id': page_id, 'name': page.get('name') or page_id, 'user_token': account['access_token']})
+    return targets, None
+
+def publish_request(db, thumbnail_id, form):
+    """Returns (targets, thumbnail, error) for a publish request; error is a message for the JSON reply."""
+    targets, error = publish_targets(db, form.getlist('page_ids'))
+    if error:
+        return None, None, error
+    thumbnail = find_thumbnail(db, thumbnail_id)
     if not thumbnail:
-        return jsonify({'status': 'error', 'message': 'Thumbnail not found.'})
+        return None, None, 'Thumbnail not found.'
+    return targets, thumbnail, None
+
+def custom_media_path(filename):
+    """Returns (name, path) in the upload folder for custom media; the file is removed once posted."""
+    media_name = secure_filename(f"custom_{uuid.uuid4()}_{filename}")
+    return media_name, os.path.join(app.config['UPLOAD_FOLDER'], media_name)
+
+def stored_media(thumbnail, form):
+    """Returns (name, error) for the stored file a post sends: the thumbnail, or one of its animations."""
+    if form.get('animation'):
+        # A stored animation of this thumbnail; MP4s are uploaded as video
+        media_name = thumbnail.get('animations', {}).get(form['animation'])
+        if not media_name or not image_store.exists(media_name):
+            return None, 'Animation not found. Please create it again.'
+        return media_name, None
+    if not image_store.exists(thumbnail['filename']):
+        return None, 'Media file not found on server.'
+    return thumbnail['filename'], None
+
+def publish_edit(thumbnail, form):
+    """Returns (data, template name, error) for a render_and_publish request.
+
+    Only the thumbnail's own fields are taken from the form, not the caption.
+    """
+    data = {key: form.get(key, value) for key, value in thumbnail['data'].items()}
+    template_name = form.get('template_select') or thumbnail['template']
+    if not template_exists(template_name):
+        return None, None, 'Invalid template selected.'
+    return data, template_name, None
+
+def publish_image(png_bytes, data):
+    """Returns (name, bytes) for uploading a fresh render in the PUBLISH_IMAGE_FORMAT."""
+    media_format = app.config['PUBLISH_IMAGE_FORMAT']
+    media_bytes = encode_image(png_bytes, media_format, app.config['PUBLISH_IMAGE_QUALITY'])
+    return f"{slug_for_row(data)}.{'jpg' if media_format == 'JPEG' else media_format.lower()}", media_bytes
+
+def page_access_token(target):
+    """Returns (page token, error) for a publish target, reusing a cached token."""
+    page_id, user_token = target['page_id'], target['user_token']
+    token = publish_pipelines.cached_token(page_id, user_token)
+    if token:
+        return token, None
+    token, error = get_page_access_token(user_token, page_id)
+    if error:
+        return None, f'Facebook Auth Error: {error}'
+    publish_pipelines.store_token(page_id, user_token, token)
+    return token, None
+
+def publish_to_page(target, media_name, open_media, form):
+    """Publishes one post to one page; runs in that page's pipeline."""
+    wait = publish_pipelines.blocked_for(target['page_id'])
+    if wait:
+        return None, f'Facebook is rate limiting this page. Please try again in {wait} seconds.'
+    token, error = page_access_token(target)
+    if error:
+        return None, error
+    with open_media() as media:
+        return publish_media(target['page_id'], token, media_name, media, form)
+
+def publish_summary(targets, results):
+    """Combines per-page (message, error) results into one response body."""
+    pages = {
+        target['page_id']: {'name': target['name'], 'status': 'error' if error else 'success', 'message': error or message}
+        for target, (message, error) in zip(targets, results)
+    }
+    failed = [page for page in pages.values() if page['status'] == 'error']
+    if len(pages) == 1:
+        message = next(iter(pages.values()))['message']
+    else:
+        message = f'Posted to {len(pages) - len(failed)} of {len(pages)} pages.'
+        message += ''.join(f" {page['name']}: {page['message']}" for page in failed)
+    return {'status': 'error' if failed else 'success', 'message': message, 'pages': pages}
 
-    caption = request.form.get('caption', '')
-    first_comment = request.form.get('first_comment', '')
-    schedule_option = request.form.get('schedule_option', 'now')
-    schedule_datetime_str = request.form.get('schedule_datetime')
+def publish_to_pages(targets, media_name, open_media, form):
+    """Publishes to every target page at once, each through its own pipeline."""
+    futures = [publish_pipelines.submit(target['page_id'], publish_to_page, target, media_name, open_media, form)
+               for target in targets]
+    return publish_summary(targets, [future.result() for future in futures])
+
+@app.route('/publish_facebook_post/<thumbnail_id>', methods=['POST'])
+def publish_facebook_post(thumbnail_id):
+    """Handles publishing or scheduling a Facebook post, with optional custom media."""
+    targets, thumbnail, error = publish_request(get_db(), thumbnail_id, request.form)
+    if error:
+        return jsonify({'status': 'error', 'message': error})
 
     media_path = None
     try:
         # Check for custom uploaded media
-        if 'custom_media' in request.files and request.files['custom_media'].filename != '':
-            custom_file = request.files['custom_media']
-            filename = secure_filename(f"custom_{uuid.uuid4()}_{custom_file.filename}")
-            media_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        custom_file = request.files.get('custom_media')
+        if custom_file and custom_file.filename:
+            media_name, media_path = custom_media_path(custom_file.filename)
             custom_file.save(media_path)
         else:
-            # Fallback to the generated thumbnail
-            media_path = os.path.join(app.config['GENERATED_FOLDER'], thumbnail['filename'])
-
-        if not os.path.exists(media_path):
-            return jsonify({'status': 'error', 'message': 'Media file not found on server.'})
-
-        # Determine if the file is a video
-        _, ext = os.path.splitext(media_path.lower())
-        is_video = ext in VIDEO_EXTENSIONS
-
-        # Step 1: Upload the media to get an ID.
-        endpoint = 'videos' if is_video else 'photos'
-        upload_url = f"https://graph.facebook.com/{page_id}/{endpoint}"
-        
-        payload = {
-            'access_token': page_access_token,
-            'published': False
-        }
-        
-        with open(media_path, 'rb') as f:
-            files = {'source': f}
-            if is_video:
-                upload_response = requests.post(upload_url, data=payload, files=files, timeout=600) # 10 minute timeout for videos
-            else:
-                upload_response = requests.post(upload_url, data=payload, files=files)
-        
-        upload_response_data = upload_response.json()
-
-        if upload_response.status_code != 200 or 'id' not in upload_response_data:
-            error_message = upload_response_data.get('error', {}).get('message', 'Failed to upload media to Facebook.')
-            return jsonify({'status': 'error', 'message': error_message})
-
-        media_id = upload_response_data['id']
-
-        # Step 2: Create the post on the page's feed using the media ID.
-        post_url = f"https://graph.facebook.com/{page_id}/feed"
-        post_params = {
-            'access_token': page_access_token,
-            'message': caption,
-            'attached_media[0]': f"{{'media_fbid': '{media_id}'}}"
-        }
-
-        if schedule_option == 'schedule':
-            if not schedule_datetime_str:
-                return jsonify({'status': 'error', 'message': 'A schedule time is required.'})
+            media_name, error = stored_media(thumbnail, request.form)
+            if error:
+                return jsonify({'status': 'error', 'message': error})
 
-            dhaka_tz = pytz.timezone('Asia/Dhaka')
-            schedule_dt_naive = datetime.strptime(schedule_datetime_str, "%Y-%m-%d %H:%M")
-            schedule_dt_dhaka = dhaka_tz.localize(schedule_dt_naive)
-            scheduled_publish_time = int(schedule_dt_dhaka.timestamp())
-
-            if scheduled_publish_time < int(time.time()) + 600:
-                return jsonify({'status': 'error', 'message': 'Scheduled time must be at least 10 minutes in the future.'})
-            
-            post_params['scheduled_publish_time'] = scheduled_publish_time
-            post_params['published'] = False
-
-        response = requests.post(post_url, params=post_params)
-        response_data = response.json()
-
-        if response.status_code == 200 and 'id' in response_data:
-            post_id = response_data['id']
-            if first_comment:
-                comment_url = f"https://graph.facebook.com/{post_id}/comments"
-                comment_params = {'access_token': page_access_token, 'message': first_comment}
-                requests.post(comment_url, params=comment_params)
-
-            message = f"Post {'scheduled' if schedule_option == 'schedule' else 'published'} successfully! Post ID: {post_id}"
-            return jsonify({'status': 'success', 'message': message})
-        else:
-            error_message = response_data.get('error', {}).get('message', 'Unknown Facebook API error.')
-            return jsonify({'status': 'error', 'message': f'Failed to publish/schedule post: {error_message}'})
+        # Each page's upload opens its own handle
+        open_media = (lambda: open(media_path, 'rb')) if media_path else (lambda: image_store.open(media_name))
+        return jsonify(publish_to_pages(targets, media_name, open_media, request.form.to_dict()))
 
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'An unexpected error occurred: {e}'})
     finally:
         # Clean up temporary custom upload
-        if 'custom_media' in request.files and media_path and os.path.exists(media_path):
-            if "custom_" in media_path: # Basic safety check
-                os.remove(media_path)
+        if media_path and os.path.exists(media_path):
+            os.remove(media_path)
+
+def persist_render(thumbnail, outputs, data, template_name):
+    """Files a render that was made for publishing, in a background thread.
+
+    The upload doesn't wait on the disk write or on the database. If the
+    record was edited since the request read it, the edit wins and this
+    render is discarded.
+    """
+    threading.Thread(target=commit_outputs, args=(thumbnail, outputs, data, template_name),
+                     name='persist-render', daemon=True).start()
+
+@app.route('/render_and_publish/<thumbnail_id>', methods=['POST'])
+@admitted(INTERACTIVE)
+def render_and_publish(thumbnail_id):
+    """Renders edited thumbnail data to memory and publishes it in one request.
+
+    The screenshot is uploaded straight from memory; the stored copy and the
+    record update are written in the background.
+    """
+    targets, thumbnail, error = publish_request(get_db(), thumbnail_id, request.form)
+    if not error:
+        data, template_name, error = publish_edit(thumbnail, request.form)
+    if error:
+        return jsonify({'status': 'error', 'message': error})
+
+    try:
+        rendered_html = render_row(template_name, data)
+        outputs = render_loop.run(render_outputs(rendered_html, url_for('index', _external=True)), label=template_name)
+        persist_render(thumbnail, outputs, data, template_name)
+        media_name, media_bytes = publish_image(outputs[0], data)
+        return jsonify(publish_to_pages(targets, media_name, lambda: io.BytesIO(media_bytes), request.form.to_dict()))
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'An unexpected error occurred: {e}'})
 
 # --- Main Execution ---
 
@@ -300,6 +1625,7 @@ def uploaded_image(filename):
     return send_from_directory(app.config['IMAGE_UPLOAD_FOLDER'], filename)
 
 @app.route('/upload_csv', methods=['POST'])
+@admitted(BULK)
 def upload_csv():
     """Handles CSV upload, data processing, and thumbnail generation."""
     if 'file' not in request.files:
@@ -320,46 +1646,26 @@ def upload_csv():
             flash('No template selected')
             return redirect(url_for('index'))
 
-        template_path = os.path.join(app.config['TEMPLATE_FOLDER'], template_name)
-        with open(template_path, 'r') as f:
-            html_template_str = f.read()
-
-        db = get_db()
         try:
+            new_thumbnails = []
             with open(filepath, 'r', encoding='utf-8') as csvfile:
                 reader = csv.DictReader(csvfile)
                 for row in reader:
                     # Generate a unique ID for the thumbnail record
                     unique_id = str(uuid.uuid4())
                     
-                    full_main_title = row.get('main_title', 'untitled')
-                    match = re.search(r"<span class='highlight'>(.*?)</span>", full_main_title)
-                    product_name_for_slug = match.group(1) if match else full_main_title
-
-                    badge_text = row.get('badge', '')
-                    sub_title_text = row.get('sub_title', '')
-
-                    combined_text = f"{badge_text} {product_name_for_slug} {sub_title_text}".strip()
-                    slug = generate_slug(combined_text)
-                    
-                    output_filename = f"{slug}.png"
-                    
-                    # Render the HTML with data from the CSV row
-                    rendered_html = render_template_string(html_template_str, **row)
-                    
-                    # Create the thumbnail
-                    asyncio.run(create_thumbnail(rendered_html, output_filename))
-                    
-                    # Save metadata to DB
-                    thumbnail_data = {
+                    new_thumbnails.append({
                         "id": unique_id,
-                        "filename": output_filename,
+                        "filename": None,
                         "template": template_name,
                         "data": row,
-                        "created_at": os.path.getctime(os.path.join(app.config['GENERATED_FOLDER'], output_filename))
-                    }
-                    db['thumbnails'].append(thumbnail_data)
-            write_db(db)
+                    })
+
+            # Render every row in one batch, then save metadata to DB
+            renders = render_batch_to_temp(new_thumbnails)
+            for thumbnail_data in new_thumbnails:
+                thumbnail_data["created_at"] = time.time()
+            commit_renders(new_thumbnails, renders, {})
             flash(f'Successfully generated thumbnails from {filename}!')
         except Exception as e:
             flash(f'An error occurred: {e}')
@@ -374,11 +1680,10 @@ def upload_csv():
 @app.route('/manual')
 def manual_entry():
     """Displays the manual column entry page."""
-    template_files = os.listdir(app.config['TEMPLATE_FOLDER'])
-    templates = sorted([f for f in template_files if f.endswith('.html')])
-    return render_template('manual_entry.html', templates=templates)
+    return render_template('manual_entry.html', templates=get_templates())
 
 @app.route('/generate_manual', methods=['POST'])
+@admitted(BULK)
 def generate_manual():
     """Generates thumbnails from four columns of line-separated text."""
     template_name = request.form.get('template')
@@ -400,12 +1705,7 @@ def generate_manual():
         flash('No data entered.')
         return redirect(url_for('manual_entry'))
 
-    template_path = os.path.join(app.config['TEMPLATE_FOLDER'], template_name)
-    with open(template_path, 'r') as f:
-        html_template_str = f.read()
-
-    db = get_db()
-    count = 0
+    new_thumbnails = []
     try:
         for i in range(num_thumbnails):
             # Assemble data for one row, using empty strings for missing lines
@@ -428,35 +1728,21 @@ def generate_manual():
             # Generate a unique ID for the thumbnail record
             unique_id = str(uuid.uuid4())
             
-            full_main_title = row_data.get('main_title', 'untitled')
-            match = re.search(r"<span class='highlight'>(.*?)</span>", full_main_title)
-            product_name_for_slug = match.group(1) if match else full_main_title
-
-            badge_text = row_data.get('badge', '')
-            sub_title_text = row_data.get('sub_title', '')
-
-            combined_text = f"{badge_text} {product_name_for_slug} {sub_title_text}".strip()
-            slug = generate_slug(combined_text)
-            
-            output_filename = f"{slug}.png"
-            
-            rendered_html = render_template_string(html_template_str, **row_data)
-            asyncio.run(create_thumbnail(rendered_html, output_filename))
-            
-            thumbnail_data = {
+            new_thumbnails.append({
                 "id": unique_id,
-                "filename": output_filename,
+                "filename": None,
                 "template": template_name,
                 "data": row_data,
-                "created_at": os.path.getctime(os.path.join(app.config['GENERATED_FOLDER'], output_filename))
-            }
-            db['thumbnails'].append(thumbnail_data)
-            count += 1
+            })
+
+        renders = render_batch_to_temp(new_thumbnails)
+        for thumbnail_data in new_thumbnails:
+            thumbnail_data["created_at"] = time.time()
         
-        write_db(db)
+        commit_renders(new_thumbnails, renders, {})
         return jsonify({
             'status': 'success',
-            'message': f'Successfully generated {count} thumbnail(s) from manual entry!'
+            'message': f'Successfully generated {len(new_thumbnails)} thumbnail(s) from manual entry!'
         })
     except Exception as e:
         return jsonify({
@@ -474,72 +1760,88 @@ def edit_thumbnail(thumbnail_id):
         flash('Thumbnail not found.')
         return redirect(url_for('index'))
     image_urls = db.get('image_urls', [])
-    template_files = os.listdir(app.config['TEMPLATE_FOLDER'])
-    templates = [f for f in template_files if f.endswith('.html')]
-    return render_template('edit.html', thumbnail=thumbnail, image_urls=image_urls, templates=templates)
+    return render_template('edit.html', thumbnail=thumbnail, image_urls=image_urls, templates=get_templates())
 
 @app.route('/update/<thumbnail_id>', methods=['POST'])
+@admitted(INTERACTIVE)
 def update_thumbnail(thumbnail_id):
     """Updates a thumbnail's data and regenerates the image."""
+    edit, error = update_edit(get_db(), thumbnail_id, request.form)
+    if error:
+        message, status = error
+        return jsonify({'status': 'error', 'message': message}), status
+
+    # Handle image upload
+    image_file = request.files.get('image_file')
+    upload = image_file and image_upload_path(thumbnail_id, image_file.filename)
+    if upload:
+        image_filename, image_path = upload
+        image_file.save(image_path)
+        # Update the image_url to point to the local file
+        edit['data']['image_url'] = url_for('uploaded_image', filename=image_filename)
+    return apply_edit(edit)
+
+@app.route('/animate/<thumbnail_id>', methods=['POST'])
+@admitted(BULK)
+def animate_thumbnail(thumbnail_id):
+    """Renders a thumbnail as a short MP4, WebP or GIF and keeps it on the record."""
+    image_format = request.form.get('format', 'mp4').lower()
+    if image_format not in ANIMATION_FORMATS:
+        return jsonify({'status': 'error', 'message': 'Unsupported animation format.'}), 400
     db = get_db()
     thumbnail = next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
     if not thumbnail:
         return jsonify({'status': 'error', 'message': 'Thumbnail not found.'}), 404
 
-    # Update data from form
-    new_data = request.form.to_dict()
-    thumbnail['data'] = new_data
-    
-    # Handle template change
-    new_template = request.form.get('template_select')
-    if new_template and new_template != thumbnail['template']:
-        thumbnail['template'] = new_template
-
-    # Handle image upload
-    if 'image_file' in request.files:
-        image_file = request.files['image_file']
-        if image_file and image_file.filename != '' and allowed_file(image_file.filename):
-            image_filename = secure_filename(f"{thumbnail_id}_{image_file.filename}")
-            image_path = os.path.join(app.config['IMAGE_UPLOAD_FOLDER'], image_filename)
-            image_file.save(image_path)
-            # Update the image_url to point to the local file
-            thumbnail['data']['image_url'] = url_for('uploaded_image', filename=image_filename)
-
-    # Regenerate thumbnail
-    template_path = os.path.join(app.config['TEMPLATE_FOLDER'], thumbnail['template'])
-    with open(template_path, 'r') as f:
-        html_template_str = f.read()
-    
-    rendered_html = render_template_string(html_template_str, **thumbnail['data'])
-    asyncio.run(create_thumbnail(rendered_html, thumbnail['filename']))
-
-    write_db(db)
-    
-    # Return JSON response for AJAX
+    try:
+        rendered_html = render_row(thumbnail['template'], thumbnail['data'])
+    except OSError:
+        return jsonify({'status': 'error', 'message': f"Template {thumbnail['template']} not found."}), 404
+    try:
+        temp_filename = render_loop.run(
+            render_animation_to_temp(rendered_html, url_for('index', _external=True), image_format),
+            label=thumbnail['template'],
+        )
+    except (RuntimeError, RenderLimitError, PlaywrightTimeoutError) as e:
+        return jsonify({'status': 'error', 'message': f'Animation failed: {e}'}), 500
+
+    # The capture takes a while; file it against the record as it is now
+    rendered_from = render_state(thumbnail)
+    with db_locked():
+        db = get_db()
+        thumbnail = next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
+        if not thumbnail or render_state(thumbnail) != rendered_from:
+            discard_temp_files([temp_filename])
+            return jsonify({'status': 'error', 'message': 'The thumbnail changed while it was being animated.'}), 409
+        filename, _ = file_render(temp_filename, f"{slug_for_row(thumbnail['data'])}-anim")
+        animations = thumbnail.setdefault('animations', {})
+        old_filename = animations.get(image_format)
+        animations[image_format] = filename
+        write_db(db)
+        if old_filename and old_filename != filename:
+            release_file(db, old_filename)
     return jsonify({
         'status': 'success',
-        'message': 'Thumbnail updated successfully!',
-        'new_image_url': url_for('generated_file', filename=thumbnail['filename'], _external=True) + f'?v={uuid.uuid4()}' # Add cache-buster
+        'message': f'{image_format.upper()} animation created.',
+        'format': image_format,
+        'animation_url': url_for('generated_file', filename=filename, _external=True),
     })
 
 @app.route('/delete/<thumbnail_id>', methods=['POST'])
 def delete_thumbnail(thumbnail_id):
     """Deletes a thumbnail image and its database record."""
-    db = get_db()
-    thumbnail = next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
-    if not thumbnail:
-        flash('Thumbnail not found.')
-        return redirect(url_for('index'))
-
-    # Delete image file
-    try:
-        os.remove(os.path.join(app.config['GENERATED_FOLDER'], thumbnail['filename']))
-    except OSError as e:
-        flash(f"Error deleting file: {e}")
+    with db_locked():
+        db = get_db()
+        thumbnail = next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
+        if not thumbnail:
+            flash('Thumbnail not found.')
+            return redirect(url_for('index'))
 
-    # Remove from DB
-    db['thumbnails'] = [item for item in db['thumbnails'] if item['id'] != thumbnail_id]
-    write_db(db)
+        # Remove from DB, then delete the image file unless another record shares it
+        db['thumbnails'] = [item for item in db['thumbnails'] if item['id'] != thumbnail_id]
+        db['library']['items'].pop(thumbnail_id, None)
+        write_db(db)
+        release_files(db, record_files(thumbnail))
     
     flash('Thumbnail deleted.')
     return redirect(url_for('index'))
@@ -547,51 +1849,176 @@ def delete_thumbnail(thumbnail_id):
 
 @app.route('/library/save/<thumbnail_id>', methods=['POST'])
 def save_to_library(thumbnail_id):
-    db = load_db()
-    thumbnail_to_save = next((t for t in db['thumbnails'] if t['id'] == thumbnail_id), None)
+    """Adds a thumbnail to the library by reference, optionally into a folder."""
+    with db_locked():
+        refresh_search_index()
+        if not search_index.has_thumbnail(thumbnail_id):
+            flash('Thumbnail not found.', 'error')
+            return redirect(url_for('index'))
 
-    if thumbnail_to_save:
-        if 'library' not in db:
-            db['library'] = {'folders': [], 'images': []}
-        
-        # Check if the image is already in the library
-        if not any(img['id'] == thumbnail_id for img in db['library']['images']):
-            db['library']['images'].append(thumbnail_to_save)
-            save_db(db)
-            flash('Thumbnail saved to library.', 'success')
-        else:
+        db = get_db()
+        items = db['library']['items']
+        folder = request.form.get('folder') or None
+        if folder not in db['library']['folders']:
+            folder = None
+        if thumbnail_id in items:
             flash('Thumbnail is already in the library.', 'info')
-    else:
-    return redirect(url_for('index'))
+        else:
+            items[thumbnail_id] = {'folder': folder, 'added_at': time.time()}
+            write_db(db)
+            flash('Thumbnail saved to library.', 'success')
+        return redirect(url_for('index'))
 
 @app.route('/library')
 def library():
-    db = load_db()
-    library_images = db.get('library', {}).get('images', [])
-    templates = get_templates()
-    return render_template('library.html', library_images=library_images, templates=templates)
+    """Lists one page of library entries, for all folders or a single one.
+
+    Entries, folders and counts come from the search index, so a page costs
+    the same however large the library grows.
+    """
+    refresh_search_index()
+    current_folder = request.args.get('folder', '')
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    folders = search_index.library_folders()
+    counts = search_index.library_counts()
+    if not current_folder:
+        folder, total = None, counts['all']
+    elif current_folder == 'unfiled':
+        folder, total = '', counts['unfiled']
+    else:
+        match = next((f for f in folders if f['id'] == current_folder), None)
+        if not match:
+            flash('Folder not found.', 'error')
+            return redirect(url_for('library'))
+        folder, total = current_folder, match['count']
+
+    per_page = app.config['LIBRARY_PAGE_SIZE']
+    entries = search_index.library_page(folder, page=page, per_page=per_page)
+    return render_template(
+        'library.html',
+        entries=entries,
+        folders=folders,
+        counts=counts,
+        current_folder=current_folder,
+        page=page,
+        pages=max(1, -(-total // per_page)),
+        templates=get_templates(),
+    )
 
 @app.route('/library/delete/<thumbnail_id>', methods=['POST'])
 def delete_from_library(thumbnail_id):
-    db = load_db()
-    if 'library' in db and 'images' in db['library']:
-        db['library']['images'] = [img for img in db['library']['images'] if img['id'] != thumbnail_id]
-        save_db(db)
-        flash('Thumbnail removed from library.', 'success')
-    else:
-        flash('Library not found or is empty.', 'error')
-    return redirect(url_for('library'))
+    """Removes a thumbnail from the library; the thumbnail itself is kept."""
+    with db_locked():
+        db = get_db()
+        if db['library']['items'].pop(thumbnail_id, None):
+            write_db(db)
+            flash('Thumbnail removed from library.', 'success')
+        else:
+            flash('Thumbnail is not in the library.', 'error')
+        return redirect(request.referrer or url_for('library'))
+
+@app.route('/library/move/<thumbnail_id>', methods=['POST'])
+def move_in_library(thumbnail_id):
+    """Moves a library entry to another folder, or out of all folders."""
+    with db_locked():
+        db = get_db()
+        entry = db['library']['items'].get(thumbnail_id)
+        folder = request.form.get('folder') or None
+        if not entry or (folder and folder not in db['library']['folders']):
+            flash('Library entry or folder not found.', 'error')
+        else:
+            entry['folder'] = folder
+            write_db(db)
+            flash('Thumbnail moved.', 'success')
+        return redirect(request.referrer or url_for('library'))
+
+@app.route('/library/folders', methods=['POST'])
+def create_library_folder():
+    """Creates an empty library folder."""
+    name = request.form.get('name', '').strip()
+    if not name:
+        flash('Folder name is required.', 'error')
+        return redirect(url_for('library'))
+    with db_locked():
+        db = get_db()
+        folder_id = str(uuid.uuid4())
+        db['library']['folders'][folder_id] = {'name': name, 'created_at': time.time()}
+        write_db(db)
+        flash(f'Folder "{name}" created.', 'success')
+        return redirect(url_for('library', folder=folder_id))
+
+@app.route('/library/folders/<folder_id>/rename', methods=['POST'])
+def rename_library_folder(folder_id):
+    """Renames a library folder."""
+    name = request.form.get('name', '').strip()
+    with db_locked():
+        db = get_db()
+        folder = db['library']['folders'].get(folder_id)
+        if not folder or not name:
+            flash('Folder not found or name missing.', 'error')
+            return redirect(url_for('library'))
+        folder['name'] = name
+        write_db(db)
+        flash('Folder renamed.', 'success')
+        return redirect(url_for('library', folder=folder_id))
+
+@app.route('/library/folders/<folder_id>/delete', methods=['POST'])
+def delete_library_folder(folder_id):
+    """Deletes a library folder, leaving its entries in the library unfiled."""
+    with db_locked():
+        db = get_db()
+        folder = db['library']['folders'].pop(folder_id, None)
+        if not folder:
+            flash('Folder not found.', 'error')
+            return redirect(url_for('library'))
+        for entry in db['library']['items'].values():
+            if entry['folder'] == folder_id:
+                entry['folder'] = None
+        write_db(db)
+        flash(f'Folder "{folder["name"]}" deleted; its thumbnails are now unfiled.', 'success')
+        return redirect(url_for('library'))
 
 @app.route('/generated/<filename>')
 def generated_file(filename):
     """Serves a generated thumbnail image."""
-    return send_from_directory(app.config['GENERATED_FOLDER'], filename)
+    if not image_store.exists(filename):
+        abort(404)
+    return image_store.send(filename)
+
+@app.route('/generated/reconcile')
+def reconcile_generated_folder():
+    """Reports orphaned files and dangling records in the generated folder."""
+    db = get_db()
+    report = reconcile_generated(db)
+    return jsonify({'status': 'success', **report})
+
+@app.route('/gc/run', methods=['POST'])
+def run_garbage_collection():
+    """Runs garbage collection now and returns what was reclaimed."""
+    report = collect_garbage()
+    return jsonify({
+        'status': 'success',
+        'message': f"Reclaimed {report['reclaimed_bytes']} bytes.",
+        'report': report,
+    })
+
+@app.route('/gc/status')
+def garbage_collection_status():
+    """Returns the report from the most recent garbage collection run."""
+    return jsonify({'status': 'success', 'report': gc_state['last_report']})
 
 @app.route('/download_template')
 def download_template():
     """Serves the sample CSV template file."""
     return send_from_directory('.', 'template.csv', as_attachment=True, mimetype='text/csv', download_name='template.csv')
 
+def flash_rerender(count):
+    if count:
+        flash(f'Re-rendering {count} thumbnail(s) that use it in the background.')
+
 @app.route('/upload_template', methods=['POST'])
 def upload_template():
     """Handles uploading of new HTML thumbnail templates."""
@@ -605,7 +2032,9 @@ def upload_template():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         file.save(os.path.join(app.config['TEMPLATE_FOLDER'], filename))
+        template_registry.invalidate(filename)
         flash('Template uploaded successfully!')
+        flash_rerender(schedule_rerender(filename))
     else:
         flash('Invalid file type. Please upload an HTML file.')
     return redirect(url_for('index'))
@@ -622,10 +2051,16 @@ def download_all():
     zip_filepath = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
 
     with zipfile.ZipFile(zip_filepath, 'w') as zipf:
+        written = set()
         for thumbnail in db['thumbnails']:
-            image_path = os.path.join(app.config['GENERATED_FOLDER'], thumbnail['filename'])
-            if os.path.exists(image_path):
-                zipf.write(image_path, arcname=thumbnail['filename'])
+            for filename in sorted(record_files(thumbnail)):
+                # Thumbnails with identical renders share one file
+                if filename in written:
+                    continue
+                written.add(filename)
+                if image_store.exists(filename):
+                    with image_store.open(filename) as source, zipf.open(filename, 'w') as target:
+                        shutil.copyfileobj(source, target)
     
     return send_from_directory(app.config['UPLOAD_FOLDER'], zip_filename, as_attachment=True)
 
@@ -633,9 +2068,13 @@ def download_all():
 @app.route('/templates')
 def manage_templates():
     """Displays the template editor page."""
-    template_files = os.listdir(app.config['TEMPLATE_FOLDER'])
-    templates = sorted([f for f in template_files if f.endswith('.html')])
-    return render_template('manage_templates.html', templates=templates)
+    templates = get_templates()
+    # Recent thumbnails can stand in for the sample data in previews
+    recent = sorted(get_db()['thumbnails'], key=lambda x: x.get('created_at', 0), reverse=True)[:20]
+    preview_rows = [{'id': item['id'], 'label': slug_for_row(item['data'])} for item in recent]
+    with render_violations_lock:
+        flagged = {name: entry['last']['detail'] for name, entry in render_violations.items() if entry['last']}
+    return render_template('manage_templates.html', templates=templates, preview_rows=preview_rows, flagged=flagged)
 
 @app.route('/templates/get/<path:filename>')
 def get_template_content(filename):
@@ -652,6 +2091,49 @@ def get_template_content(filename):
         content = f.read()
     return {"content": content}
 
+@app.route('/preview', methods=['POST'])
+def preview_template():
+    """Renders a quick low-resolution preview of draft template code or edited row data.
+
+    Uses the posted `content`, or the saved `template`, with sample data,
+    a thumbnail's own data, or posted field values. Answers 204 when a
+    newer preview from the same editor `channel` has replaced this one.
+    """
+    content = request.form.get('content')
+    if content is None:
+        template_name = secure_filename(request.form.get('template', ''))
+        if not template_exists(template_name):
+            return jsonify({'status': 'error', 'message': 'Template not found.'}), 404
+        content = template_registry.source(template_name)
+
+    row = dict(PREVIEW_SAMPLE_ROW)
+    thumbnail_id = request.form.get('thumbnail_id')
+    if thumbnail_id:
+        thumbnail = next((item for item in get_db()['thumbnails'] if item['id'] == thumbnail_id), None)
+        if thumbnail:
+            row = dict(thumbnail['data'])
+    row.update({key: request.form[key] for key in row if key in request.form})
+
+    try:
+        rendered_html = render_template_string(content, **row)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Template error: {e}'}), 400
+
+    # Binding templates keep their document loaded and only swap the row in
+    source_key = hashlib.sha1(content.encode('utf-8')).hexdigest() if supports_binding(content) else None
+    try:
+        image = render_loop.run(renderer.preview(
+            rendered_html, base_url=url_for('index', _external=True), row=row,
+            source_key=source_key, channel=request.form.get('channel'),
+        ), label=request.form.get('template') or 'preview')
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Preview failed: {e}'}), 500
+    if image is None:
+        return '', 204
+    response = send_file(io.BytesIO(image), mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/templates/save', methods=['POST'])
 def save_template():
     """Saves content to a template file."""
@@ -672,7 +2154,9 @@ def save_template():
     try:
         with open(filepath, 'w') as f:
             f.write(content)
+        template_registry.invalidate(secure_name)
         flash(f'Template "{secure_name}" saved successfully!')
+        flash_rerender(schedule_rerender(secure_name))
     except Exception as e:
         flash(f'Error saving template: {e}')
 
@@ -692,92 +2176,283 @@ def upload_template_file():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         file.save(os.path.join(app.config['TEMPLATE_FOLDER'], filename))
+        template_registry.invalidate(filename)
         flash(f'Template "{filename}" uploaded successfully!')
+        flash_rerender(schedule_rerender(filename))
     else:
         flash('Invalid file type. Please upload an HTML file.')
     return redirect(url_for('manage_templates', highlight_file=filename))
 
+@app.route('/search')
+def search_thumbnails():
+    """Searches thumbnails by title, badge, subtitle, template and creation date.
+
+    Query parameters: q, template, created_from, created_to (YYYY-MM-DD or
+    Unix time), sort (relevance, newest or oldest), page and per_page.
+    """
+    try:
+        created_from = parse_search_time(request.args.get('created_from'))
+        created_to = parse_search_time(request.args.get('created_to'), end=True)
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(100, max(1, int(request.args.get('per_page', 50))))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid date or page number.'}), 400
+
+    refresh_search_index()
+    results, total = search_index.search(
+        request.args.get('q', ''),
+        template=request.args.get('template') or None,
+        created_from=created_from,
+        created_to=created_to,
+        sort=request.args.get('sort'),
+        page=page,
+        per_page=per_page,
+    )
+    for result in results:
+        result['image_url'] = url_for('generated_file', filename=result['filename']) if result['filename'] else None
+    return jsonify({
+        'status': 'success',
+        'results': results,
+        'total': total,
+        'page': page,
+        'pages': -(-total // per_page),
+    })
+
+PROFILE_JOBS = ('rerender', 'gc')
+
+@app.route('/profiling')
+def profiling_status():
+    """Reports the running profiling session and lists stored profiles."""
+    session = profiler.session
+    running = None
+    if session is not None:
+        running = {
+            'target': session.target,
+            'started': session.started,
+            'seconds': session.seconds,
+            'samples': session.sample_count(),
+        }
+    folder = app.config['PROFILE_FOLDER']
+    profiles = []
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder), reverse=True):
+            path = os.path.join(folder, name)
+            profiles.append({
+                'name': name,
+                'size': os.path.getsize(path),
+                'url': url_for('download_profile', filename=name),
+            })
+    return jsonify({
+        'status': 'success',
+        'running': running,
+        'last_result': profiler.last_result,
+        'targets': sorted(app.view_functions) + list(PROFILE_JOBS) + ['*'],
+        'profiles': profiles,
+    })
+
+@app.route('/profiling/start', methods=['POST'])
+def start_profiling():
+    """Samples one route (by endpoint name), a background job or '*' for a time window.
+
+    Sessions are per worker process: requests to other workers aren't sampled.
+    """
+    target = request.form.get('target', '')
+    if target not in app.view_functions and target not in PROFILE_JOBS and target != '*':
+        return jsonify({'status': 'error', 'message': f'Unknown target "{target}".'}), 400
+    try:
+        seconds = min(float(request.form.get('seconds', 30)), app.config['PROFILE_MAX_SECONDS'])
+        interval_ms = max(1, float(request.form.get('interval_ms', app.config['PROFILE_INTERVAL_MS'])))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid seconds or interval.'}), 400
+
+    session = profiler.start(target, seconds=seconds, interval_ms=interval_ms, loop=render_loop.loop())
+    if session is None:
+        return jsonify({'status': 'error', 'message': 'A profiling session is already running.'}), 409
+    return jsonify({
+        'status': 'success',
+        'message': f'Profiling {target} for {seconds:g} seconds.',
+        'status_url': url_for('profiling_status'),
+    })
+
+@app.route('/profiling/stop', methods=['POST'])
+def stop_profiling():
+    """Ends the running session early and writes what it has collected."""
+    if profiler.stop() is None:
+        return jsonify({'status': 'error', 'message': 'No profiling session is running.'}), 404
+    return jsonify({'status': 'success', 'message': 'Profiling stopped; results are being written.'})
+
+@app.route('/profiling/<filename>')
+def download_profile(filename):
+    """Downloads a stored profile (.folded stacks or .trace.json timeline)."""
+    return send_from_directory(app.config['PROFILE_FOLDER'], filename, as_attachment=True)
+
+@app.route('/ready')
+def readiness():
+    """Answers 200 once this worker has warmed up, and 503 while it is warming or if warm-up failed."""
+    ready = warm_state['ready']
+    return jsonify(dict(warm_state, status='ready' if ready else 'warming')), 200 if ready else 503
+
+@app.route('/render/admission')
+def render_admission_status():
+    """Returns render slot usage, queue lengths and rejection counts."""
+    return jsonify({'status': 'success', 'admission': admission.status()})
+
+@app.route('/publish/status')
+def publish_status():
+    """Returns each Facebook page's uploads in flight, outcomes and rate-limit state."""
+    return jsonify({'status': 'success', 'pages': publish_pipelines.status()})
+
+@app.route('/render/violations')
+def render_violation_report():
+    """Returns renderer limit hits (timeouts, memory, blocked requests) per template."""
+    with render_violations_lock:
+        report = {name: dict(entry, counts=dict(entry['counts'])) for name, entry in render_violations.items()}
+    return jsonify({'status': 'success', 'templates': report})
+
+@app.route('/templates/rerender_status')
+def rerender_status():
+    """Returns queued or running template re-renders and the last finished one."""
+    with rerender_lock:
+        jobs = {
+            name: {'done': job['done'], 'total': job['total'], 'due_at': job['due_at']}
+            for name, job in rerender_state['jobs'].items()
+        }
+    return jsonify({'status': 'success', 'jobs': jobs, 'last_report': rerender_state['last_report']})
+
 
 @app.route('/clear_all', methods=['POST'])
 def clear_all():
-    """Deletes all thumbnails and clears the database."""
-    db = get_db()
-    for thumbnail in db['thumbnails']:
-        try:
-            os.remove(os.path.join(app.config['GENERATED_FOLDER'], thumbnail['filename']))
-        except OSError:
-            pass # Ignore if file doesn't exist
-    
-    db['thumbnails'] = []
-    write_db(db)
-    flash('All thumbnails have been cleared.')
+    """Deletes the selected thumbnails (all with `all=1`) and their records."""
+    spec = parse_selection(request.form)
+    error = selection_error(spec)
+    if error:
+        flash(error)
+        return redirect(url_for('index'))
+    with db_locked():
+        db = get_db()
+        selected = select_thumbnails(db, spec)
+        if selected is None:
+            flash('Selection not found.')
+            return redirect(url_for('index'))
+
+        removed_ids = {item['id'] for item in selected}
+        db['thumbnails'] = [item for item in db['thumbnails'] if item['id'] not in removed_ids]
+        for thumbnail_id in removed_ids:
+            db['library']['items'].pop(thumbnail_id, None)
+        write_db(db)
+        # Files shared with thumbnails outside the selection are kept
+        release_files(db, set().union(*(record_files(item) for item in selected)))
+    if spec['selection'] or spec['ids'] or spec['query']:
+        flash(f'{len(removed_ids)} thumbnail(s) from {describe_selection(spec)} have been cleared.')
+    else:
+        flash('All thumbnails have been cleared.')
     return redirect(url_for('index', _anchor='gallery'))
 
 
+@app.route('/selections')
+def list_selections():
+    """Returns the saved selection sets with their current match counts."""
+    db = get_db()
+    selections = db.get('selections', {})
+    return jsonify({
+        'status': 'success',
+        'selections': [
+            {
+                'name': name,
+                'ids': saved.get('ids', []),
+                'query': saved.get('query', {}),
+                'count': len(select_thumbnails(db, {'selection': name})),
+            }
+            for name, saved in sorted(selections.items())
+        ]
+    })
+
+@app.route('/selections/save', methods=['POST'])
+def save_selection():
+    """Saves a named selection from ad-hoc ids and/or field filters."""
+    name = request.form.get('name', '').strip()
+    if not name:
+        return jsonify({'status': 'error', 'message': 'A selection name is required.'}), 400
+
+    spec = parse_selection(request.form)
+    if not spec or (not spec['ids'] and not spec['query']):
+        return jsonify({'status': 'error', 'message': 'Select some thumbnails or enter a filter.'}), 400
+
+    with db_locked():
+        db = get_db()
+        # Only keep ids that point at existing thumbnails
+        known_ids = {item['id'] for item in db['thumbnails']}
+        db.setdefault('selections', {})[name] = {
+            'ids': [thumbnail_id for thumbnail_id in dict.fromkeys(spec['ids']) if thumbnail_id in known_ids],
+            'query': spec['query'],
+        }
+        write_db(db)
+        return jsonify({
+            'status': 'success',
+            'message': f'Selection "{name}" saved.',
+            'count': len(select_thumbnails(db, {'selection': name})),
+        })
+
+@app.route('/selections/delete/<name>', methods=['POST'])
+def delete_selection(name):
+    """Deletes a saved selection. The thumbnails themselves are untouched."""
+    with db_locked():
+        db = get_db()
+        if name not in db.get('selections', {}):
+            return jsonify({'status': 'error', 'message': 'Selection not found.'}), 404
+        del db['selections'][name]
+        write_db(db)
+        return jsonify({'status': 'success', 'message': f'Selection "{name}" deleted.'})
+
+
 @app.route('/bulk_swap', methods=['POST'])
+@admitted(BULK)
 def bulk_swap():
-    """Applies a single template to all existing thumbnails."""
+    """Applies a single template to the selected thumbnails (all with `all=1`)."""
     new_template = request.form.get('template')
     if not new_template:
         flash('No template selected for bulk swap.')
         return redirect(url_for('index'))
 
+    spec = parse_selection(request.form)
+    error = selection_error(spec)
+    if error:
+        flash(error)
+        return redirect(url_for('index'))
     db = get_db()
-    if not db['thumbnails']:
+    selected = select_thumbnails(db, spec)
+    if selected is None:
+        flash('Selection not found.')
+        return redirect(url_for('index'))
+    if not selected:
         flash('No thumbnails to apply changes to.')
         return redirect(url_for('index'))
 
-    template_path = os.path.join(app.config['TEMPLATE_FOLDER'], new_template)
-    with open(template_path, 'r') as f:
-        html_template_str = f.read()
-
-    for thumbnail in db['thumbnails']:
+    rendered_from = {thumbnail['id']: render_state(thumbnail) for thumbnail in selected}
+    for thumbnail in selected:
         thumbnail['template'] = new_template
-        rendered_html = render_template_string(html_template_str, **thumbnail['data'])
-        asyncio.run(create_thumbnail(rendered_html, thumbnail['filename']))
+    committed = render_batch_to_store(selected, rendered_from)
     
-    write_db(db)
-    flash(f'All thumbnails have been updated to the "{new_template}" design.')
+    flash(f'{len(committed)} thumbnail(s) from {describe_selection(spec)} have been updated to the "{new_template}" design.'
+          + skipped_note(len(selected) - len(committed)))
     return redirect(url_for('index', _anchor='gallery'))
 
 
 @app.route('/swap_template/<thumbnail_id>', methods=['POST'])
+@admitted(INTERACTIVE)
 def swap_template(thumbnail_id):
     """Swaps the template for a thumbnail and regenerates it."""
-    db = get_db()
-    thumbnail = next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
-    if not thumbnail:
-        flash('Thumbnail not found.')
-        return redirect(url_for('index'))
-
-    new_template = request.form.get('new_template')
-    if not new_template or not os.path.exists(os.path.join(app.config['TEMPLATE_FOLDER'], new_template)):
-        flash('Invalid template selected.')
+    edit, error = swap_edit(get_db(), thumbnail_id, request.form)
+    if error:
+        flash(error[0])
         return redirect(url_for('index'))
-
-    thumbnail['template'] = new_template
-
-    # Regenerate thumbnail
-    template_path = os.path.join(app.config['TEMPLATE_FOLDER'], new_template)
-    with open(template_path, 'r') as f:
-        html_template_str = f.read()
-    
-    rendered_html = render_template_string(html_template_str, **thumbnail['data'])
-    asyncio.run(create_thumbnail(rendered_html, thumbnail['filename']))
-
-    write_db(db)
-    # flash(f'Design swapped to {new_template} successfully!') # Flash messages are for redirects
-    # return redirect(url_for('index', highlight=thumbnail_id))
-    return jsonify({
-        'status': 'success',
-        'message': f'Design swapped to {new_template} successfully!',
-        'new_image_url': url_for('generated_file', filename=thumbnail['filename'], _external=True) + f'?v={uuid.uuid4()}' # Add cache-buster
-    })
+    return apply_edit(edit)
 
 
 @app.route('/bulk_edit_text', methods=['POST'])
+@admitted(BULK)
 def bulk_edit_text():
-    """Applies new text to all existing thumbnails."""
+    """Applies new text to the selected thumbnails (all with `all=1`)."""
     new_badge = request.form.get('badge')
     new_main_title_format = request.form.get('main_title')
     new_sub_title = request.form.get('sub_title')
@@ -786,12 +2461,22 @@ def bulk_edit_text():
         flash('No text entered for bulk edit.')
         return redirect(url_for('index'))
 
+    spec = parse_selection(request.form)
+    error = selection_error(spec)
+    if error:
+        flash(error)
+        return redirect(url_for('index'))
     db = get_db()
-    if not db['thumbnails']:
+    selected = select_thumbnails(db, spec)
+    if selected is None:
+        flash('Selection not found.')
+        return redirect(url_for('index'))
+    if not selected:
         flash('No thumbnails to apply changes to.')
         return redirect(url_for('index'))
 
-    for thumbnail in db['thumbnails']:
+    rendered_from = {thumbnail['id']: render_state(thumbnail) for thumbnail in selected}
+    for thumbnail in selected:
         if new_badge:
             thumbnail['data']['badge'] = new_badge
         
@@ -814,85 +2499,64 @@ def bulk_edit_text():
         if new_sub_title:
             thumbnail['data']['sub_title'] = new_sub_title
 
-        # Regenerate thumbnail
-        template_path = os.path.join(app.config['TEMPLATE_FOLDER'], thumbnail['template'])
-        with open(template_path, 'r') as f:
-            html_template_str = f.read()
-        
-        rendered_html = render_template_string(html_template_str, **thumbnail['data'])
-        asyncio.run(create_thumbnail(rendered_html, thumbnail['filename']))
+    # Regenerate thumbnails, one batch per template
+    committed = render_batch_to_store(selected, rendered_from)
     
-    write_db(db)
-    flash(f'All thumbnails have been updated with the new text.')
+    flash(f'{len(committed)} thumbnail(s) from {describe_selection(spec)} have been updated with the new text.'
+          + skipped_note(len(selected) - len(committed)))
     return redirect(url_for('index', _anchor='gallery'))
 
 
 @app.route('/spin_images', methods=['POST'])
+@admitted(BULK)
 def spin_images():
-    """Randomly assigns an image from the saved URLs to each thumbnail."""
+    """Randomly assigns an image from the saved URLs to each selected thumbnail."""
     db = get_db()
     image_urls = db.get('image_urls', [])
     if not image_urls:
         flash('No image URLs saved. Please add some in Settings.', 'error')
         return redirect(url_for('index'))
 
-    thumbnails = db.get('thumbnails', [])
+    spec = parse_selection(request.form)
+    error = selection_error(spec)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
+    thumbnails = select_thumbnails(db, spec)
+    if thumbnails is None:
+        return jsonify({'status': 'error', 'message': 'Selection not found.'}), 404
     if not thumbnails:
         flash('No thumbnails to apply images to.', 'error')
         return redirect(url_for('index'))
 
+    rendered_from = {thumbnail['id']: render_state(thumbnail) for thumbnail in thumbnails}
     for thumbnail in thumbnails:
         thumbnail['data']['image_url'] = random.choice(image_urls)
-        
-        template_path = os.path.join(app.config['TEMPLATE_FOLDER'], thumbnail['template'])
-        with open(template_path, 'r') as f:
-            html_template_str = f.read()
-        
-        rendered_html = render_template_string(html_template_str, **thumbnail['data'])
-        asyncio.run(create_thumbnail(rendered_html, thumbnail['filename']))
+    committed = render_batch_to_store(thumbnails, rendered_from)
 
-    write_db(db)
     # flash('All thumbnail images have been randomly updated!', 'success')
     # return redirect(url_for('index', _anchor='gallery'))
     return jsonify({
         'status': 'success',
-        'message': 'All thumbnail images have been randomly updated!'
+        'message': f'Images for {len(committed)} thumbnail(s) from {describe_selection(spec)} have been randomly updated!'
+                   + skipped_note(len(thumbnails) - len(committed)),
+        'updated_ids': [thumbnail['id'] for thumbnail in committed]
     })
 
 @app.route('/spin_thumbnail/<thumbnail_id>', methods=['POST'])
+@admitted(INTERACTIVE)
 def spin_thumbnail(thumbnail_id):
     """Randomly assigns an image from the saved URLs to a specific thumbnail."""
-    db = get_db()
-    image_urls = db.get('image_urls', [])
-    if not image_urls:
-        return jsonify({'status': 'error', 'message': 'No image URLs saved. Please add some in Settings.'}), 400
-
-    thumbnail = next((item for item in db['thumbnails'] if item['id'] == thumbnail_id), None)
-    if not thumbnail:
-        return jsonify({'status': 'error', 'message': 'Thumbnail not found.'}), 404
-
-    try:
-        thumbnail['data']['image_url'] = random.choice(image_urls)
-        
-        template_path = os.path.join(app.config['TEMPLATE_FOLDER'], thumbnail['template'])
-        with open(template_path, 'r') as f:
-            html_template_str = f.read()
-        
-        rendered_html = render_template_string(html_template_str, **thumbnail['data'])
-        asyncio.run(create_thumbnail(rendered_html, thumbnail['filename']))
-
-        write_db(db)
-        return jsonify({
-            'status': 'success',
-            'message': 'Thumbnail image randomly updated!',
-            'new_image_url': url_for('generated_file', filename=thumbnail['filename'], _external=True) + f'?v={uuid.uuid4()}' # Add cache-buster
-        })
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': f'An error occurred: {e}'}), 500
+    edit, error = spin_edit(get_db(), thumbnail_id)
+    if error:
+        message, status = error
+        return jsonify({'status': 'error', 'message': message}), status
+    return apply_edit(edit)
 
 
 if __name__ == '__main__':
     init_db()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true': # The reloader's serving process
+        start_warm_up()
     app.run(debug=True, host='0.0.0.0', port=8080)
 
 
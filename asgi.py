@@ -0,0 +1,398 @@
+"""ASGI entry point: async render and publish endpoints in front of the Flask app.
+
+Run with `uvicorn asgi:app` (or gunicorn's UvicornWorker). The render and
+publish routes below await the shared renderer and an HTTP client directly,
+so one process can serve many of them at once. Every other path is handed to
+the existing Flask `app`, whose blocking renders are routed onto this same
+event loop and renderer.
+"""
+import io
+import os
+import asyncio
+import contextlib
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse
+from starlette.routing import Match, Mount, Route
+
+from admission import INTERACTIVE, AdmissionRejected
+from app import (
+    app as flask_app,
+    CHANGED_MEANWHILE,
+    VIDEO_EXTENSIONS,
+    admission,
+    commit_outputs,
+    custom_media_path,
+    edit_reply,
+    feed_post_params,
+    get_db,
+    image_store,
+    image_upload_path,
+    init_db,
+    profiler,
+    publish_edit,
+    publish_image,
+    publish_pipelines,
+    publish_request,
+    publish_summary,
+    published_message,
+    render_loop,
+    render_outputs,
+    render_row,
+    renderer,
+    spin_edit,
+    start_warm_up,
+    stored_media,
+    swap_edit,
+    update_edit,
+)
+from renderer import render_label
+
+http_state = {'client': None}
+background_tasks = set()
+
+# Uploads are copied to disk this much at a time
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def flask_url_for(request, endpoint, external=False, **values):
+    """Builds a URL for a Flask endpoint from inside an ASGI handler."""
+    adapter = flask_app.url_map.bind(request.url.netloc, url_scheme=request.url.scheme)
+    return adapter.build(endpoint, values, force_external=external)
+
+
+def render_html(template_name, data):
+    """Renders a thumbnail template with row data, in the Flask app's context."""
+    with flask_app.app_context():
+        return render_row(template_name, data)
+
+
+def render_busy(e):
+    """Turns away a render request with a Retry-After instead of queueing it."""
+    message = f'The renderer is busy ({e.reason}). Please try again in {e.retry_after} seconds.'
+    return JSONResponse({'status': 'error', 'message': message}, status_code=429,
+                        headers={'Retry-After': str(e.retry_after)})
+
+
+def graph_url():
+    return flask_app.config['GRAPH_API_URL']
+
+
+async def save_upload(upload, path):
+    """Copies an uploaded file to `path` a chunk at a time, off the event loop."""
+    f = await asyncio.to_thread(open, path, 'wb')
+    try:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await asyncio.to_thread(f.write, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def render_on_loop(request, template_name, data):
+    """Renders a row on the shared renderer; returns the main PNG bytes and variant outputs."""
+    render_label.set(template_name) # Attributes limit violations; scoped to this request's task
+    rendered_html = await asyncio.to_thread(render_html, template_name, data)
+    async with admission.admit_async(request.client.host, INTERACTIVE):
+        return await render_outputs(rendered_html, str(request.base_url))
+
+
+async def apply_edit(request, edit):
+    """Renders and commits an edit worked out by the app and returns the JSON response."""
+    try:
+        outputs = await render_on_loop(request, edit['template'], edit['data'])
+        thumbnail = await asyncio.to_thread(commit_outputs, edit['thumbnail'], outputs, edit['data'], edit['template'])
+    except AdmissionRejected as e:
+        return render_busy(e)
+    except Exception as e:
+        return JSONResponse({'status': 'error', 'message': f'An error occurred: {e}'}, status_code=500)
+    if not thumbnail:
+        return JSONResponse({'status': 'error', 'message': CHANGED_MEANWHILE}, status_code=409)
+    image_url = flask_url_for(request, 'generated_file', external=True, filename=thumbnail['filename'])
+    return JSONResponse(edit_reply(edit, image_url))
+
+
+def edit_error(error):
+    message, status = error
+    return JSONResponse({'status': 'error', 'message': message}, status_code=status)
+
+
+async def swap_template(request):
+    """Swaps the template for a thumbnail and regenerates it."""
+    form = await request.form()
+    db = await asyncio.to_thread(get_db)
+    edit, error = swap_edit(db, request.path_params['thumbnail_id'], form)
+    if error:
+        return edit_error(error)
+    return await apply_edit(request, edit)
+
+
+async def spin_thumbnail(request):
+    """Randomly assigns an image from the saved URLs to a specific thumbnail."""
+    db = await asyncio.to_thread(get_db)
+    edit, error = spin_edit(db, request.path_params['thumbnail_id'])
+    if error:
+        return edit_error(error)
+    return await apply_edit(request, edit)
+
+
+async def update_thumbnail(request):
+    """Updates a thumbnail's data and regenerates the image."""
+    thumbnail_id = request.path_params['thumbnail_id']
+    form = await request.form()
+    db = await asyncio.to_thread(get_db)
+    edit, error = update_edit(db, thumbnail_id, form)
+    if error:
+        return edit_error(error)
+
+    # Handle image upload
+    image_file = form.get('image_file')
+    upload = isinstance(image_file, UploadFile) and image_upload_path(thumbnail_id, image_file.filename)
+    if upload:
+        image_filename, image_path = upload
+        await save_upload(image_file, image_path)
+        # Update the image_url to point to the local file
+        edit['data']['image_url'] = flask_url_for(request, 'uploaded_image', filename=image_filename)
+    return await apply_edit(request, edit)
+
+
+def graph_error(response, default):
+    try:
+        return response.json().get('error', {}).get('message', default)
+    except ValueError:
+        return default
+
+
+async def graph_request(client, page_id, method, url, **kwargs):
+    """Makes a Graph API call for a page and records its usage and throttling."""
+    response = await client.request(method, url, **kwargs)
+    publish_pipelines.record(page_id, response)
+    return response
+
+
+async def get_page_access_token(client, user_token, page_id):
+    """Exchange user token for page token."""
+    try:
+        r = await graph_request(client, page_id, 'GET', f"{graph_url()}/v19.0/{page_id}",
+                                params={"fields": "access_token", "access_token": user_token})
+        r.raise_for_status()
+        data = r.json()
+    except httpx.HTTPError as e:
+        return None, str(e)
+    if "access_token" in data:
+        return data["access_token"], None
+    return None, data.get("error", {}).get("message", "Failed to get page access token.")
+
+
+async def publish_media(client, page_id, page_access_token, media_name, open_media, form):
+    """Uploads media to a page and posts it, returning (message, error)."""
+    _, ext = os.path.splitext(media_name.lower())
+    is_video = ext in VIDEO_EXTENSIONS
+
+    # Step 1: Upload the media to get an ID.
+    endpoint = 'videos' if is_video else 'photos'
+    media_file = await asyncio.to_thread(open_media)
+    try:
+        upload_response = await graph_request(
+            client, page_id, 'POST', f"{graph_url()}/{page_id}/{endpoint}",
+            data={'access_token': page_access_token, 'published': 'false'},
+            files={'source': (media_name, media_file)},
+            timeout=600 if is_video else 60, # 10 minute timeout for videos
+        )
+    finally:
+        media_file.close()
+    upload_response_data = upload_response.json()
+    if upload_response.status_code != 200 or 'id' not in upload_response_data:
+        return None, graph_error(upload_response, 'Failed to upload media to Facebook.')
+    media_id = upload_response_data['id']
+
+    # Step 2: Create the post on the page's feed using the media ID.
+    post_params, error = feed_post_params(page_access_token, media_id, form)
+    if error:
+        return None, error
+
+    response = await graph_request(client, page_id, 'POST', f"{graph_url()}/{page_id}/feed", params=post_params)
+    response_data = response.json()
+    if response.status_code != 200 or 'id' not in response_data:
+        return None, f"Failed to publish/schedule post: {graph_error(response, 'Unknown Facebook API error.')}"
+
+    post_id = response_data['id']
+    first_comment = form.get('first_comment', '')
+    if first_comment:
+        await graph_request(client, page_id, 'POST', f"{graph_url()}/{post_id}/comments",
+                            params={'access_token': page_access_token, 'message': first_comment})
+
+    return published_message(post_id, form), None
+
+
+async def page_access_token(client, target):
+    """Returns (page token, error) for a publish target, reusing a cached token."""
+    page_id, user_token = target['page_id'], target['user_token']
+    token = publish_pipelines.cached_token(page_id, user_token)
+    if token:
+        return token, None
+    token, error = await get_page_access_token(client, user_token, page_id)
+    if error:
+        return None, f'Facebook Auth Error: {error}'
+    publish_pipelines.store_token(page_id, user_token, token)
+    return token, None
+
+
+async def publish_to_page(client, target, media_name, open_media, form):
+    """Publishes one post to one page, in one of that page's upload slots."""
+    async with publish_pipelines.slot(target['page_id']) as done:
+        message, error = None, None
+        wait = publish_pipelines.blocked_for(target['page_id'])
+        if wait:
+            error = f'Facebook is rate limiting this page. Please try again in {wait} seconds.'
+        else:
+            token, error = await page_access_token(client, target)
+        if not error:
+            try:
+                message, error = await publish_media(client, target['page_id'], token, media_name, open_media, form)
+            except Exception as e:
+                error = f'An unexpected error occurred: {e}'
+        done(error)
+        return message, error
+
+
+async def publish_to_pages(client, targets, media_name, open_media, form):
+    """Publishes to every target page at once; each upload opens its own handle with `open_media`."""
+    results = await asyncio.gather(*(publish_to_page(client, target, media_name, open_media, form) for target in targets))
+    return JSONResponse(publish_summary(targets, results))
+
+
+def read_stored(media_name):
+    with image_store.open(media_name) as f:
+        return f.read()
+
+
+async def publish_facebook_post(request):
+    """Handles publishing or scheduling a Facebook post, with optional custom media."""
+    thumbnail_id = request.path_params['thumbnail_id']
+    client = http_state['client']
+    db = await asyncio.to_thread(get_db)
+    form = await request.form()
+    targets, thumbnail, error = publish_request(db, thumbnail_id, form)
+    if error:
+        return JSONResponse({'status': 'error', 'message': error})
+
+    media_path = None
+    try:
+        # Custom uploads are copied to disk, not read into memory, and removed once posted
+        custom_file = form.get('custom_media')
+        if isinstance(custom_file, UploadFile) and custom_file.filename:
+            media_name, media_path = custom_media_path(custom_file.filename)
+            await save_upload(custom_file, media_path)
+            open_media = lambda: open(media_path, 'rb')
+        else:
+            media_name, error = await asyncio.to_thread(stored_media, thumbnail, form)
+            if error:
+                return JSONResponse({'status': 'error', 'message': error})
+            media_bytes = await asyncio.to_thread(read_stored, media_name)
+            open_media = lambda: io.BytesIO(media_bytes)
+
+        return await publish_to_pages(client, targets, media_name, open_media, form)
+    except Exception as e:
+        return JSONResponse({'status': 'error', 'message': f'An unexpected error occurred: {e}'})
+    finally:
+        if media_path and os.path.exists(media_path):
+            os.remove(media_path)
+
+
+def track_task(coro):
+    """Starts a background task and keeps a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def render_and_publish(request):
+    """Renders edited thumbnail data to memory and publishes it in one request.
+
+    Page tokens are fetched while the screenshot is taken, the image bytes
+    go straight into the upload body, and the stored copy and record update
+    are written in the background. An edit saved since the request read the
+    record wins; the render is dropped.
+    """
+    thumbnail_id = request.path_params['thumbnail_id']
+    client = http_state['client']
+    db = await asyncio.to_thread(get_db)
+    form = await request.form()
+    targets, thumbnail, error = publish_request(db, thumbnail_id, form)
+    if not error:
+        data, template_name, error = publish_edit(thumbnail, form)
+    if error:
+        return JSONResponse({'status': 'error', 'message': error})
+
+    try:
+        outputs, *_ = await asyncio.gather(render_on_loop(request, template_name, data),
+                                           *(page_access_token(client, target) for target in targets))
+        track_task(asyncio.to_thread(commit_outputs, thumbnail, outputs, data, template_name))
+        media_name, media_bytes = await asyncio.to_thread(publish_image, outputs[0], data)
+        return await publish_to_pages(client, targets, media_name, lambda: io.BytesIO(media_bytes), form)
+    except AdmissionRejected as e:
+        return render_busy(e)
+    except Exception as e:
+        return JSONResponse({'status': 'error', 'message': f'An unexpected error occurred: {e}'})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_):
+    # Blocking Flask renders run on this loop too, so there is one renderer per process
+    render_loop.attach(asyncio.get_running_loop())
+    http_state['client'] = httpx.AsyncClient(timeout=60)
+    await asyncio.to_thread(init_db)
+    # Warm renders run on this loop, so wait off it
+    await asyncio.to_thread(start_warm_up, flask_app.config['WARMUP_WAIT_SECONDS'])
+    try:
+        yield
+    finally:
+        # Let renders that were published but not yet filed reach the store
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        await http_state['client'].aclose()
+        await renderer.stop()
+
+
+class ProfileRequests:
+    """Lets a running profiling session time and sample the async routes.
+
+    Routes are tracked under their name, which matches the Flask endpoint for
+    the same path; requests handed on to Flask are tracked by its own
+    before_request hook.
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = [route for route in routes if isinstance(route, Route)]
+
+    async def __call__(self, scope, receive, send):
+        token = None
+        if scope['type'] == 'http' and profiler.session is not None:
+            name = next((route.name for route in self.routes if route.matches(scope)[0] == Match.FULL), None)
+            token = name and profiler.track(name)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.untrack(token)
+
+
+routes = [
+    Route('/swap_template/{thumbnail_id}', swap_template, methods=['POST']),
+    Route('/spin_thumbnail/{thumbnail_id}', spin_thumbnail, methods=['POST']),
+    Route('/update/{thumbnail_id}', update_thumbnail, methods=['POST']),
+    Route('/publish_facebook_post/{thumbnail_id}', publish_facebook_post, methods=['POST']),
+    Route('/render_and_publish/{thumbnail_id}', render_and_publish, methods=['POST']),
+    Mount('/', app=WSGIMiddleware(flask_app)),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(ProfileRequests, routes=routes)],
+    lifespan=lifespan,
+)
@@ -0,0 +1,11 @@
+# Gunicorn reads this file from the working directory on startup.
+
+def post_worker_init(worker):
+    """Warms each worker up before it takes requests, within the worker timeout.
+
+    Whatever isn't done by then carries on in the background; /ready
+    reports when it finishes.
+    """
+    from app import app, init_db, start_warm_up
+    init_db()
+    start_warm_up(min(app.config['WARMUP_WAIT_SECONDS'], worker.cfg.timeout / 2))
@@ -0,0 +1,419 @@
+import io
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import itertools
+import collections
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from PIL import Image
+
+# Drives a realistic mix of render and publish traffic at a scratch copy of
+# the app, with Facebook and remote image hosts replaced by local servers,
+# and reports throughput, tail latency and error rates per endpoint.
+# Usage: python load_test.py [--duration 60] [--clients 8] [--asgi] ...
+# Renders use the real Playwright renderer, so Chromium must be installed.
+# Every client comes from 127.0.0.1, so render admission treats them as one
+# user; 429s are reported as "busy", separately from errors.
+
+ENDPOINTS = ('upload_csv', 'swap_template', 'spin_thumbnail', 'publish_facebook_post')
+DEFAULT_MIX = 'upload_csv=1,swap_template=4,spin_thumbnail=3,publish_facebook_post=2'
+
+
+def jittered(ms):
+    """A delay around `ms` milliseconds, in seconds, spread like real network latency."""
+    return max(0.0, random.lognormvariate(0, 0.5) * ms / 1000) if ms else 0.0
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class FakeGraphServer(ThreadingHTTPServer):
+    """Answers the Graph API calls the app makes: page token exchange, photo and
+    video uploads, feed posts and first comments.
+
+    Each call waits a jittered `latency_ms` (uploads `upload_latency_ms`).
+    Calls over `rps` per second to one page, and a random `error_rate` share
+    of the rest, get the error Facebook sends for a throttled page, with the
+    usage headers its real responses carry.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency_ms=120, upload_latency_ms=400, rps=None, error_rate=0.0):
+        super().__init__(('127.0.0.1', 0), FakeGraphHandler)
+        self.latency_ms = latency_ms
+        self.upload_latency_ms = upload_latency_ms
+        self.rps = rps
+        self.error_rate = error_rate
+        self.ids = itertools.count(10**15)
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        self._lock = threading.Lock()
+        self._windows = {} # page id -> (second, calls to it in that second)
+
+    def admit(self, kind, page_id):
+        """Counts a call; returns (allowed, calls to the page this second)."""
+        with self._lock:
+            self.calls[kind] += 1
+            second = int(time.monotonic())
+            window = self._windows.get(page_id, (0, 0))
+            count = window[1] + 1 if window[0] == second else 1
+            self._windows[page_id] = (second, count)
+            limited = (self.rps and count > self.rps) or random.random() < self.error_rate
+            if limited:
+                self.throttled[page_id] += 1
+            return not limited, count
+
+    def next_id(self):
+        with self._lock:
+            return str(next(self.ids))
+
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, usage=0):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('X-App-Usage', json.dumps({'call_count': 1, 'total_cputime': 1, 'total_time': 1}))
+        self.send_header('X-Page-Usage', json.dumps({'call_count': usage, 'total_cputime': 1, 'total_time': 1}))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def error(self, status, code, message):
+        self.reply(status, {'error': {'message': message, 'type': 'OAuthException', 'code': code}}, usage=100)
+
+    def handle_call(self):
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update({k: v[0] for k, v in parse_qs(body.decode('utf-8', 'replace')).items()})
+        parts = [p for p in url.path.split('/') if p]
+
+        if self.command == 'GET' and len(parts) == 2 and parts[0].startswith('v'):
+            kind, page_id = 'token', parts[1]
+        elif self.command == 'POST' and len(parts) == 2 and parts[1] in ('photos', 'videos', 'feed', 'comments'):
+            # Post ids are <page id>_<post number>
+            kind, page_id = parts[1], parts[0].split('_')[0]
+        else:
+            return self.error(404, 803, f'Unknown path components: {url.path}')
+
+        server = self.server
+        time.sleep(jittered(server.upload_latency_ms if kind in ('photos', 'videos') else server.latency_ms))
+        allowed, count = server.admit(kind, page_id)
+        if not allowed:
+            return self.error(400, 32, 'Page request limit reached')
+        # Uploads send the token in the multipart body, which isn't parsed here
+        if not params.get('access_token') and kind not in ('photos', 'videos'):
+            return self.error(400, 190, 'An active access token must be used.')
+
+        usage = min(100, round(100 * count / server.rps)) if server.rps else 1
+        if kind == 'token':
+            self.reply(200, {'access_token': f'page-token-{page_id}', 'id': page_id}, usage)
+        elif kind == 'feed':
+            self.reply(200, {'id': f'{page_id}_{server.next_id()}'}, usage)
+        else:
+            self.reply(200, {'id': server.next_id()}, usage)
+
+    do_GET = handle_call
+    do_POST = handle_call
+
+
+class AssetServer(ThreadingHTTPServer):
+    """Serves `count` distinct PNG images at /images/<n>.png after a jittered `latency_ms`."""
+    daemon_threads = True
+
+    def __init__(self, count=16, size=400, latency_ms=60):
+        super().__init__(('127.0.0.1', 0), AssetHandler)
+        self.latency_ms = latency_ms
+        self.requests = 0
+        self.images = {}
+        for n in range(count):
+            out = io.BytesIO()
+            Image.new('RGB', (size, size), ((n * 67) % 256, (n * 131) % 256, (n * 29) % 256)).save(out, 'PNG')
+            self.images[f'/images/{n}.png'] = out.getvalue()
+
+    def urls(self, base):
+        return [base + path for path in self.images]
+
+
+class AssetHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(jittered(self.server.latency_ms))
+        image = self.server.images.get(urlsplit(self.path).path)
+        if image is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(image)))
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(image)
+
+
+def start_app(workdir, graph_url, use_asgi):
+    """Imports the app inside `workdir` and serves it on a free local port."""
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnail_templates'),
+                    os.path.join(workdir, 'thumbnail_templates'))
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as flask_module
+    flask_module.init_db()
+    for folder in ('UPLOAD_FOLDER', 'GENERATED_FOLDER', 'IMAGE_UPLOAD_FOLDER'):
+        os.makedirs(flask_module.app.config[folder], exist_ok=True)
+    flask_module.app.config['GRAPH_API_URL'] = graph_url
+
+    if use_asgi:
+        import socket
+        import uvicorn
+        import asgi
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=port, log_level='warning'))
+        threading.Thread(target=server.run, name='uvicorn', daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        return f"http://127.0.0.1:{port}", flask_module
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, flask_module.app, threaded=True, request_handler=QuietHandler)
+    flask_module.start_warm_up(wait=300) # Measure steady state, not the first renders
+    return serve(server), flask_module
+
+
+class LoadTest:
+    """Runs `clients` concurrent sessions against `base_url`, each picking
+    endpoints by `mix` weight until the deadline, and records every call."""
+
+    def __init__(self, base_url, image_urls, templates, mix, csv_rows=5, pages=1):
+        self.base_url = base_url
+        self.page_ids = [str(1000000001 + n) for n in range(pages)]
+        self.image_urls = image_urls
+        self.templates = templates
+        self.mix = mix
+        self.csv_rows = csv_rows
+        self.thumbnail_ids = []
+        self.results = collections.defaultdict(list) # endpoint -> [(seconds, outcome)]
+        self.csv_rows_sent = 0
+        self._lock = threading.Lock()
+
+    def csv_file(self, rows):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=['badge', 'main_title', 'sub_title', 'image_url'])
+        writer.writeheader()
+        for n in range(rows):
+            writer.writerow({
+                'badge': f'Part {n + 1}',
+                'main_title': f"Load <span class='highlight'>TEST</span> #{random.randrange(10**6)}",
+                'sub_title': random.choice(['The Ultimate Guide', 'From Scratch in 2025', 'Beginner to Pro']),
+                'image_url': random.choice(self.image_urls),
+            })
+        return out.getvalue().encode()
+
+    def seed(self, rows):
+        """Sets credentials and image URLs, and creates the thumbnails the other endpoints act on."""
+        session = requests.Session()
+        session.post(f'{self.base_url}/save_settings', allow_redirects=False, data={
+            'account_name': 'Load test', 'facebook_access_token': 'load-test-user-token',
+            'facebook_page_id': '\n'.join(f'{page_id} Load Page {n + 1}' for n, page_id in enumerate(self.page_ids)),
+        }).raise_for_status()
+        session.post(f'{self.base_url}/save_image_urls', allow_redirects=False,
+                     data={'image_urls': '\n'.join(self.image_urls)}).raise_for_status()
+        session.post(f'{self.base_url}/upload_csv', allow_redirects=False,
+                     files={'file': ('seed.csv', self.csv_file(rows))},
+                     data={'template': self.templates[0]}).raise_for_status()
+        results = session.get(f'{self.base_url}/search', params={'per_page': 100}).json()['results']
+        self.thumbnail_ids = [record['id'] for record in results]
+        if not self.thumbnail_ids:
+            raise RuntimeError('Seeding created no thumbnails; check that the renderer can start.')
+
+    def call(self, session, endpoint):
+        url = f'{self.base_url}/{endpoint}'
+        if endpoint == 'upload_csv':
+            with self._lock:
+                self.csv_rows_sent += self.csv_rows
+            return session.post(url, allow_redirects=False,
+                                files={'file': ('load.csv', self.csv_file(self.csv_rows))},
+                                data={'template': random.choice(self.templates)})
+        url += f'/{random.choice(self.thumbnail_ids)}'
+        if endpoint == 'swap_template':
+            return session.post(url, data={'new_template': random.choice(self.templates)})
+        if endpoint == 'spin_thumbnail':
+            return session.post(url)
+        return session.post(url, data={
+            'caption': 'Load test post', 'first_comment': 'First!', 'schedule_option': 'now',
+            'page_ids': random.sample(self.page_ids, random.randint(1, len(self.page_ids))),
+        })
+
+    def outcome(self, response):
+        if response.status_code == 429:
+            return 'busy'
+        if response.status_code >= 400:
+            return 'error'
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            return 'error' if response.json().get('status') == 'error' else 'ok'
+        # upload_csv redirects either way; created thumbnails are checked after the run
+        return 'ok'
+
+    def client(self, deadline):
+        session = requests.Session()
+        endpoints, weights = zip(*self.mix.items())
+        while time.monotonic() < deadline:
+            endpoint = random.choices(endpoints, weights)[0]
+            start = time.perf_counter()
+            try:
+                outcome = self.outcome(self.call(session, endpoint))
+            except requests.RequestException:
+                outcome = 'error'
+            with self._lock:
+                self.results[endpoint].append((time.perf_counter() - start, outcome))
+
+    def run(self, clients, seconds):
+        deadline = time.monotonic() + seconds
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(clients) as pool:
+            for future in [pool.submit(self.client, deadline) for _ in range(clients)]:
+                future.result()
+        return time.perf_counter() - started
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))]
+
+
+def summarize(results, elapsed):
+    """Returns per-endpoint counts, throughput and latency percentiles (ms)."""
+    report = {}
+    for endpoint, calls in sorted(results.items()):
+        outcomes = collections.Counter(outcome for _, outcome in calls)
+        latencies = sorted(seconds * 1000 for seconds, outcome in calls if outcome != 'busy')
+        report[endpoint] = {
+            'requests': len(calls),
+            'ok': outcomes['ok'],
+            'busy': outcomes['busy'],
+            'errors': outcomes['error'],
+            'error_rate': outcomes['error'] / len(calls),
+            'throughput': len(calls) / elapsed,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': latencies[-1] if latencies else 0.0,
+        }
+    return report
+
+
+def print_report(report, elapsed, extra):
+    print(f"\n{'endpoint':<24}{'reqs':>7}{'req/s':>8}{'ok':>7}{'busy':>6}{'err':>6}{'err%':>7}"
+          f"{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}")
+    for endpoint, row in report.items():
+        print(f"{endpoint:<24}{row['requests']:>7}{row['throughput']:>8.2f}{row['ok']:>7}{row['busy']:>6}"
+              f"{row['errors']:>6}{row['error_rate'] * 100:>6.1f}%{row['p50_ms']:>8.0f}{row['p95_ms']:>8.0f}"
+              f"{row['p99_ms']:>8.0f}{row['max_ms']:>8.0f}")
+    print(f"\n{elapsed:.1f}s run; latencies in ms, excluding busy (429) responses")
+    for label, value in extra.items():
+        print(f"{label}: {value}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        endpoint, _, weight = part.partition('=')
+        if endpoint.strip() not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint '{endpoint}'; choose from {', '.join(ENDPOINTS)}")
+        mix[endpoint.strip()] = float(weight or 1)
+    return {endpoint: weight for endpoint, weight in mix.items() if weight > 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the app against a local fake Graph API and asset server.')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of load after seeding')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client sessions')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'endpoint weights (default {DEFAULT_MIX})')
+    parser.add_argument('--csv-rows', type=int, default=5, help='rows per uploaded CSV')
+    parser.add_argument('--seed-rows', type=int, default=20, help='thumbnails created before the run')
+    parser.add_argument('--graph-latency-ms', type=float, default=120)
+    parser.add_argument('--graph-upload-latency-ms', type=float, default=400)
+    parser.add_argument('--pages', type=int, default=3, help='Facebook pages to publish to; each post picks some of them')
+    parser.add_argument('--graph-rps', type=int, default=None, help='Graph calls per second to one page before rate-limit errors')
+    parser.add_argument('--graph-error-rate', type=float, default=0.0, help='share of Graph calls failing as rate limited')
+    parser.add_argument('--asset-latency-ms', type=float, default=60)
+    parser.add_argument('--asgi', action='store_true', help='serve asgi:app with uvicorn instead of the Flask app')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+
+    graph = FakeGraphServer(args.graph_latency_ms, args.graph_upload_latency_ms, args.graph_rps, args.graph_error_rate)
+    assets = AssetServer(latency_ms=args.asset_latency_ms)
+    graph_url = serve(graph)
+    image_urls = assets.urls(serve(assets))
+
+    workdir = tempfile.mkdtemp(prefix='thumbnail-load-')
+    output = os.path.abspath(args.json) if args.json else None
+    try:
+        base_url, flask_module = start_app(workdir, graph_url, args.asgi)
+        templates = sorted(f for f in os.listdir(flask_module.app.config['TEMPLATE_FOLDER']) if f.endswith('.html'))
+        test = LoadTest(base_url, image_urls, templates, args.mix, csv_rows=args.csv_rows, pages=args.pages)
+        print(f"Seeding {args.seed_rows} thumbnails at {base_url} ...")
+        test.seed(args.seed_rows)
+        before = len(flask_module.get_db()['thumbnails'])
+
+        print(f"Running {args.clients} clients for {args.duration:.0f}s ...")
+        elapsed = test.run(args.clients, args.duration)
+        report = summarize(test.results, elapsed)
+        created = len(flask_module.get_db()['thumbnails']) - before
+        extra = {
+            'CSV rows uploaded / thumbnails created': f'{test.csv_rows_sent} / {created}',
+            'Graph API calls': dict(graph.calls),
+            'Graph API rate-limited, by page': dict(graph.throttled),
+            'Publish pipelines': flask_module.publish_pipelines.status(),
+            'Asset requests': assets.requests,
+            'Render admission': flask_module.admission.status(),
+        }
+        print_report(report, elapsed, extra)
+        if output:
+            with open(output, 'w') as f:
+                json.dump({'seconds': elapsed, 'endpoints': report, **extra}, f, indent=2)
+    finally:
+        graph.shutdown()
+        assets.shutdown()
+        if args.keep:
+            print(f"Scratch directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import threading
+import collections
+
+MAX_TIMELINE_EVENTS = 100000
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def stack_of(frame):
+    """Returns a frame's call stack as names, outermost first."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class ProfileSession:
+    """One profiling window: stack samples and timeline events for one target."""
+
+    def __init__(self, target, seconds, interval_ms):
+        self.target = target
+        self.seconds = seconds
+        self.interval = interval_ms / 1000
+        self.started = time.time()
+        self.started_perf = time.perf_counter()
+        self.deadline = self.started_perf + seconds
+        self.threads = {} # thread ident -> label of the request or job it is running
+        self.depth = collections.Counter() # thread ident -> tracked requests it is running; async ones share a thread
+        self.samples = collections.Counter()
+        self.lock = threading.Lock() # Guards samples and threads against the sampler
+        self.events = []
+        self.thread_names = {}
+        self.loop_thread = None
+        self.previous_factory = None
+        self.stopped = threading.Event()
+
+    def timestamp(self, perf=None):
+        """Microseconds since the session started, as trace events use."""
+        return round(((perf or time.perf_counter()) - self.started_perf) * 1e6)
+
+    def sample_count(self):
+        with self.lock:
+            return sum(self.samples.values())
+
+    def add_event(self, event):
+        if len(self.events) < MAX_TIMELINE_EVENTS:
+            self.events.append(event)
+
+
+class Profiler:
+    """Samples the Python stacks of one route or background job for a time window.
+
+    While a session is running, threads handling the target register
+    themselves with `track`, and a sampler thread records their stacks
+    every `interval_ms`, along with the render loop's thread while any of
+    them is active. Tasks on the render loop are timed through a task
+    factory. When the window ends, two files are written to `folder`:
+    collapsed stacks (`.folded`, for flamegraph.pl or speedscope) and a
+    Chrome trace (`.trace.json`, for Perfetto or chrome://tracing) with
+    request, job and task spans.
+
+    With no session running, `track` is a single attribute check.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.session = None
+        self.last_result = None
+        self._lock = threading.Lock()
+
+    def start(self, target, seconds=30, interval_ms=5, loop=None):
+        """Starts a session, or returns None if one is already running."""
+        with self._lock:
+            if self.session is not None:
+                return None
+            session = ProfileSession(target, seconds, interval_ms)
+            self.session = session
+        if loop is not None:
+            loop.call_soon_threadsafe(self._instrument_loop, session, loop)
+        threading.Thread(target=self._sample, args=(session, loop), name='profiler', daemon=True).start()
+        return session
+
+    def stop(self):
+        """Ends the running session early; its results are still written."""
+        session = self.session
+        if session is not None:
+            session.stopped.set()
+        return session
+
+    def track(self, target, label=None):
+        """Registers the current thread as running `target`, if a session wants it.
+
+        Returns a token for `untrack`, or None when nothing is being profiled.
+        """
+        session = self.session
+        if session is None or session.target not in ('*', target):
+            return None
+        ident = threading.get_ident()
+        with session.lock:
+            session.threads[ident] = label or target
+            session.depth[ident] += 1
+        session.thread_names.setdefault(ident, threading.current_thread().name)
+        return (session, ident, time.perf_counter(), label or target)
+
+    def untrack(self, token):
+        if token is None:
+            return
+        session, ident, start, label = token
+        with session.lock:
+            session.depth[ident] -= 1
+            if session.depth[ident] <= 0:
+                del session.depth[ident]
+                session.threads.pop(ident, None)
+        session.add_event({
+            'name': label, 'cat': 'request', 'ph': 'X', 'pid': os.getpid(), 'tid': ident,
+            'ts': session.timestamp(start), 'dur': session.timestamp() - session.timestamp(start),
+        })
+
+    def _instrument_loop(self, session, loop):
+        """Runs on the render loop: times every task started there during the session."""
+        session.loop_thread = threading.get_ident()
+        session.thread_names[session.loop_thread] = 'render-loop'
+        previous = session.previous_factory = loop.get_task_factory()
+
+        def factory(loop, coro, **kwargs):
+            task = previous(loop, coro, **kwargs) if previous else asyncio.Task(coro, loop=loop, **kwargs)
+            start = time.perf_counter()
+
+            def done(task):
+                name = task.get_name()
+                coro_name = getattr(task.get_coro(), '__qualname__', '')
+                session.add_event({
+                    'name': f"{name} {coro_name}".strip(), 'cat': 'task', 'ph': 'X', 'pid': os.getpid(),
+                    'tid': session.loop_thread, 'ts': session.timestamp(start),
+                    'dur': session.timestamp() - session.timestamp(start),
+                })
+            task.add_done_callback(done)
+            return task
+
+        loop.set_task_factory(factory)
+
+    def _sample(self, session, loop):
+        while not session.stopped.is_set() and time.perf_counter() < session.deadline:
+            with session.lock:
+                threads = dict(session.threads)
+            if threads:
+                frames = sys._current_frames()
+                if session.loop_thread is not None:
+                    threads.setdefault(session.loop_thread, 'render-loop')
+                stacks = [(label, *stack_of(frames[ident])) for ident, label in threads.items() if ident in frames]
+                with session.lock:
+                    session.samples.update(stacks)
+            session.stopped.wait(session.interval)
+        session.stopped.set()
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.set_task_factory, session.previous_factory)
+        try:
+            self.last_result = self._write(session)
+        finally:
+            with self._lock:
+                self.session = None
+
+    def _write(self, session):
+        os.makedirs(self.folder, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(session.started))
+        base = f"profile-{stamp}-{re.sub(r'[^A-Za-z0-9_-]', '_', session.target)}"
+        folded = f"{base}.folded"
+        with open(os.path.join(self.folder, folded), 'w') as f:
+            for stack, count in session.samples.most_common():
+                # Frame names may contain spaces but never ';', the folded separator
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        trace = f"{base}.trace.json"
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}}
+            for ident, name in session.thread_names.items()
+        ]
+        with open(os.path.join(self.folder, trace), 'w') as f:
+            json.dump({'traceEvents': metadata + session.events, 'displayTimeUnit': 'ms'}, f)
+        return {
+            'target': session.target,
+            'started': session.started,
+            'samples': sum(session.samples.values()),
+            'events': len(session.events),
+            'files': [folded, trace],
+        }
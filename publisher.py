@@ -0,0 +1,198 @@
+import json
+import time
+import asyncio
+import threading
+import contextlib
+import concurrent.futures
+
+# Graph API error codes for throttling: app, user, page, API-specific and page business use case limits
+THROTTLE_CODES = {4, 17, 32, 613, 80001}
+APP_CODES = {4}
+INVALID_TOKEN_CODE = 190
+USAGE_HEADERS = ('X-Page-Usage', 'X-Business-Use-Case-Usage')
+APP = '*' # Rate-limit state shared by every page of the app
+
+
+def usage_of(headers, name):
+    """Returns (highest usage percent, seconds until access returns) from one usage header."""
+    try:
+        value = json.loads(headers.get(name) or 'null')
+    except ValueError:
+        return 0, 0
+    if not value:
+        return 0, 0
+    # Business use case usage is {business id: [entries]}; the other headers are a single entry
+    entries = [entry for group in value.values() for entry in group] if name == 'X-Business-Use-Case-Usage' else [value]
+    percent = max((max(entry.get(key) or 0 for key in ('call_count', 'total_cputime', 'total_time')) for entry in entries), default=0)
+    regain = max((entry.get('estimated_time_to_regain_access') or 0 for entry in entries), default=0)
+    return percent, regain * 60
+
+
+class PageState:
+    def __init__(self):
+        self.executor = None
+        self.semaphore = None
+        self.in_flight = 0
+        self.published = 0
+        self.failed = 0
+        self.usage = 0
+        self.blocked_until = 0
+        self.backoff = 0
+        self.last_error = None
+        self.token = None # (user token, page token, expires)
+
+
+class PublishPipelines:
+    """Runs uploads for each Facebook page in its own pipeline, with its own rate-limit state.
+
+    Each page gets up to `concurrency` uploads in flight, through a thread
+    pool (`submit`) or, on the async path, a semaphore (`slot`); a slow or
+    throttled page never holds up another. Graph responses are fed to
+    `record`, which reads the usage headers and throttling errors: a page
+    whose usage passes `usage_limit` percent is held for a minute, and a
+    throttled page for as long as Facebook says, or an exponential backoff.
+    App-wide throttling holds every page. Page tokens are cached per page
+    for `token_ttl` seconds and dropped when Facebook rejects them. `forget`
+    drops a page that is no longer a target, and `shutdown` stops every
+    page's pool at exit.
+    """
+
+    def __init__(self, concurrency=2, usage_limit=90, token_ttl=3600, max_backoff=3600):
+        self.concurrency = concurrency
+        self.usage_limit = usage_limit
+        self.token_ttl = token_ttl
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def _page(self, page_id):
+        state = self._pages.get(page_id)
+        if state is None:
+            state = self._pages[page_id] = PageState()
+        return state
+
+    def blocked_for(self, page_id):
+        """Seconds until `page_id` may be called again, or 0."""
+        now = time.time()
+        with self._lock:
+            until = max(self._page(page_id).blocked_until, self._page(APP).blocked_until)
+        return max(0, round(until - now))
+
+    def _hold(self, state, seconds):
+        state.blocked_until = max(state.blocked_until, time.time() + seconds)
+
+    def record(self, page_id, response):
+        """Updates a page's rate-limit state from a Graph API response."""
+        try:
+            error = (response.json() or {}).get('error') or {}
+        except ValueError:
+            error = {}
+        with self._lock:
+            state, app = self._page(page_id), self._page(APP)
+            if response.headers.get('X-App-Usage'):
+                app.usage, _ = usage_of(response.headers, 'X-App-Usage')
+            page_usage = [usage_of(response.headers, name) for name in USAGE_HEADERS if response.headers.get(name)]
+            if page_usage:
+                state.usage = max(percent for percent, _ in page_usage)
+            regain = max((seconds for _, seconds in page_usage), default=0)
+
+            code = error.get('code')
+            if code in THROTTLE_CODES:
+                target = app if code in APP_CODES else state
+                target.backoff = min(self.max_backoff, target.backoff * 2 or 60)
+                self._hold(target, regain or target.backoff)
+                target.last_error = error.get('message')
+            elif code == INVALID_TOKEN_CODE:
+                state.token = None
+            elif response.status_code == 200:
+                state.backoff = app.backoff = 0
+            if state.usage >= self.usage_limit:
+                self._hold(state, regain or 60)
+            if app.usage >= self.usage_limit:
+                self._hold(app, 60)
+
+    def cached_token(self, page_id, user_token):
+        with self._lock:
+            token = self._page(page_id).token
+        if token and token[0] == user_token and token[2] > time.time():
+            return token[1]
+        return None
+
+    def store_token(self, page_id, user_token, page_token):
+        with self._lock:
+            self._page(page_id).token = (user_token, page_token, time.time() + self.token_ttl)
+
+    def _finished(self, state, error):
+        with self._lock:
+            state.in_flight -= 1
+            if error:
+                state.failed += 1
+            else:
+                state.published += 1
+
+    def submit(self, page_id, fn, *args):
+        """Runs `fn(*args)`, which returns (message, error), in the page's thread pool; returns a Future."""
+        def run(state):
+            message, error = None, 'Publishing failed.'
+            try:
+                message, error = fn(*args)
+            except Exception as e:
+                error = f'An unexpected error occurred: {e}'
+            finally:
+                self._finished(state, error)
+            return message, error
+
+        # Submitted under the lock so `forget` can't shut the pool down in between
+        with self._lock:
+            state = self._page(page_id)
+            if state.executor is None:
+                state.executor = concurrent.futures.ThreadPoolExecutor(
+                    self.concurrency, thread_name_prefix=f'publish-{page_id}')
+            state.in_flight += 1
+            return state.executor.submit(run, state)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, page_id):
+        """Holds one of the page's upload slots on the async path; yields a callback for the outcome."""
+        with self._lock:
+            state = self._page(page_id)
+            if state.semaphore is None:
+                state.semaphore = asyncio.Semaphore(self.concurrency)
+            state.in_flight += 1
+        outcome = {'error': 'Publishing failed.'}
+        try:
+            async with state.semaphore:
+                yield lambda error: outcome.update(error=error)
+        finally:
+            self._finished(state, outcome['error'])
+
+    def forget(self, page_id):
+        """Drops a removed page's token, counters and thread pool; uploads in flight still finish."""
+        with self._lock:
+            state = self._pages.pop(page_id, None)
+        if state is not None and state.executor is not None:
+            state.executor.shutdown(wait=False)
+
+    def shutdown(self, wait=True):
+        """Stops every page's thread pool, by default after its queued uploads finish."""
+        with self._lock:
+            executors = [state.executor for state in self._pages.values() if state.executor is not None]
+            for state in self._pages.values():
+                state.executor = None
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return {
+                page_id: {
+                    'in_flight': state.in_flight,
+                    'published': state.published,
+                    'failed': state.failed,
+                    'usage_percent': state.usage,
+                    'blocked_for': max(0, round(state.blocked_until - now)),
+                    'last_throttle': state.last_error,
+                }
+                for page_id, state in self._pages.items()
+            }
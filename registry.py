@@ -0,0 +1,62 @@
+import os
+import threading
+
+
+class TemplateRegistry:
+    """In-memory listing and sources of the thumbnail templates in `folder`.
+
+    `names` rescans the folder only when its mtime changes, which happens
+    whenever a template is added, removed or renamed, by this process or
+    another worker, so a listing costs one stat instead of a directory read.
+    Sources are kept per file and reread when the file's mtime changes.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._names = None
+        self._stamp = None
+        self._sources = {} # name -> (mtime_ns, content)
+
+    def _scan(self):
+        stamp = os.stat(self.folder).st_mtime_ns
+        names = sorted(f for f in os.listdir(self.folder) if f.endswith('.html'))
+        self._names, self._stamp = names, stamp
+        for name in self._sources.keys() - set(names):
+            del self._sources[name]
+        return names
+
+    def names(self):
+        """Returns the template file names, sorted."""
+        with self._lock:
+            if self._names is None or os.stat(self.folder).st_mtime_ns != self._stamp:
+                return list(self._scan())
+            return list(self._names)
+
+    def source(self, name):
+        """Returns a template's source, from memory unless the file has changed."""
+        path = os.path.join(self.folder, name)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._sources.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r') as f:
+            content = f.read()
+        with self._lock:
+            self._sources[name] = (mtime, content)
+        return content
+
+    def load(self):
+        """Scans the folder and reads every template into memory; returns the names."""
+        with self._lock:
+            names = self._scan()
+        for name in names:
+            self.source(name)
+        return names
+
+    def invalidate(self, name=None):
+        """Forgets the listing, and `name`'s source, after a template is written."""
+        with self._lock:
+            self._names = None
+            self._sources.pop(name, None)
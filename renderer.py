@@ -0,0 +1,561 @@
+import io
+import re
+import asyncio
+import threading
+import contextlib
+import contextvars
+from urllib.parse import urlsplit
+from PIL import Image
+from playwright.async_api import async_playwright
+
+VIEWPORT = {"width": 1280, "height": 720}
+
+# Name of the template being rendered, used to attribute limit violations
+render_label = contextvars.ContextVar('render_label', default=None)
+
+# Templates opt into data binding with <meta name="render-mode" content="bind">
+BIND_MARKER = re.compile(r'<meta\s+name=["\']render-mode["\']\s+content=["\']bind["\']', re.I)
+BIND_FIELDS = ('badge', 'main_title', 'sub_title', 'image_url')
+
+# Templates declare extra outputs with e.g.
+# <meta name="render-variants" content="story=1080x1920:jpeg, link=1200x630+40+45">
+# `WxH` lays the page out again at that viewport; `WxH+X+Y` crops the main
+# render and must lie inside VIEWPORT.
+VARIANTS_MARKER = re.compile(r'<meta\s+name=["\']render-variants["\']\s+content=["\']([^"\']*)["\']', re.I)
+VARIANT_SPEC = re.compile(r'^([\w-]+)=(\d+)x(\d+)(?:\+(\d+)\+(\d+))?(?::(png|jpeg|webp))?$', re.I)
+VARIANT_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+
+# Templates set their animation timing with e.g.
+# <meta name="render-animation" content="fps=15, seconds=4">
+ANIMATION_MARKER = re.compile(r'<meta\s+name=["\']render-animation["\']\s+content=["\']([^"\']*)["\']', re.I)
+ANIMATION_SETTING = re.compile(r'^(fps|seconds)=(\d+(?:\.\d+)?)$', re.I)
+
+# Patches one row into a loaded template. Text fields are set like Jinja's
+# autoescaped output, HTML fields like `|safe`, and bound images are decoded
+# before the screenshot is taken.
+BIND_SCRIPT = """
+async (row) => {
+    const value = (name) => (row[name] === undefined ? '' : row[name]);
+    document.querySelectorAll('[data-bind-text]').forEach(el => { el.textContent = value(el.dataset.bindText); });
+    document.querySelectorAll('[data-bind-html]').forEach(el => { el.innerHTML = value(el.dataset.bindHtml); });
+    const images = [];
+    document.querySelectorAll('[data-bind-src]').forEach(el => {
+        const src = value(el.dataset.bindSrc);
+        if (el.getAttribute('src') !== src) el.setAttribute('src', src);
+        images.push(el);
+    });
+    await Promise.all(images.map(img => img.decode().catch(() => {})));
+    await document.fonts.ready;
+}
+"""
+
+
+# Puts the page on a clock that only moves when the capture loop seeks it.
+# Seeking runs due timers in order, then pending animation frames, then
+# sets every CSS animation and transition to that time, so each frame shows
+# the same moment however long the previous screenshot took. Animations are
+# seeked from the clock time they first appeared at, so one started by a
+# timer or class change plays from its own beginning.
+ANIMATION_CLOCK_SCRIPT = """
+(() => {
+    let now = 0;
+    let nextId = 1;
+    const frames = new Map();
+    const timers = new Map();
+    const epoch = Date.now();
+    const starts = new WeakMap();
+    const adopt = () => document.getAnimations().forEach(animation => {
+        if (!starts.has(animation)) starts.set(animation, now);
+    });
+    performance.now = () => now;
+    Date.now = () => epoch + now;
+    window.requestAnimationFrame = (callback) => { frames.set(nextId, callback); return nextId++; };
+    window.cancelAnimationFrame = (id) => frames.delete(id);
+    const schedule = (repeat) => (callback, delay = 0, ...args) => {
+        delay = Math.max(0, Number(delay) || 0);
+        timers.set(nextId, { callback, args, at: now + delay, every: repeat ? Math.max(1, delay) : 0 });
+        return nextId++;
+    };
+    window.setTimeout = schedule(false);
+    window.setInterval = schedule(true);
+    window.clearTimeout = window.clearInterval = (id) => timers.delete(id);
+    window.__seekAnimationClock = (ms) => {
+        adopt();
+        for (;;) {
+            let due = null;
+            timers.forEach((timer, id) => {
+                if (timer.at <= ms && (!due || timer.at < due[1].at)) due = [id, timer];
+            });
+            if (!due) break;
+            const [id, timer] = due;
+            now = timer.at;
+            if (timer.every) timer.at += timer.every; else timers.delete(id);
+            if (typeof timer.callback === 'function') timer.callback(...timer.args);
+            adopt();
+        }
+        now = ms;
+        const callbacks = [...frames.values()];
+        frames.clear();
+        callbacks.forEach(callback => callback(now));
+        adopt();
+        document.getAnimations().forEach(animation => {
+            animation.pause();
+            animation.currentTime = ms - starts.get(animation);
+        });
+    };
+})();
+"""
+
+
+def inject_base_url(html_content, base_url):
+    """Adds a <base> tag so relative paths in a template resolve against the app."""
+    if not base_url:
+        return html_content
+    if '<head>' in html_content:
+        return html_content.replace('<head>', f'<head>\n    <base href="{base_url}">', 1)
+    return f'<base href="{base_url}">{html_content}'
+
+
+def supports_binding(template_source):
+    """Checks whether a template opted into the data-binding render mode."""
+    return bool(BIND_MARKER.search(template_source))
+
+
+def parse_variants(html_content):
+    """Returns the output variants a template declares.
+
+    Malformed entries, empty sizes and crops that reach outside the main
+    render are skipped.
+    """
+    match = VARIANTS_MARKER.search(html_content)
+    if not match:
+        return []
+    variants = []
+    for spec in match.group(1).split(','):
+        spec_match = VARIANT_SPEC.match(spec.strip())
+        if not spec_match:
+            continue
+        name, width, height, left, top, image_format = spec_match.groups()
+        width, height = int(width), int(height)
+        crop = (int(left), int(top)) if left is not None else None
+        if not width or not height:
+            continue
+        if crop and (crop[0] + width > VIEWPORT['width'] or crop[1] + height > VIEWPORT['height']):
+            continue
+        variants.append({
+            'name': name,
+            'width': width,
+            'height': height,
+            'crop': crop,
+            'format': (image_format or 'png').lower(),
+        })
+    return variants
+
+
+def parse_animation(html_content):
+    """Returns the fps and seconds a template declares for animated output, if any."""
+    match = ANIMATION_MARKER.search(html_content)
+    if not match:
+        return {}
+    settings = {}
+    for setting in match.group(1).split(','):
+        setting_match = ANIMATION_SETTING.match(setting.strip())
+        if setting_match:
+            settings[setting_match.group(1).lower()] = float(setting_match.group(2))
+    return settings
+
+
+def binding_row(data):
+    """Returns the bound fields of a row the way Jinja would print them."""
+    return {field: str(data[field]) for field in BIND_FIELDS if field in data}
+
+
+def encode_image(png_bytes, image_format='PNG', quality=90):
+    """Re-encodes a PNG screenshot in another format, e.g. a smaller JPEG for upload."""
+    if image_format.upper() == 'PNG':
+        return png_bytes
+    with Image.open(io.BytesIO(png_bytes)) as image:
+        buffer = io.BytesIO()
+        image.convert('RGB').save(buffer, format=image_format, quality=quality)
+        return buffer.getvalue()
+
+
+class RenderLimitError(Exception):
+    """Raised when a render is stopped for breaking a resource limit."""
+
+    def __init__(self, kind, detail):
+        super().__init__(f'{kind}: {detail}')
+        self.kind = kind
+        self.detail = detail
+
+
+def host_matches(host, patterns):
+    """Checks a hostname against domains, matching subdomains too."""
+    return any(host == pattern or host.endswith('.' + pattern) for pattern in patterns)
+
+
+class Renderer:
+    """Keeps one Chromium instance alive and screenshots HTML on fresh pages.
+
+    All methods must be awaited on the event loop the renderer was started
+    on. The browser is launched on first use and relaunched if it dies.
+
+    Every page is governed: at most `max_pages` are open at once, each step
+    of a render must finish within `budget_seconds`, and a page whose JS heap
+    passes `max_page_memory_mb` is closed. Requests of a blocked resource
+    type or to a blocked host are aborted; if `allowed_hosts` is set, only
+    those hosts and the app's own host may be fetched. Each limit hit is
+    passed to `on_violation(label, kind, detail)`, where `label` is the
+    `render_label` in effect when the page was opened.
+    """
+
+    def __init__(self, max_pages=4, viewport=None, preview_scale=0.5, preview_quality=70,
+                 budget_seconds=30, max_page_memory_mb=512, blocked_resource_types=(),
+                 blocked_hosts=(), allowed_hosts=None, on_violation=None):
+        self.max_pages = max_pages
+        self.viewport = viewport or VIEWPORT
+        self.preview_scale = preview_scale
+        self.preview_quality = preview_quality
+        self.budget_seconds = budget_seconds
+        self.max_page_memory_mb = max_page_memory_mb
+        self.blocked_resource_types = set(blocked_resource_types)
+        self.blocked_hosts = tuple(blocked_hosts)
+        self.allowed_hosts = tuple(allowed_hosts) if allowed_hosts is not None else None
+        self.on_violation = on_violation
+        self._playwright = None
+        self._browser = None
+        self._lock = None
+        self._pages = None
+        self._preview_lock = None
+        self._preview_page = None
+        self._preview_source = None
+        self._preview_tickets = {}
+        self._cdp_sessions = {} # Page -> task opening its CDP session, dropped when the page closes
+
+    async def start(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._pages = asyncio.Semaphore(self.max_pages)
+            self._preview_lock = asyncio.Lock()
+        async with self._lock:
+            if self._browser is not None and self._browser.is_connected():
+                return
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            args = []
+            if self.max_page_memory_mb:
+                # Hard V8 limit per renderer process, behind the softer heap watchdog
+                args.append(f'--js-flags=--max-old-space-size={self.max_page_memory_mb}')
+            self._browser = await self._playwright.chromium.launch(args=args)
+
+    async def stop(self):
+        self._preview_page = None
+        self._cdp_sessions.clear()
+        if self._browser is not None:
+            await self._browser.close()
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    def _report(self, label, kind, detail):
+        if self.on_violation:
+            self.on_violation(label, kind, detail)
+
+    async def _new_page(self, base_url=None, **options):
+        """Opens a page with the request policy installed."""
+        page = await self._browser.new_page(**options)
+        label = render_label.get()
+        own_host = urlsplit(base_url).hostname if base_url else None
+        if not (self.blocked_resource_types or self.blocked_hosts or self.allowed_hosts is not None):
+            return page
+
+        async def handle(route):
+            request = route.request
+            host = urlsplit(request.url).hostname or ''
+            blocked = (
+                request.resource_type in self.blocked_resource_types
+                or host_matches(host, self.blocked_hosts)
+                or (self.allowed_hosts is not None and host and host != own_host
+                    and not host_matches(host, self.allowed_hosts))
+            )
+            if blocked:
+                self._report(label, 'blocked_request', f'{request.resource_type} {request.url[:200]}')
+                await route.abort('blockedbyclient')
+            else:
+                await route.continue_()
+
+        await page.route('**/*', handle)
+        return page
+
+    @contextlib.asynccontextmanager
+    async def _page(self, base_url=None, **options):
+        """Takes a slot from the page pool and yields a governed page."""
+        await self.start()
+        async with self._pages:
+            page = await self._new_page(base_url, viewport=options.pop('viewport', self.viewport), **options)
+            try:
+                yield page
+            finally:
+                await page.close()
+
+    async def _cdp_session(self, page):
+        """Returns the page's CDP session with metrics enabled, opening it on first use.
+
+        Every governed step of a page shares the one session; it goes away
+        with the page.
+        """
+        opening = self._cdp_sessions.get(page)
+        if opening is None:
+            async def open_session():
+                cdp = await page.context.new_cdp_session(page)
+                await cdp.send('Performance.enable')
+                return cdp
+            opening = self._cdp_sessions[page] = asyncio.ensure_future(open_session())
+            page.once('close', lambda *_: self._cdp_sessions.pop(page, None))
+        try:
+            return await asyncio.shield(opening)
+        except Exception:
+            if self._cdp_sessions.get(page) is opening:
+                del self._cdp_sessions[page]
+            raise
+
+    async def _watch_memory(self, page):
+        """Polls a page's JS heap and returns its size once it passes the cap."""
+        cdp = await self._cdp_session(page)
+        cap = self.max_page_memory_mb * 1024 * 1024
+        while True:
+            metrics = await cdp.send('Performance.getMetrics')
+            used = next((m['value'] for m in metrics['metrics'] if m['name'] == 'JSHeapUsedSize'), 0)
+            if used > cap:
+                return used
+            await asyncio.sleep(0.25)
+
+    async def _governed(self, page, work):
+        """Runs one step of page work under the wall-clock budget and memory cap.
+
+        On a breach the page is closed, which stops whatever it was doing,
+        and RenderLimitError is raised.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget_seconds
+        work_task = asyncio.ensure_future(work)
+        pending = {work_task}
+        watchdog = None
+        if self.max_page_memory_mb:
+            watchdog = asyncio.ensure_future(self._watch_memory(page))
+            pending.add(watchdog)
+        try:
+            while True:
+                done, _ = await asyncio.wait(pending, timeout=max(0, deadline - loop.time()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if work_task in done:
+                    return work_task.result()
+                if watchdog in done:
+                    pending.discard(watchdog)
+                    if watchdog.cancelled() or watchdog.exception():
+                        continue # Metrics unavailable; keep going on the budget alone
+                    kind = 'memory'
+                    detail = f'JS heap reached {watchdog.result() // 2 ** 20:.0f} MB (cap {self.max_page_memory_mb} MB)'
+                else:
+                    kind = 'timeout'
+                    detail = f'exceeded the {self.budget_seconds}s render budget'
+                break
+            await page.close()
+            self._report(render_label.get(), kind, detail)
+            raise RenderLimitError(kind, detail)
+        finally:
+            for task in (work_task, watchdog):
+                if task is not None and not task.done():
+                    task.cancel()
+                    # Work on a killed page fails as it unwinds; that error is expected
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def render(self, html_content, base_url=None, path=None, timeout=60000):
+        """Renders HTML and returns the PNG bytes, also writing them to `path` if given."""
+        async with self._page(base_url) as page:
+            async def work():
+                await page.set_content(inject_base_url(html_content, base_url), timeout=timeout)
+                return await page.screenshot(path=path, type="png")
+            return await self._governed(page, work())
+
+    async def preview(self, html_content, base_url=None, row=None, source_key=None, channel=None, timeout=10000):
+        """Renders a reduced-resolution JPEG on a dedicated page that stays open.
+
+        The preview page sits outside the render pool, so previews never queue
+        behind batch work. When `source_key` matches the document already
+        loaded, `row` is patched in through data binding instead of reloading.
+        Returns None if a newer preview on the same `channel` replaced this one
+        before it was taken.
+        """
+        await self.start()
+        ticket = self._preview_tickets.get(channel, 0) + 1
+        self._preview_tickets[channel] = ticket
+
+        def superseded():
+            return self._preview_tickets.get(channel) != ticket
+
+        try:
+            async with self._preview_lock:
+                if superseded():
+                    return None
+                if self._preview_page is None or self._preview_page.is_closed():
+                    self._preview_page = await self._new_page(
+                        base_url, viewport=self.viewport, device_scale_factor=self.preview_scale)
+                    self._preview_source = None
+                page = self._preview_page
+
+                async def work():
+                    if row is not None and source_key and source_key == self._preview_source:
+                        await asyncio.wait_for(page.evaluate(BIND_SCRIPT, binding_row(row)), timeout / 1000)
+                    else:
+                        self._preview_source = None
+                        await page.set_content(inject_base_url(html_content, base_url), timeout=timeout)
+                        self._preview_source = source_key
+                    if superseded():
+                        return None
+                    return await page.screenshot(type="jpeg", quality=self.preview_quality)
+                return await self._governed(page, work())
+        finally:
+            if not superseded():
+                del self._preview_tickets[channel]
+
+    async def render_bound(self, html_content, rows, base_url=None, paths=None, timeout=60000):
+        """Loads a data-binding template once and screenshots it for each row.
+
+        `html_content` is the template already rendered for any one row; each
+        row's bound fields are then patched in through the DOM, so CSS, fonts
+        and layout are not rebuilt from scratch per row. The load and each row
+        get their own render budget.
+        """
+        async with self._page(base_url) as page:
+            await self._governed(page, page.set_content(inject_base_url(html_content, base_url), timeout=timeout))
+            screenshots = []
+            for i, row in enumerate(rows):
+                async def work(row=row, path=paths[i] if paths else None):
+                    await asyncio.wait_for(page.evaluate(BIND_SCRIPT, binding_row(row)), timeout / 1000)
+                    return await page.screenshot(path=path, type="png")
+                screenshots.append(await self._governed(page, work()))
+            return screenshots
+
+    async def render_variants(self, html_content, variants, base_url=None, timeout=60000):
+        """Renders the main image and every declared variant in one page session.
+
+        Crops are cut from the layout already on screen; resized variants
+        re-lay out the same document, so fonts and images load only once.
+        Returns the main PNG bytes and a dict of variant name to bytes.
+        """
+        outputs = {}
+        async with self._page(base_url) as page:
+            async def work():
+                await page.set_content(inject_base_url(html_content, base_url), timeout=timeout)
+                main = await page.screenshot(type="png")
+                for variant in sorted(variants, key=lambda v: v['crop'] is None):
+                    if variant['crop']:
+                        left, top = variant['crop']
+                        clip = {'x': left, 'y': top, 'width': variant['width'], 'height': variant['height']}
+                        outputs[variant['name']] = await page.screenshot(type="png", clip=clip)
+                    else:
+                        await page.set_viewport_size({'width': variant['width'], 'height': variant['height']})
+                        await page.evaluate("() => document.fonts.ready.then(() => true)")
+                        outputs[variant['name']] = await page.screenshot(type="png")
+                return main
+            main = await self._governed(page, work())
+
+        for variant in variants:
+            if variant['format'] != 'png':
+                outputs[variant['name']] = await asyncio.to_thread(
+                    encode_image, outputs[variant['name']], variant['format'].upper())
+        return main, outputs
+
+    async def render_animation(self, html_content, encoder, base_url=None, fps=12, seconds=3,
+                               queue_frames=4, timeout=60000):
+        """Captures a timed sequence of frames and feeds them to an encoder.
+
+        The page runs on ANIMATION_CLOCK_SCRIPT's clock, advanced one frame
+        interval per capture. Frames pass through a queue of `queue_frames`
+        to the encoder, which works in a thread while later frames are taken;
+        a full queue holds capture back. The page goes back to the pool
+        before the encoder finishes. Returns the number of frames captured.
+        """
+        queue = asyncio.Queue(maxsize=queue_frames)
+
+        async def encode():
+            while (png := await queue.get()) is not None:
+                await asyncio.to_thread(encoder.add_frame, png)
+            await asyncio.to_thread(encoder.finish)
+
+        encoding = asyncio.ensure_future(encode())
+
+        async def feed(item):
+            put = asyncio.ensure_future(queue.put(item))
+            await asyncio.wait({put, encoding}, return_when=asyncio.FIRST_COMPLETED)
+            if not put.done():
+                put.cancel()
+            if encoding.done():
+                encoding.result() # Raises if the encoder failed
+
+        count = max(1, round(fps * seconds))
+        try:
+            async with self._page(base_url) as page:
+                await page.add_init_script(ANIMATION_CLOCK_SCRIPT)
+
+                async def load():
+                    await page.set_content(inject_base_url(html_content, base_url), timeout=timeout)
+                    await page.evaluate("() => document.fonts.ready.then(() => true)")
+                await self._governed(page, load())
+
+                for i in range(count):
+                    async def frame(ms=i * 1000 / fps):
+                        await page.evaluate("ms => window.__seekAnimationClock(ms)", ms)
+                        return await page.screenshot(type="png")
+                    await feed(await self._governed(page, frame()))
+            await feed(None)
+            await encoding
+        finally:
+            if not encoding.done():
+                encoding.cancel()
+        return count
+
+
+class RenderLoop:
+    """Lets synchronous request handlers await coroutines on one shared loop.
+
+    By default the loop runs in a daemon thread started on first use. An
+    async server can `attach()` its own loop instead, so sync (WSGI) code
+    and async handlers share the same renderer.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def attach(self, loop):
+        self._loop = loop
+
+    def loop(self):
+        """Returns the shared loop, starting it if needed."""
+        return self._ensure_loop()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='render-loop', daemon=True).start()
+            return self._loop
+
+    def run(self, coro, timeout=None, label=None):
+        """Runs a coroutine on the shared loop and blocks until it finishes.
+
+        `label` becomes the `render_label` for everything the coroutine renders.
+        """
+        if label is not None:
+            coro = self._labelled(label, coro)
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        return future.result(timeout)
+
+    @staticmethod
+    async def _labelled(label, coro):
+        render_label.set(label) # Scoped to this task and the tasks it starts
+        asyncio.current_task().set_name(f'render {label}')
+        return await coro
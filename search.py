@@ -0,0 +1,259 @@
+import re
+import html
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS thumbnails (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE NOT NULL,
+    badge TEXT,
+    main_title TEXT,
+    sub_title TEXT,
+    template TEXT,
+    created_at REAL,
+    filename TEXT
+);
+CREATE INDEX IF NOT EXISTS thumbnails_created ON thumbnails (created_at);
+CREATE INDEX IF NOT EXISTS thumbnails_template ON thumbnails (template, created_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS thumbnails_fts USING fts5(
+    badge, main_title, sub_title, template,
+    content='thumbnails', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS thumbnails_ai AFTER INSERT ON thumbnails BEGIN
+    INSERT INTO thumbnails_fts (rowid, badge, main_title, sub_title, template)
+    VALUES (new.rowid, new.badge, new.main_title, new.sub_title, new.template);
+END;
+CREATE TRIGGER IF NOT EXISTS thumbnails_ad AFTER DELETE ON thumbnails BEGIN
+    INSERT INTO thumbnails_fts (thumbnails_fts, rowid, badge, main_title, sub_title, template)
+    VALUES ('delete', old.rowid, old.badge, old.main_title, old.sub_title, old.template);
+END;
+CREATE TRIGGER IF NOT EXISTS thumbnails_au AFTER UPDATE ON thumbnails BEGIN
+    INSERT INTO thumbnails_fts (thumbnails_fts, rowid, badge, main_title, sub_title, template)
+    VALUES ('delete', old.rowid, old.badge, old.main_title, old.sub_title, old.template);
+    INSERT INTO thumbnails_fts (rowid, badge, main_title, sub_title, template)
+    VALUES (new.rowid, new.badge, new.main_title, new.sub_title, new.template);
+END;
+
+CREATE TABLE IF NOT EXISTS library_folders (id TEXT PRIMARY KEY, name TEXT, created_at REAL);
+CREATE TABLE IF NOT EXISTS library_items (thumbnail_id TEXT PRIMARY KEY, folder TEXT, added_at REAL);
+CREATE INDEX IF NOT EXISTS library_items_added ON library_items (added_at);
+CREATE INDEX IF NOT EXISTS library_items_folder ON library_items (folder, added_at);
+CREATE TABLE IF NOT EXISTS library_counts (folder TEXT PRIMARY KEY, items INTEGER NOT NULL);
+CREATE TRIGGER IF NOT EXISTS library_items_ai AFTER INSERT ON library_items BEGIN
+    INSERT INTO library_counts (folder, items) VALUES (new.folder, 1)
+    ON CONFLICT (folder) DO UPDATE SET items = items + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS library_items_ad AFTER DELETE ON library_items BEGIN
+    UPDATE library_counts SET items = items - 1 WHERE folder = old.folder;
+END;
+CREATE TRIGGER IF NOT EXISTS library_items_au AFTER UPDATE OF folder ON library_items BEGIN
+    UPDATE library_counts SET items = items - 1 WHERE folder = old.folder;
+    INSERT INTO library_counts (folder, items) VALUES (new.folder, 1)
+    ON CONFLICT (folder) DO UPDATE SET items = items + 1;
+END;
+"""
+
+FIELDS = ('badge', 'main_title', 'sub_title', 'template', 'created_at', 'filename')
+# Mirrored tables: name -> (key column, value columns)
+TABLES = {
+    'thumbnails': ('id', FIELDS),
+    'library_folders': ('id', ('name', 'created_at')),
+    'library_items': ('thumbnail_id', ('folder', 'added_at')),
+}
+SORTS = {
+    'newest': 't.created_at DESC',
+    'oldest': 't.created_at ASC',
+    'relevance': 'bm25(thumbnails_fts), t.created_at DESC',
+}
+
+
+def plain_text(value):
+    """Strips markup such as the highlight span from a title."""
+    return html.unescape(re.sub(r'<[^>]+>', '', value or '')).strip()
+
+
+def match_query(text):
+    """Turns free text into an FTS query matching every word as a prefix."""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+
+
+def index_row(item):
+    """Returns the indexed fields of a thumbnail record, in FIELDS order."""
+    data = item.get('data', {})
+    return (
+        plain_text(data.get('badge')),
+        plain_text(data.get('main_title')),
+        plain_text(data.get('sub_title')),
+        item.get('template') or '',
+        float(item.get('created_at') or 0),
+        item.get('filename'),
+    )
+
+
+def library_rows(library):
+    """Returns the library's folders and items as rows for their mirrored tables."""
+    library = library or {}
+    return (
+        {key: (folder.get('name'), folder.get('created_at')) for key, folder in library.get('folders', {}).items()},
+        # Unfiled items are kept under '' so they have a count row like any folder
+        {key: (item.get('folder') or '', item.get('added_at')) for key, item in library.get('items', {}).items()},
+    )
+
+
+class SearchIndex:
+    """SQLite index over db.json: full-text search of thumbnails, and the library.
+
+    `sync` brings the index in line with the thumbnail records and library,
+    writing only the rows that changed. It remembers a stamp of the db.json
+    it was synced from, so a reader can tell when the file was changed behind
+    its back (another worker process, or a hand edit) and resync before
+    searching.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._rows = None # table -> {key: fields}, as last read or written by this process
+        self._generation = None
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _meta(self, conn, key):
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def stamp(self):
+        with self._lock:
+            return self._meta(self._connection(), 'stamp')
+
+    def sync(self, thumbnails, library=None, stamp=None):
+        """Updates the index to match `thumbnails` and `library`; returns (written, deleted) counts."""
+        folders, items = library_rows(library)
+        current = {
+            'thumbnails': {item['id']: index_row(item) for item in thumbnails if item.get('id')},
+            'library_folders': folders,
+            'library_items': items,
+        }
+        written = deleted = 0
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                generation = self._meta(conn, 'generation')
+                if self._rows is None or generation != self._generation:
+                    # Another process wrote since we last looked
+                    self._rows = {
+                        table: {
+                            row[0]: tuple(row[1:])
+                            for row in conn.execute(f"SELECT {key}, {', '.join(columns)} FROM {table}")
+                        }
+                        for table, (key, columns) in TABLES.items()
+                    }
+                for table, (key, columns) in TABLES.items():
+                    previous, rows = self._rows[table], current[table]
+                    changed = [(name, *row) for name, row in rows.items() if previous.get(name) != row]
+                    removed = [(name,) for name in previous.keys() - rows.keys()]
+                    if removed:
+                        conn.executemany(f'DELETE FROM {table} WHERE {key} = ?', removed)
+                    if changed:
+                        conn.executemany(
+                            f"INSERT INTO {table} ({key}, {', '.join(columns)}) "
+                            f"VALUES ({', '.join('?' * (len(columns) + 1))}) "
+                            f"ON CONFLICT ({key}) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}",
+                            changed,
+                        )
+                    written += len(changed)
+                    deleted += len(removed)
+                self._generation = str(int(generation or 0) + 1) if written or deleted else generation
+                conn.executemany(
+                    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                    [('generation', self._generation), ('stamp', stamp)],
+                )
+                self._rows = current
+            return written, deleted
+
+    def search(self, text='', template=None, created_from=None, created_to=None,
+               sort=None, page=1, per_page=50):
+        """Returns (records, total) for one page of matching thumbnails."""
+        query = match_query(text or '')
+        where, params = [], []
+        # With a text query, the unary + keeps SQLite from driving the search
+        # off the column indexes and running the MATCH once per row
+        column = '+t.' if query else 't.'
+        if query:
+            where.append('thumbnails_fts MATCH ?')
+            params.append(query)
+        if template:
+            where.append(f'{column}template = ?')
+            params.append(template)
+        if created_from is not None:
+            where.append(f'{column}created_at >= ?')
+            params.append(created_from)
+        if created_to is not None:
+            where.append(f'{column}created_at < ?')
+            params.append(created_to)
+        source = 'thumbnails t'
+        if query:
+            source = 'thumbnails_fts JOIN thumbnails t ON t.rowid = thumbnails_fts.rowid'
+        else:
+            sort = 'oldest' if sort == 'oldest' else 'newest'
+        order = SORTS.get(sort or 'relevance', SORTS['relevance'])
+        clause = f"WHERE {' AND '.join(where)}" if where else ''
+
+        with self._lock:
+            conn = self._connection()
+            total = conn.execute(f'SELECT count(*) FROM {source} {clause}', params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT t.id, {', '.join(f't.{f}' for f in FIELDS)} FROM {source} {clause} "
+                f"ORDER BY {order} LIMIT ? OFFSET ?",
+                params + [per_page, (page - 1) * per_page],
+            ).fetchall()
+        return [dict(zip(('id',) + FIELDS, row)) for row in rows], total
+
+    def has_thumbnail(self, thumbnail_id):
+        """Checks by primary key whether a thumbnail is indexed."""
+        with self._lock:
+            row = self._connection().execute('SELECT 1 FROM thumbnails WHERE id = ?', (thumbnail_id,)).fetchone()
+        return row is not None
+
+    def library_folders(self):
+        """Returns the library folders, each with its item count, sorted by name."""
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT f.id, f.name, coalesce(c.items, 0) FROM library_folders f '
+                'LEFT JOIN library_counts c ON c.folder = f.id ORDER BY f.name COLLATE NOCASE'
+            ).fetchall()
+        return [{'id': key, 'name': name, 'count': count} for key, name, count in rows]
+
+    def library_counts(self):
+        """Returns {'all': n, 'unfiled': n} from the maintained per-folder counts."""
+        with self._lock:
+            rows = dict(self._connection().execute('SELECT folder, items FROM library_counts').fetchall())
+        return {'all': sum(rows.values()), 'unfiled': rows.get('', 0)}
+
+    def library_page(self, folder=None, page=1, per_page=24):
+        """Returns one page of library entries, newest first, with their thumbnail fields.
+
+        `folder` is a folder id, '' for unfiled entries, or None for all of them.
+        """
+        where, params = '', []
+        if folder is not None:
+            where, params = 'WHERE li.folder = ?', [folder]
+        with self._lock:
+            rows = self._connection().execute(
+                f"SELECT t.id, {', '.join(f't.{f}' for f in FIELDS)}, li.folder, li.added_at "
+                f"FROM library_items li JOIN thumbnails t ON t.id = li.thumbnail_id {where} "
+                f"ORDER BY li.added_at DESC LIMIT ? OFFSET ?",
+                params + [per_page, (page - 1) * per_page],
+            ).fetchall()
+        return [dict(zip(('id',) + FIELDS + ('folder', 'added_at'), row)) for row in rows]
@@ -0,0 +1,223 @@
+import os
+import io
+import shutil
+import hashlib
+import mimetypes
+from flask import send_file, send_from_directory
+
+
+def shard_prefix(name, depth=1):
+    """Returns the shard directories for a filename, e.g. 'ab' or 'ab/cd'."""
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return '/'.join(digest[i * 2:i * 2 + 2] for i in range(depth))
+
+
+class LocalStorage:
+    """Stores generated images on local disk in hash-sharded subdirectories.
+
+    Files from the old flat layout (`<root>/<name>`) are still found and are
+    moved into their shard the first time they are touched, or all at once
+    by `migrate_legacy()`.
+    """
+
+    def __init__(self, root, shard_depth=1):
+        self.root = root
+        self.shard_depth = shard_depth
+
+    def key_for(self, name):
+        return f"{shard_prefix(name, self.shard_depth)}/{name}"
+
+    def path_for(self, name):
+        """Returns the sharded path for a name, migrating a flat file if needed."""
+        path = os.path.join(self.root, *self.key_for(name).split('/'))
+        if not os.path.exists(path):
+            legacy_path = os.path.join(self.root, name)
+            if os.path.isfile(legacy_path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(legacy_path, path)
+        return path
+
+    def exists(self, name):
+        return os.path.isfile(self.path_for(name))
+
+    def put_file(self, name, source_path):
+        """Moves a finished local file into storage under `name`."""
+        path = self.path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+
+    def open(self, name):
+        return open(self.path_for(name), 'rb')
+
+    def delete(self, name):
+        try:
+            os.remove(self.path_for(name))
+        except OSError:
+            pass # Ignore if file doesn't exist
+
+    def list(self):
+        """Yields (name, size, mtime) for every stored file."""
+        if not os.path.isdir(self.root):
+            return
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # Hidden folders and files are scratch space, not stored objects
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                stat = os.stat(os.path.join(dirpath, filename))
+                yield filename, stat.st_size, stat.st_mtime
+
+    def send(self, name, **kwargs):
+        path = self.path_for(name)
+        return send_from_directory(os.path.dirname(path), name, **kwargs)
+
+    def migrate_legacy(self):
+        """Moves every file from the flat layout into its shard."""
+        moved = 0
+        if not os.path.isdir(self.root):
+            return moved
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    self.path_for(entry.name)
+                    moved += 1
+        return moved
+
+
+class LocalObjectClient:
+    """A local stand-in for an S3-style object store client.
+
+    Implements the small subset of the boto3 S3 client API that
+    `ObjectStorage` uses, keeping each bucket as a directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            if hasattr(Body, 'read'):
+                shutil.copyfileobj(Body, f)
+            else:
+                f.write(Body)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        stat = os.stat(self._path(Bucket, Key))
+        return {'ContentLength': stat.st_size, 'LastModified': stat.st_mtime}
+
+    def get_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        stat = os.stat(path)
+        return {'Body': open(path, 'rb'), 'ContentLength': stat.st_size, 'LastModified': stat.st_mtime}
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except OSError:
+            pass
+        return {}
+
+    def list_objects_v2(self, Bucket, **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        contents = []
+        for dirpath, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                key = os.path.relpath(path, bucket_root).replace(os.sep, '/')
+                contents.append({'Key': key, 'Size': stat.st_size, 'LastModified': stat.st_mtime})
+        return {'Contents': contents, 'IsTruncated': False}
+
+
+class ObjectStorage:
+    """Stores generated images in an object store under sharded keys.
+
+    `client` is anything with the boto3 S3 client methods used below, such
+    as `boto3.client('s3')` or `LocalObjectClient`. Files still sitting in
+    the old flat `legacy_root` folder are uploaded the first time they are
+    looked up, or all at once by `migrate_legacy()`.
+    """
+
+    def __init__(self, client, bucket, shard_depth=1, legacy_root=None):
+        self.client = client
+        self.bucket = bucket
+        self.shard_depth = shard_depth
+        self.legacy_root = legacy_root
+
+    def key_for(self, name):
+        return f"{shard_prefix(name, self.shard_depth)}/{name}"
+
+    def _head(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key_for(name))
+        except Exception: # boto3 raises ClientError, the local stand-in OSError
+            return False
+        return True
+
+    def _migrate(self, name):
+        legacy_path = os.path.join(self.legacy_root, name) if self.legacy_root else None
+        if legacy_path and os.path.isfile(legacy_path):
+            self.put_file(name, legacy_path)
+            return True
+        return False
+
+    def exists(self, name):
+        return self._head(name) or self._migrate(name)
+
+    def put_file(self, name, source_path):
+        with open(source_path, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket, Key=self.key_for(name), Body=f)
+        os.remove(source_path)
+
+    def open(self, name):
+        if not self._head(name):
+            self._migrate(name)
+        return self.client.get_object(Bucket=self.bucket, Key=self.key_for(name))['Body']
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key_for(name))
+        if self.legacy_root:
+            try:
+                os.remove(os.path.join(self.legacy_root, name))
+            except OSError:
+                pass
+
+    def list(self):
+        kwargs = {}
+        while True:
+            response = self.client.list_objects_v2(Bucket=self.bucket, **kwargs)
+            for item in response.get('Contents', []):
+                modified = item['LastModified']
+                if hasattr(modified, 'timestamp'):
+                    modified = modified.timestamp()
+                yield item['Key'].rsplit('/', 1)[-1], item['Size'], modified
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def send(self, name, **kwargs):
+        body = self.open(name)
+        try:
+            data = io.BytesIO(body.read())
+        finally:
+            body.close()
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        return send_file(data, mimetype=mimetype, download_name=name, **kwargs)
+
+    def migrate_legacy(self):
+        """Uploads every file from the flat legacy folder."""
+        moved = 0
+        if not self.legacy_root or not os.path.isdir(self.legacy_root):
+            return moved
+        with os.scandir(self.legacy_root) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('.') and self._migrate(entry.name):
+                    moved += 1
+        return moved
@@ -0,0 +1,102 @@
+import io
+import os
+import sys
+import json
+import shutil
+import uuid
+import hashlib
+
+import pytest
+from PIL import Image
+
+# The modules live at the top of the repository, next to app.py
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+def fake_png(content):
+    """A small PNG whose colour is a digest of `content`, so equal documents give equal bytes."""
+    digest = hashlib.sha256(content.encode('utf-8')).digest()
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 36), tuple(digest[:3])).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class FakeRenderer:
+    """Stands in for the Chromium renderer: records what it was asked to render."""
+
+    def __init__(self):
+        self.rendered = []
+        self.fail = None # Raise for documents containing this text
+
+    def _png(self, html_content):
+        if self.fail and self.fail in html_content:
+            raise RuntimeError('render failed')
+        self.rendered.append(html_content)
+        return fake_png(html_content)
+
+    async def start(self):
+        pass
+
+    async def render(self, html_content, base_url=None, path=None, timeout=60000):
+        png = self._png(html_content)
+        if path:
+            with open(path, 'wb') as f:
+                f.write(png)
+        return png
+
+    async def render_bound(self, html_content, rows, base_url=None, paths=None, timeout=60000):
+        pngs = [self._png(html_content + json.dumps(row, sort_keys=True)) for row in rows]
+        for path, png in zip(paths or [], pngs):
+            with open(path, 'wb') as f:
+                f.write(png)
+        return pngs
+
+    async def render_variants(self, html_content, variants, base_url=None, timeout=60000):
+        return self._png(html_content), {variant['name']: fake_png(html_content + variant['name']) for variant in variants}
+
+
+@pytest.fixture
+def fake_renderer():
+    return FakeRenderer()
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch, fake_renderer):
+    """The app module, working in a scratch folder with the bundled templates and a fake renderer.
+
+    The warm-up and garbage collector threads are kept from starting.
+    """
+    import app
+    from registry import TemplateRegistry
+    from search import SearchIndex
+
+    monkeypatch.chdir(tmp_path)
+    shutil.copytree(os.path.join(REPO, 'thumbnail_templates'), 'thumbnail_templates')
+    for folder in ('uploads', 'generated', 'image_uploads'):
+        os.makedirs(folder)
+    monkeypatch.setattr(app, 'search_index', SearchIndex(str(tmp_path / 'search_index.db')))
+    monkeypatch.setattr(app, 'template_registry', TemplateRegistry('thumbnail_templates'))
+    for name in ('start', 'render', 'render_bound', 'render_variants'):
+        monkeypatch.setattr(app.renderer, name, getattr(fake_renderer, name))
+    monkeypatch.setitem(app.warm_state, 'started_at', 1)
+    monkeypatch.setitem(app.warm_state, 'ready', True)
+    monkeypatch.setitem(app.gc_state, 'thread', 'off')
+    app.init_db()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def add_thumbnails(app, *rows, template='default.html'):
+    """Renders and stores a thumbnail per row of data; returns the stored records."""
+    thumbnails = [
+        {'id': uuid.uuid4().hex, 'template': template, 'created_at': n, 'filename': None,
+         'data': dict({'badge': '', 'sub_title': '', 'image_url': ''}, **row)}
+        for n, row in enumerate(rows)
+    ]
+    with app.app.test_request_context():
+        return app.render_batch_to_store(thumbnails, {})
@@ -0,0 +1,177 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from admission import BULK, INTERACTIVE, AdmissionController, AdmissionRejected
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def acquire_in_thread(controller, user, priority, admitted):
+    def run():
+        try:
+            admitted.append(controller.acquire(user, priority))
+        except AdmissionRejected as e:
+            admitted.append(e)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_admits_up_to_slots_then_queues():
+    controller = AdmissionController(slots=2, max_wait=5, reserved_interactive=0)
+    first = controller.acquire('a', INTERACTIVE)
+    controller.acquire('b', INTERACTIVE)
+
+    admitted = []
+    thread = acquire_in_thread(controller, 'c', INTERACTIVE, admitted)
+    wait_until(lambda: controller.status()['queued_interactive'] == 1)
+    assert admitted == []
+
+    controller.release(first)
+    thread.join(2)
+    assert admitted and admitted[0]['user'] == 'c'
+    assert controller.status()['active'] == 2
+
+
+def test_bulk_leaves_reserved_slots_for_interactive():
+    controller = AdmissionController(slots=3, max_wait=0.1, reserved_interactive=1)
+    controller.acquire('a', BULK)
+    controller.acquire('b', BULK)
+    with pytest.raises(AdmissionRejected):
+        controller.acquire('c', BULK)
+    controller.acquire('d', INTERACTIVE)
+    assert controller.status()['active_bulk'] == 2
+
+
+def test_bulk_always_gets_one_slot():
+    controller = AdmissionController(slots=1, max_wait=0.1, reserved_interactive=1)
+    ticket = controller.acquire('a', BULK)
+    assert ticket['priority'] == BULK
+
+
+def test_interactive_goes_ahead_of_bulk():
+    controller = AdmissionController(slots=1, max_wait=5, reserved_interactive=0)
+    running = controller.acquire('a', INTERACTIVE)
+    admitted = []
+    bulk = acquire_in_thread(controller, 'b', BULK, admitted)
+    wait_until(lambda: controller.status()['queued_bulk'] == 1)
+    interactive = acquire_in_thread(controller, 'c', INTERACTIVE, admitted)
+    wait_until(lambda: controller.status()['queued_interactive'] == 1)
+
+    controller.release(running)
+    interactive.join(2)
+    assert [ticket['user'] for ticket in admitted] == ['c']
+    controller.release(admitted[0])
+    bulk.join(2)
+    assert [ticket['user'] for ticket in admitted] == ['c', 'b']
+
+
+def test_round_robin_between_users():
+    controller = AdmissionController(slots=1, max_queue=16, max_wait=5, reserved_interactive=0)
+    running = controller.acquire('a', INTERACTIVE)
+    admitted = []
+    threads = []
+    for user in ('a', 'a', 'b'):
+        threads.append(acquire_in_thread(controller, user, INTERACTIVE, admitted))
+        count = len(threads)
+        wait_until(lambda: controller.status()['queued_interactive'] == count)
+
+    controller.release(running)
+    wait_until(lambda: len(admitted) == 1)
+    # 'a' was served most recently, so 'b' goes next despite queueing last
+    assert admitted[0]['user'] == 'b'
+    for count in (2, 3):
+        controller.release(admitted[-1])
+        wait_until(lambda: len(admitted) == count)
+    assert [ticket['user'] for ticket in admitted] == ['b', 'a', 'a']
+    for thread in threads:
+        thread.join(2)
+
+
+def test_rejects_when_queue_is_full():
+    controller = AdmissionController(slots=1, max_queue=1, max_wait=5)
+    controller.acquire('a', INTERACTIVE)
+    admitted = []
+    acquire_in_thread(controller, 'b', INTERACTIVE, admitted)
+    wait_until(lambda: controller.status()['queued_interactive'] == 1)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire('c', INTERACTIVE)
+    assert rejected.value.reason == 'render queue is full'
+    assert rejected.value.retry_after >= 1
+
+
+def test_rejects_a_user_over_their_share():
+    controller = AdmissionController(slots=1, max_queue=4, max_wait=5)
+    controller.acquire('a', INTERACTIVE)
+    admitted = []
+    for count in (1, 2):
+        acquire_in_thread(controller, 'b', INTERACTIVE, admitted)
+        wait_until(lambda: controller.status()['queued_interactive'] == count)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire('b', INTERACTIVE)
+    assert rejected.value.reason == 'too many queued renders for this user'
+
+
+def test_times_out_and_leaves_the_queue():
+    controller = AdmissionController(slots=1, max_wait=0.05)
+    controller.acquire('a', INTERACTIVE)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire('b', INTERACTIVE)
+    assert rejected.value.reason == 'timed out waiting for a render slot'
+    assert controller.status()['queued_interactive'] == 0
+    assert controller.status()['rejected'] == 1
+
+
+def test_async_waiters_hold_no_thread():
+    controller = AdmissionController(slots=1, max_wait=5)
+
+    async def main():
+        running = controller.acquire('a', INTERACTIVE)
+        threads = threading.active_count()
+        waiters = [asyncio.ensure_future(controller.acquire_async(user, INTERACTIVE)) for user in 'bcd']
+        await asyncio.sleep(0.01)
+        assert controller.status()['queued_interactive'] == 3
+        assert threading.active_count() == threads
+
+        controller.release(running)
+        ticket = await asyncio.wait_for(waiters[0], 1)
+        assert ticket['user'] == 'b'
+        for waiter in waiters[1:]:
+            controller.release(ticket)
+            ticket = await asyncio.wait_for(waiter, 1)
+        controller.release(ticket)
+
+    asyncio.run(main())
+    assert controller.status()['active'] == 0
+
+
+def test_async_cancel_and_timeout_leave_the_queue():
+    controller = AdmissionController(slots=1, max_wait=0.05)
+
+    async def main():
+        running = controller.acquire('a', INTERACTIVE)
+        waiter = asyncio.ensure_future(controller.acquire_async('b', INTERACTIVE))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.status()['queued_interactive'] == 0
+
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire_async('c', INTERACTIVE)
+        assert controller.status()['queued_interactive'] == 0
+
+        controller.release(running)
+        async with controller.admit_async('d', INTERACTIVE):
+            assert controller.status()['active'] == 1
+
+    asyncio.run(main())
+    assert controller.status()['active'] == 0
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+from PIL import Image
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from animation import FrameEncoder
+from conftest import add_thumbnails, fake_png
+
+
+def test_identical_frames_become_one_longer_frame(tmp_path):
+    path = str(tmp_path / 'out.gif')
+    encoder = FrameEncoder('GIF', path, fps=10)
+    for content in ('a', 'a', 'a', 'b'):
+        encoder.add_frame(fake_png(content))
+    assert encoder._durations == [300, 100]
+    encoder.finish()
+    with Image.open(path) as image:
+        assert image.n_frames == 2
+
+
+def test_finish_without_frames_raises_a_clear_error(tmp_path):
+    encoder = FrameEncoder('WEBP', str(tmp_path / 'out.webp'), fps=10)
+    with pytest.raises(RuntimeError, match='no frames'):
+        encoder.finish()
+
+
+@pytest.fixture
+def animations(app_module, monkeypatch):
+    """Stands in for the renderer's frame capture; raises `fail` if set, else feeds two frames."""
+    state = {'fail': None}
+
+    async def render_animation(html_content, encoder, base_url=None, fps=12, seconds=3, queue_frames=4, timeout=60000):
+        if state['fail']:
+            raise state['fail']
+        for content in ('a', 'b'):
+            encoder.add_frame(fake_png(html_content + content))
+        encoder.finish()
+        return 2
+
+    monkeypatch.setattr(app_module.renderer, 'render_animation', render_animation)
+    return state
+
+
+def test_animation_is_kept_on_the_record(app_module, client, animations):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    response = client.post(f"/animate/{thumbnail['id']}", data={'format': 'gif'})
+    assert response.get_json()['status'] == 'success'
+    stored, = app_module.get_db()['thumbnails']
+    assert app_module.image_store.exists(stored['animations']['gif'])
+
+
+def test_failed_captures_answer_with_json_errors(app_module, client, animations):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+
+    animations['fail'] = PlaywrightTimeoutError('Timeout 60000ms exceeded.')
+    response = client.post(f"/animate/{thumbnail['id']}", data={'format': 'gif'})
+    assert response.status_code == 500
+    assert response.get_json() == {'status': 'error', 'message': 'Animation failed: Timeout 60000ms exceeded.'}
+
+    os.remove(os.path.join('thumbnail_templates', thumbnail['template']))
+    response = client.post(f"/animate/{thumbnail['id']}", data={'format': 'gif'})
+    assert response.status_code == 404
+    assert response.get_json()['status'] == 'error'
+    # No scratch files are left behind
+    assert not [name for name in os.listdir('generated') if name.startswith('.render-')]
@@ -0,0 +1,93 @@
+import os
+import io
+
+import httpx
+import pytest
+from starlette.testclient import TestClient
+
+from conftest import add_thumbnails
+from publisher import PublishPipelines
+
+
+@pytest.fixture
+def asgi(app_module, monkeypatch):
+    import asgi
+    monkeypatch.setattr(asgi, 'publish_pipelines', PublishPipelines())
+    yield asgi
+    asgi.publish_pipelines.shutdown()
+
+
+@pytest.fixture
+def graph(asgi, monkeypatch):
+    """A fake Graph API behind the async client; records the bytes of each upload."""
+    uploads = []
+
+    def handle(request):
+        if request.method == 'GET':
+            return httpx.Response(200, json={'access_token': 'page-token'})
+        if request.url.path.endswith(('/photos', '/videos')):
+            uploads.append(request.read())
+            return httpx.Response(200, json={'id': 'media-1'})
+        return httpx.Response(200, json={'id': 'post-1'})
+
+    monkeypatch.setitem(asgi.http_state, 'client', httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+    return uploads
+
+
+@pytest.fixture
+def asgi_client(asgi):
+    # Not entered as a context manager, so the lifespan (warm-up, real renderer) doesn't run
+    return TestClient(asgi.app)
+
+
+def with_page(app):
+    db = app.get_db()
+    db['social_media_credentials']['facebook_accounts'] = {'acct': {'access_token': 'user-token'}}
+    db['social_media_credentials']['facebook_pages'] = {'p1': {'name': 'Shop', 'account': 'acct'}}
+    app.write_db(db)
+
+
+def test_swap_and_update_share_the_flask_checks(app_module, asgi_client):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+
+    response = asgi_client.post(f"/swap_template/{thumbnail['id']}", data={'new_template': 'missing.html'})
+    assert response.status_code == 400
+    assert asgi_client.post('/spin_thumbnail/unknown').status_code == 400 # No image URLs saved
+
+    response = asgi_client.post(f"/swap_template/{thumbnail['id']}", data={'new_template': 'template_multi_format.html'})
+    assert response.json()['message'] == 'Design swapped to template_multi_format.html successfully!'
+    stored, = app_module.get_db()['thumbnails']
+    assert stored['template'] == 'template_multi_format.html'
+    assert response.json()['new_image_url'].split('?v=')[0].endswith(f"/generated/{stored['filename']}")
+
+
+def test_update_streams_the_image_to_disk(app_module, asgi, asgi_client, monkeypatch):
+    monkeypatch.setattr(asgi, 'UPLOAD_CHUNK_SIZE', 4)
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    response = asgi_client.post(f"/update/{thumbnail['id']}", data={'main_title': 'Boots', 'badge': '', 'sub_title': ''},
+                                files={'image_file': ('photo.png', io.BytesIO(b'0123456789'), 'image/png')})
+    assert response.json()['status'] == 'success'
+    image_filename = f"{thumbnail['id']}_photo.png"
+    with open(os.path.join('image_uploads', image_filename), 'rb') as f:
+        assert f.read() == b'0123456789'
+    stored, = app_module.get_db()['thumbnails']
+    assert stored['data']['main_title'] == 'Boots'
+    assert stored['data']['image_url'] == f'/uploads/image/{image_filename}'
+
+
+def test_custom_media_is_posted_from_disk_and_removed(app_module, asgi_client, graph):
+    with_page(app_module)
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    response = asgi_client.post(f"/publish_facebook_post/{thumbnail['id']}", data={'caption': 'New in'},
+                                files={'custom_media': ('promo.png', io.BytesIO(b'custom bytes'), 'image/png')})
+    assert response.json()['message'] == 'Post published successfully! Post ID: post-1'
+    assert len(graph) == 1 and b'custom bytes' in graph[0]
+    assert os.listdir('uploads') == []
+
+
+def test_publish_without_a_stored_animation(app_module, asgi_client, graph):
+    with_page(app_module)
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    response = asgi_client.post(f"/publish_facebook_post/{thumbnail['id']}", data={'animation': 'mp4'})
+    assert response.json() == {'status': 'error', 'message': 'Animation not found. Please create it again.'}
+    assert graph == []
@@ -0,0 +1,67 @@
+import os
+import time
+
+from conftest import add_thumbnails
+
+DAY = 24 * 3600
+
+
+def write(path, size=10):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+def stored_names(app):
+    return sorted(name for name, _, _ in app.image_store.list())
+
+
+def store_stray(app, name, size=10):
+    write('scratch', size)
+    app.image_store.put_file(name, 'scratch')
+
+
+def test_keeps_referenced_files_and_removes_expired_ones(app_module):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes', 'image_url': '/uploads/image/kept.png'})
+    store_stray(app_module, 'stray.png')
+    write(os.path.join('image_uploads', 'kept.png'))
+    write(os.path.join('image_uploads', 'dropped.png'))
+
+    report = app_module.collect_garbage(now=time.time() + 8 * DAY)
+    assert stored_names(app_module) == [thumbnail['filename']]
+    assert os.listdir('image_uploads') == ['kept.png']
+    assert report['folders']['generated']['removed'] == ['stray.png']
+    assert report['reclaimed_bytes'] == 20
+
+
+def test_quota_removes_the_oldest_files_past_the_minimum_age(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config['GC_QUOTA_BYTES'], 'UPLOAD_FOLDER', 25)
+    for name in ('old.zip', 'newer.zip', 'newest.zip'):
+        write(os.path.join('uploads', name))
+        os.utime(os.path.join('uploads', name), (time.time(), time.time() + len(name)))
+
+    app_module.collect_garbage(now=time.time() + 2 * 3600)
+    assert sorted(os.listdir('uploads')) == ['newer.zip', 'newest.zip']
+
+    # Nothing younger than GC_MIN_AGE_SECONDS goes, even over quota
+    app_module.collect_garbage(now=time.time())
+    assert len(os.listdir('uploads')) == 2
+
+
+def test_scans_without_the_lock_and_rechecks_before_removing(app_module, monkeypatch):
+    store_stray(app_module, 'stray.png')
+    scan = app_module.gc_entries
+
+    def racing_entries(folder_key):
+        assert app_module.db_lock_state['depth'] == 0
+        yield from scan(folder_key)
+        if folder_key == 'GENERATED_FOLDER':
+            # A commit takes up the file after the scan picked it
+            with app_module.db_locked():
+                db = app_module.get_db()
+                db['thumbnails'].append({'id': 'late', 'template': 'default.html', 'data': {}, 'filename': 'stray.png'})
+                app_module.write_db(db)
+
+    monkeypatch.setattr(app_module, 'gc_entries', racing_entries)
+    report = app_module.collect_garbage(now=time.time() + 2 * DAY)
+    assert stored_names(app_module) == ['stray.png']
+    assert report['folders']['generated']['removed'] == []
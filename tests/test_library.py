@@ -0,0 +1,78 @@
+import json
+import threading
+
+from conftest import add_thumbnails
+
+
+def library_ids(app, folder=None):
+    return [entry['id'] for entry in app.search_index.library_page(folder)]
+
+
+def create_folder(app, client, name):
+    client.post('/library/folders', data={'name': name})
+    return next(key for key, folder in app.get_db()['library']['folders'].items() if folder['name'] == name)
+
+
+def test_save_move_and_remove_keep_references_and_counts(app_module, client):
+    first, second = add_thumbnails(app_module, {'main_title': 'Shoes'}, {'main_title': 'Hats'})
+    folder = create_folder(app_module, client, 'Spring')
+
+    client.post(f"/library/save/{first['id']}", data={'folder': folder})
+    client.post(f"/library/save/{second['id']}")
+    client.post(f"/library/save/{second['id']}") # Already saved; not added twice
+    assert app_module.get_db()['library']['items'][first['id']]['folder'] == folder
+    assert app_module.search_index.library_counts() == {'all': 2, 'unfiled': 1}
+    assert library_ids(app_module, folder) == [first['id']]
+
+    client.post(f"/library/move/{second['id']}", data={'folder': folder})
+    assert app_module.search_index.library_counts() == {'all': 2, 'unfiled': 0}
+    assert app_module.search_index.library_folders() == [{'id': folder, 'name': 'Spring', 'count': 2}]
+
+    client.post(f"/library/delete/{first['id']}")
+    client.post(f'/library/folders/{folder}/delete')
+    assert library_ids(app_module) == [second['id']]
+    assert app_module.search_index.library_counts() == {'all': 1, 'unfiled': 1}
+    # The thumbnails themselves are untouched
+    assert len(app_module.get_db()['thumbnails']) == 2
+
+
+def test_counts_follow_a_deleted_thumbnail(app_module, client):
+    first, second = add_thumbnails(app_module, {'main_title': 'Shoes'}, {'main_title': 'Hats'})
+    for thumbnail in (first, second):
+        client.post(f"/library/save/{thumbnail['id']}")
+
+    client.post(f"/delete/{first['id']}")
+    assert app_module.search_index.library_counts() == {'all': 1, 'unfiled': 1}
+    assert library_ids(app_module) == [second['id']]
+    page = client.get('/library').get_data(as_text=True)
+    assert 'All (1)' in page and 'Unfiled (1)' in page
+
+
+def test_an_outside_write_is_picked_up_before_reading(app_module, client):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    # Another worker process, or a hand edit, saves to the library behind this index's back
+    db = app_module.get_db()
+    db['library']['items'][thumbnail['id']] = {'folder': None, 'added_at': 1}
+    with open(app_module.DB_FILE, 'w') as f:
+        json.dump(db, f, indent=2)
+    assert app_module.search_index.library_counts()['all'] == 0
+
+    assert 'All (1)' in client.get('/library').get_data(as_text=True)
+    assert library_ids(app_module) == [thumbnail['id']]
+
+
+def test_db_locked_serializes_read_modify_write(app_module):
+    def increment():
+        for _ in range(20):
+            with app_module.db_locked():
+                db = app_module.get_db()
+                db['counter'] = db.get('counter', 0) + 1
+                app_module.write_db(db)
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert app_module.get_db()['counter'] == 80
+    assert app_module.db_lock_state['depth'] == 0
@@ -0,0 +1,65 @@
+import argparse
+
+import pytest
+import requests
+
+from conftest import add_thumbnails
+from load_test import FakeGraphServer, parse_mix, percentile, serve, summarize
+from publisher import PublishPipelines
+
+
+@pytest.fixture
+def graph():
+    server = FakeGraphServer(latency_ms=0, upload_latency_ms=0, rps=2)
+    url = serve(server)
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+
+def test_percentile_and_summarize():
+    assert percentile([], 50) == 0.0
+    assert percentile([10, 20, 30, 40], 50) == 20
+    assert percentile([10, 20, 30, 40], 99) == 40
+
+    report = summarize({'swap_template': [(0.1, 'ok'), (0.3, 'ok'), (5.0, 'busy'), (0.2, 'error')]}, elapsed=2)
+    row = report['swap_template']
+    assert (row['requests'], row['ok'], row['busy'], row['errors']) == (4, 2, 1, 1)
+    assert row['throughput'] == 2
+    # Busy answers are left out of the latencies
+    assert row['max_ms'] == 300
+
+
+def test_parse_mix():
+    assert parse_mix('swap_template=4, spin_thumbnail=0,upload_csv') == {'swap_template': 4.0, 'upload_csv': 1.0}
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_mix('render=1')
+
+
+def test_fake_graph_throttles_a_page_over_its_rate(graph):
+    server, url = graph
+    token = requests.get(f'{url}/v19.0/p1', params={'access_token': 'user'})
+    assert token.json()['access_token'] == 'page-token-p1'
+    # Five calls span at most two seconds, so at least one goes over 2 a second
+    replies = [requests.post(f'{url}/p1/feed', data={'access_token': 'page'}) for _ in range(5)]
+    throttled = [reply for reply in replies if reply.status_code != 200]
+    assert throttled and all(reply.json()['error']['code'] == 32 for reply in throttled)
+    assert server.throttled['p1'] == len(throttled)
+    assert requests.post(f'{url}/p2/feed').json()['error']['code'] == 190
+
+
+def test_app_publishes_through_the_fake_graph(app_module, client, graph, monkeypatch):
+    server, url = graph
+    server.rps = None
+    monkeypatch.setitem(app_module.app.config, 'GRAPH_API_URL', url)
+    monkeypatch.setattr(app_module, 'publish_pipelines', PublishPipelines())
+    db = app_module.get_db()
+    db['social_media_credentials']['facebook_accounts'] = {'acct': {'access_token': 'user-token'}}
+    db['social_media_credentials']['facebook_pages'] = {'p1': {'name': 'Shop', 'account': 'acct'}}
+    app_module.write_db(db)
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+
+    response = client.post(f"/publish_facebook_post/{thumbnail['id']}", data={'caption': 'New in', 'first_comment': 'Link'})
+    assert response.get_json()['status'] == 'success'
+    assert dict(server.calls) == {'token': 1, 'photos': 1, 'feed': 1, 'comments': 1}
+    app_module.publish_pipelines.shutdown()
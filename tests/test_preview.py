@@ -0,0 +1,45 @@
+import pytest
+
+from conftest import add_thumbnails, fake_png
+
+
+@pytest.fixture
+def previews(app_module, monkeypatch):
+    """Stands in for the renderer's preview page; records each call, answers None for a channel 'stale'."""
+    calls = []
+
+    async def preview(html_content, base_url=None, row=None, source_key=None, channel=None, timeout=10000):
+        calls.append({'html': html_content, 'row': row, 'source_key': source_key, 'channel': channel})
+        return None if channel == 'stale' else fake_png(html_content)
+
+    monkeypatch.setattr(app_module.renderer, 'preview', preview)
+    return calls
+
+
+def test_draft_content_is_previewed_with_sample_data(app_module, client, previews):
+    response = client.post('/preview', data={'content': '<h1>{{ sub_title }}</h1>', 'channel': 'editor'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert response.headers['Cache-Control'] == 'no-store'
+    call, = previews
+    assert call['html'] == f"<h1>{app_module.PREVIEW_SAMPLE_ROW['sub_title']}</h1>"
+    assert (call['source_key'], call['channel']) == (None, 'editor')
+
+
+def test_saved_template_is_previewed_with_a_thumbnails_edited_data(app_module, client, previews):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes', 'sub_title': 'Spring'})
+    client.post('/preview', data={'template': 'default.html', 'thumbnail_id': thumbnail['id'], 'main_title': 'Boots'})
+    client.post('/preview', data={'template': 'default.html', 'thumbnail_id': thumbnail['id'], 'main_title': 'Sandals'})
+
+    first, second = previews
+    assert first['row'] == dict(thumbnail['data'], main_title='Boots')
+    assert 'Boots' in first['html'] and 'Spring' in first['html']
+    # A binding template keeps its document, so both previews share a source key
+    assert first['source_key'] and first['source_key'] == second['source_key']
+
+
+def test_superseded_and_broken_previews(client, previews):
+    assert client.post('/preview', data={'content': '<p></p>', 'channel': 'stale'}).status_code == 204
+    assert client.post('/preview', data={'content': '{% if %}'}).status_code == 400
+    assert client.post('/preview', data={'template': 'missing.html'}).status_code == 404
+    assert len(previews) == 1
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from conftest import add_thumbnails, fake_png
+from publisher import PublishPipelines
+
+
+class Response:
+    def __init__(self, body):
+        self.status_code = 200
+        self.headers = {}
+        self._body = body
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def graph(app_module, monkeypatch):
+    """A fake Graph API for the Flask routes; records each upload's name and bytes."""
+    uploads = []
+
+    def request(method, url, files=None, **kwargs):
+        if files:
+            name, media = files['source']
+            uploads.append((name, media.read()))
+            return Response({'id': 'media-1'})
+        return Response({'id': 'post-1'})
+
+    monkeypatch.setattr(app_module, 'publish_pipelines', PublishPipelines())
+    monkeypatch.setattr(app_module.requests, 'get', lambda url, params=None: Response({'access_token': 'page-token'}))
+    monkeypatch.setattr(app_module.requests, 'request', request)
+    db = app_module.get_db()
+    db['social_media_credentials']['facebook_accounts'] = {'acct': {'access_token': 'user-token'}}
+    db['social_media_credentials']['facebook_pages'] = {'p1': {'name': 'Shop', 'account': 'acct'}}
+    app_module.write_db(db)
+    yield uploads
+    app_module.publish_pipelines.shutdown()
+
+
+def wait_for_persist():
+    for thread in threading.enumerate():
+        if thread.name == 'persist-render':
+            thread.join(5)
+
+
+def test_render_and_publish_uploads_the_render_from_memory(app_module, client, graph):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    response = client.post(f"/render_and_publish/{thumbnail['id']}", data={'main_title': 'Boots', 'caption': 'New in'})
+    assert response.get_json()['message'] == 'Post published successfully! Post ID: post-1'
+    wait_for_persist()
+
+    (name, uploaded), = graph
+    assert name == 'boots.png'
+    stored, = app_module.get_db()['thumbnails']
+    assert stored['data']['main_title'] == 'Boots'
+    with app_module.image_store.open(stored['filename']) as f:
+        assert f.read() == uploaded
+
+
+def test_a_render_made_for_publishing_loses_to_a_later_edit(app_module, client):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    client.post(f"/update/{thumbnail['id']}", data={'main_title': 'Sandals', 'badge': '', 'sub_title': ''})
+    edited, = app_module.get_db()['thumbnails']
+
+    data = dict(thumbnail['data'], main_title='Boots')
+    app_module.persist_render(thumbnail, (fake_png('Boots'), {}), data, thumbnail['template'])
+    wait_for_persist()
+    assert app_module.get_db()['thumbnails'] == [edited]
@@ -0,0 +1,115 @@
+import json
+import time
+import threading
+
+from publisher import APP, PublishPipelines, usage_of
+
+
+class Response:
+    def __init__(self, status_code=200, body=None, **headers):
+        self.status_code = status_code
+        self.headers = {name.replace('_', '-'): json.dumps(value) for name, value in headers.items()}
+        self._body = body or {}
+
+    def json(self):
+        return self._body
+
+
+def error(code, message='Too many calls'):
+    return {'error': {'code': code, 'message': message}}
+
+
+def test_usage_of_reads_each_header_shape():
+    headers = {
+        'X-Page-Usage': json.dumps({'call_count': 40, 'total_cputime': 75, 'total_time': 10}),
+        'X-Business-Use-Case-Usage': json.dumps({'123': [
+            {'call_count': 20, 'estimated_time_to_regain_access': 0},
+            {'total_time': 95, 'estimated_time_to_regain_access': 3},
+        ]}),
+        'X-App-Usage': 'not json',
+    }
+    assert usage_of(headers, 'X-Page-Usage') == (75, 0)
+    assert usage_of(headers, 'X-Business-Use-Case-Usage') == (95, 180)
+    assert usage_of(headers, 'X-App-Usage') == (0, 0)
+    assert usage_of({}, 'X-Page-Usage') == (0, 0)
+
+
+def test_record_holds_a_page_over_the_usage_limit():
+    pipelines = PublishPipelines(usage_limit=90)
+    pipelines.record('p1', Response(X_Page_Usage={'call_count': 50}))
+    assert pipelines.blocked_for('p1') == 0
+    pipelines.record('p1', Response(X_Page_Usage={'call_count': 92}))
+    assert 55 <= pipelines.blocked_for('p1') <= 60
+    assert pipelines.blocked_for('p2') == 0
+
+
+def test_record_backs_off_a_throttled_page():
+    pipelines = PublishPipelines(max_backoff=100)
+    pipelines.record('p1', Response(400, error(32)))
+    assert 55 <= pipelines.blocked_for('p1') <= 60
+    pipelines.record('p1', Response(400, error(32)))
+    assert 95 <= pipelines.blocked_for('p1') <= 100
+    assert pipelines.status()['p1']['last_throttle'] == 'Too many calls'
+
+    # Facebook's own estimate wins over the backoff
+    pipelines.record('p2', Response(400, error(80001), X_Business_Use_Case_Usage={
+        '1': [{'call_count': 100, 'estimated_time_to_regain_access': 10}]}))
+    assert 595 <= pipelines.blocked_for('p2') <= 600
+
+
+def test_success_resets_the_backoff():
+    pipelines = PublishPipelines()
+    pipelines.record('p1', Response(400, error(32)))
+    pipelines.record('p1', Response(200))
+    assert pipelines._pages['p1'].backoff == 0
+
+
+def test_app_throttling_holds_every_page():
+    pipelines = PublishPipelines()
+    pipelines.record('p1', Response(400, error(4)))
+    assert pipelines.blocked_for('p1') > 0
+    assert pipelines.blocked_for('p2') > 0
+    assert pipelines._pages[APP].backoff == 60
+
+
+def test_tokens_are_cached_until_rejected():
+    pipelines = PublishPipelines(token_ttl=60)
+    pipelines.store_token('p1', 'user', 'page')
+    assert pipelines.cached_token('p1', 'user') == 'page'
+    assert pipelines.cached_token('p1', 'other user') is None
+    pipelines.record('p1', Response(400, error(190, 'Invalid token')))
+    assert pipelines.cached_token('p1', 'user') is None
+
+    expired = PublishPipelines(token_ttl=-1)
+    expired.store_token('p1', 'user', 'page')
+    assert expired.cached_token('p1', 'user') is None
+
+
+def test_submit_counts_outcomes_per_page():
+    pipelines = PublishPipelines(concurrency=2)
+    release = threading.Event()
+
+    def upload(fail):
+        release.wait(2)
+        if fail:
+            raise RuntimeError('boom')
+        return 'ok', None
+
+    futures = [pipelines.submit('p1', upload, fail) for fail in (False, True)]
+    assert pipelines.status()['p1']['in_flight'] == 2
+    release.set()
+    assert futures[0].result(2) == ('ok', None)
+    assert futures[1].result(2) == (None, 'An unexpected error occurred: boom')
+    status = pipelines.status()['p1']
+    assert (status['in_flight'], status['published'], status['failed']) == (0, 1, 1)
+    pipelines.shutdown()
+
+
+def test_forget_drops_a_page_but_finishes_its_uploads():
+    pipelines = PublishPipelines()
+    pipelines.store_token('p1', 'user', 'page')
+    future = pipelines.submit('p1', lambda: (time.sleep(0.05) or 'ok', None))
+    pipelines.forget('p1')
+    assert future.result(2) == ('ok', None)
+    assert 'p1' not in pipelines.status()
+    assert pipelines.cached_token('p1', 'user') is None
@@ -0,0 +1,72 @@
+import os
+import threading
+
+from conftest import add_thumbnails
+from registry import TemplateRegistry
+
+
+def write(path, content, mtime):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_sources_are_reread_only_when_the_file_changes(tmp_path):
+    path = str(tmp_path / 'card.html')
+    write(path, 'one', 10**18)
+    registry = TemplateRegistry(str(tmp_path))
+    assert registry.load() == ['card.html']
+
+    write(path, 'two', 10**18) # Same mtime: still served from memory
+    assert registry.source('card.html') == 'one'
+    write(path, 'two', 2 * 10**18)
+    assert registry.source('card.html') == 'two'
+
+
+def test_names_follow_the_folder(tmp_path):
+    registry = TemplateRegistry(str(tmp_path))
+    write(str(tmp_path / 'a.html'), 'a', 10**18)
+    assert registry.names() == ['a.html']
+    write(str(tmp_path / 'b.html'), 'b', 10**18)
+    (tmp_path / 'notes.txt').write_text('x')
+    os.utime(tmp_path, ns=(2 * 10**18, 2 * 10**18))
+    assert registry.names() == ['a.html', 'b.html']
+
+
+def test_concurrent_reads_agree(tmp_path):
+    write(str(tmp_path / 'card.html'), 'card', 10**18)
+    registry = TemplateRegistry(str(tmp_path))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.source('card.html'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['card'] * 8
+    assert registry._sources == {'card.html': (10**18, 'card')}
+
+
+def test_renders_use_the_registry(app_module, client, fake_renderer):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    path = os.path.join('thumbnail_templates', 'default.html')
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, 'a') as f:
+        f.write('<!-- unsaved -->')
+    os.utime(path, ns=(mtime, mtime))
+
+    client.post(f"/update/{thumbnail['id']}", data={'main_title': 'Boots', 'badge': '', 'sub_title': ''})
+    assert '<!-- unsaved -->' not in fake_renderer.rendered[-1]
+
+    app_module.template_registry.invalidate('default.html')
+    client.post(f"/update/{thumbnail['id']}", data={'main_title': 'Sandals', 'badge': '', 'sub_title': ''})
+    assert '<!-- unsaved -->' in fake_renderer.rendered[-1]
+
+
+def test_ready_answers_503_until_warm(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.warm_state, 'ready', False)
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert response.get_json()['status'] == 'warming'
+
+    monkeypatch.setitem(app_module.warm_state, 'ready', True)
+    assert client.get('/ready').status_code == 200
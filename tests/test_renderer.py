@@ -0,0 +1,100 @@
+import os
+import asyncio
+
+import pytest
+
+from renderer import Renderer, RenderLimitError, parse_animation, parse_variants
+
+TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'thumbnail_templates')
+
+
+def variants_meta(content):
+    return f'<head><meta name="render-variants" content="{content}"></head>'
+
+
+def test_parse_variants():
+    variants = parse_variants(variants_meta('story=1080x1920:jpeg, link=1200x630+40+45, square=720x720+280+0:WEBP'))
+    assert variants == [
+        {'name': 'story', 'width': 1080, 'height': 1920, 'crop': None, 'format': 'jpeg'},
+        {'name': 'link', 'width': 1200, 'height': 630, 'crop': (40, 45), 'format': 'png'},
+        {'name': 'square', 'width': 720, 'height': 720, 'crop': (280, 0), 'format': 'webp'},
+    ]
+
+
+def test_parse_variants_skips_bad_entries():
+    content = 'ok=100x100+1180+620, wide=1200x630+100+0, tall=100x100+0+700, empty=0x100, odd=100x100:gif, =1x1'
+    assert [variant['name'] for variant in parse_variants(variants_meta(content))] == ['ok']
+
+
+def test_parse_variants_without_marker():
+    assert parse_variants('<head><meta name="render-mode" content="bind"></head>') == []
+
+
+def test_bundled_variants_template():
+    with open(os.path.join(TEMPLATE_FOLDER, 'template_multi_format.html')) as f:
+        assert {variant['name'] for variant in parse_variants(f.read())} == {'story', 'link', 'square'}
+
+
+def test_parse_animation():
+    html = '<meta name="render-animation" content="fps=15, seconds=2.5, loop=3">'
+    assert parse_animation(html) == {'fps': 15.0, 'seconds': 2.5}
+    assert parse_animation("<meta name='render-animation' content='FPS=8'>") == {'fps': 8.0}
+    assert parse_animation('<html></html>') == {}
+
+
+class FakeCDPSession:
+    def __init__(self, heap):
+        self.heap = heap
+        self.sent = []
+
+    async def send(self, method):
+        self.sent.append(method)
+        return {'metrics': [{'name': 'JSHeapUsedSize', 'value': self.heap}]}
+
+
+class FakePage:
+    def __init__(self, heap=0):
+        self.context = self
+        self.sessions = []
+        self.heap = heap
+        self.closed = False
+        self._on_close = []
+
+    async def new_cdp_session(self, page):
+        self.sessions.append(FakeCDPSession(self.heap))
+        return self.sessions[-1]
+
+    def once(self, event, handler):
+        assert event == 'close'
+        self._on_close.append(handler)
+
+    async def close(self):
+        self.closed = True
+        for handler in self._on_close:
+            handler(self)
+
+
+def test_governed_steps_share_one_cdp_session_per_page():
+    renderer = Renderer(max_page_memory_mb=512)
+    page = FakePage()
+
+    async def steps():
+        for n in range(3):
+            assert await renderer._governed(page, asyncio.sleep(0.01, n)) == n
+        await page.close()
+
+    asyncio.run(steps())
+    session, = page.sessions
+    assert session.sent[0] == 'Performance.enable'
+    assert renderer._cdp_sessions == {}
+
+
+def test_governed_closes_a_page_over_the_memory_cap():
+    violations = []
+    renderer = Renderer(max_page_memory_mb=1, on_violation=lambda *args: violations.append(args))
+    page = FakePage(heap=2 * 2 ** 20)
+
+    with pytest.raises(RenderLimitError, match='memory'):
+        asyncio.run(renderer._governed(page, asyncio.sleep(5)))
+    assert page.closed
+    assert violations[0][1] == 'memory'
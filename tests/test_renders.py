@@ -0,0 +1,54 @@
+import os
+import re
+
+from conftest import add_thumbnails
+
+
+def test_renders_are_named_by_content(app_module):
+    first, second, other = add_thumbnails(app_module, {'main_title': 'Shoes'}, {'main_title': 'Shoes'}, {'main_title': 'Hats'})
+    assert re.fullmatch(r'shoes-[0-9a-f]{12}\.png', first['filename'])
+    assert first['content_hash'].startswith(first['filename'][-16:-4])
+    # Identical renders share one stored file
+    assert second['filename'] == first['filename']
+    assert other['filename'] != first['filename']
+    assert sorted(name for name, _, _ in app_module.image_store.list()) == sorted({first['filename'], other['filename']})
+
+
+def test_replaced_render_is_released_once_unused(app_module, client):
+    first, second = add_thumbnails(app_module, {'main_title': 'Shoes'}, {'main_title': 'Shoes'})
+    shared = first['filename']
+
+    response = client.post(f"/update/{first['id']}", data={'main_title': 'Boots', 'badge': '', 'sub_title': ''})
+    assert response.get_json()['status'] == 'success'
+    assert app_module.image_store.exists(shared) # `second` still uses it
+
+    client.post(f"/update/{second['id']}", data={'main_title': 'Sandals', 'badge': '', 'sub_title': ''})
+    assert not app_module.image_store.exists(shared)
+    filenames = {item['filename'] for item in app_module.get_db()['thumbnails']}
+    assert all(app_module.image_store.exists(filename) for filename in filenames)
+
+
+def test_failed_batch_keeps_the_old_renders(app_module, client, fake_renderer):
+    add_thumbnails(app_module, {'main_title': 'Shoes'}, {'main_title': 'Hats'})
+    before = {item['id']: item['filename'] for item in app_module.get_db()['thumbnails']}
+
+    fake_renderer.fail = 'Hats'
+    client.post('/bulk_edit_text', data={'badge': 'New', 'all': '1'})
+    assert {item['id']: item['filename'] for item in app_module.get_db()['thumbnails']} == before
+    assert all(app_module.image_store.exists(filename) for filename in before.values())
+    # No scratch files are left behind in the generated folder
+    assert not [name for name in os.listdir('generated') if name.startswith('.render-')]
+
+
+def test_reconcile_reports_drift(app_module, client):
+    kept, lost = add_thumbnails(app_module, {'main_title': 'Shoes'}, {'main_title': 'Hats'})
+    app_module.image_store.delete(lost['filename'])
+    with open('scratch.png', 'wb') as f:
+        f.write(b'png')
+    app_module.image_store.put_file('stray.png', 'scratch.png')
+
+    report = client.get('/generated/reconcile').get_json()
+    assert report['orphaned_files'] == ['stray.png']
+    assert report['dangling_records'] == [{'id': lost['id'], 'filename': lost['filename']}]
+    assert report['collisions'] == {}
+    assert kept['filename'] not in report['orphaned_files']
@@ -0,0 +1,83 @@
+import os
+import time
+
+import pytest
+
+from conftest import add_thumbnails
+
+
+@pytest.fixture
+def rerender(app_module, monkeypatch):
+    """The re-render queue with its worker thread kept from starting; jobs are run by the test."""
+    monkeypatch.setattr(app_module, 'rerender_state', {'thread': 'off', 'jobs': {}, 'generations': {}, 'last_report': None})
+    monkeypatch.setitem(app_module.app.config, 'RERENDER_CHUNK_SIZE', 1)
+    monkeypatch.setitem(app_module.app.config, 'RERENDER_PAUSE_SECONDS', 0)
+    return app_module.rerender_state
+
+
+def edit_template(name):
+    path = os.path.join('thumbnail_templates', name)
+    with open(path, 'a') as f:
+        f.write('\n<!-- edited -->\n')
+    os.utime(path, (time.time() + 10, time.time() + 10))
+
+
+def schedule(app, template_name):
+    with app.app.test_request_context():
+        return app.schedule_rerender(template_name)
+
+
+def filenames(app):
+    return {item['id']: item['filename'] for item in app.get_db()['thumbnails']}
+
+
+def test_only_thumbnails_using_the_template_are_rerendered(app_module, rerender):
+    first, second = add_thumbnails(app_module, {'main_title': 'Shoes'}, {'main_title': 'Hats'})
+    other, = add_thumbnails(app_module, {'main_title': 'Socks'}, template='template_multi_format.html')
+    before = filenames(app_module)
+
+    edit_template('default.html')
+    assert schedule(app_module, 'default.html') == 2
+    assert schedule(app_module, 'missing.html') == 0
+    job = rerender['jobs']['default.html']
+    app_module.run_rerender_job('default.html', job)
+
+    after = filenames(app_module)
+    assert after[first['id']] != before[first['id']] and after[second['id']] != before[second['id']]
+    assert after[other['id']] == before[other['id']]
+    assert (job['done'], rerender['jobs']) == (2, {})
+    assert rerender['last_report']['rendered'] == 2
+
+
+def test_saving_again_supersedes_the_waiting_job(app_module, rerender, fake_renderer):
+    add_thumbnails(app_module, {'main_title': 'Shoes'})
+    schedule(app_module, 'default.html')
+    stale = rerender['jobs']['default.html']
+    schedule(app_module, 'default.html')
+    assert rerender['jobs']['default.html']['generation'] == stale['generation'] + 1
+
+    rendered = len(fake_renderer.rendered)
+    app_module.run_rerender_job('default.html', stale)
+    assert len(fake_renderer.rendered) == rendered
+    assert 'default.html' in rerender['jobs']
+
+
+def test_a_record_edited_during_the_rerender_keeps_its_edit(app_module, rerender, client, monkeypatch):
+    thumbnail, = add_thumbnails(app_module, {'main_title': 'Shoes'})
+    schedule(app_module, 'default.html')
+    render_batch_to_temp = app_module.render_batch_to_temp
+    edited = []
+
+    def edited_meanwhile(chunk):
+        renders = render_batch_to_temp(chunk)
+        client.post(f"/update/{thumbnail['id']}", data={'main_title': 'Boots', 'badge': '', 'sub_title': ''})
+        edited.extend(app_module.get_db()['thumbnails'])
+        return renders
+
+    monkeypatch.setattr(app_module, 'render_batch_to_temp', edited_meanwhile)
+    edit_template('default.html')
+    app_module.run_rerender_job('default.html', rerender['jobs']['default.html'])
+
+    assert app_module.get_db()['thumbnails'] == edited
+    assert app_module.image_store.exists(edited[0]['filename'])
+    assert not [name for name in os.listdir('generated') if name.startswith('.render-')]
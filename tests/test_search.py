@@ -0,0 +1,97 @@
+import pytest
+
+from search import SearchIndex, match_query, plain_text
+
+
+def thumbnail(thumbnail_id, main_title, created_at, template='default.html', badge=''):
+    return {
+        'id': thumbnail_id, 'template': template, 'created_at': created_at, 'filename': f'{thumbnail_id}.png',
+        'data': {'badge': badge, 'main_title': main_title, 'sub_title': ''},
+    }
+
+
+@pytest.fixture
+def index(tmp_path):
+    return SearchIndex(str(tmp_path / 'search_index.db'))
+
+
+def ids(result):
+    records, _ = result
+    return [record['id'] for record in records]
+
+
+def test_plain_text_and_match_query():
+    assert plain_text("Best <span class='highlight'>Caf&eacute;</span>") == 'Best Café'
+    assert match_query('red sh') == '"red"* "sh"*'
+
+
+def test_sync_writes_only_changed_rows(index):
+    thumbnails = [thumbnail('a', 'Red Shoes', 1), thumbnail('b', 'Blue Shoes', 2)]
+    assert index.sync(thumbnails, stamp='1') == (2, 0)
+    assert index.sync(thumbnails, stamp='2') == (0, 0)
+    assert index.stamp() == '2'
+
+    thumbnails[0]['data']['main_title'] = 'Green Shoes'
+    assert index.sync(thumbnails[:1], stamp='3') == (1, 1)
+    assert index.has_thumbnail('a')
+    assert not index.has_thumbnail('b')
+
+
+def test_search_follows_updates_and_deletes(index):
+    thumbnails = [thumbnail('a', "Red <span class='highlight'>Shoes</span>", 1), thumbnail('b', 'Blue Hat', 2)]
+    index.sync(thumbnails)
+    assert ids(index.search('shoe')) == ['a']
+
+    # The FTS table is kept in step by triggers on the thumbnails table
+    thumbnails[0]['data']['main_title'] = 'Red Boots'
+    index.sync(thumbnails)
+    assert ids(index.search('shoe')) == []
+    assert ids(index.search('boot')) == ['a']
+
+    index.sync(thumbnails[1:])
+    assert ids(index.search('boot')) == []
+    assert index.search('hat')[1] == 1
+
+
+def test_search_filters_and_sorts(index):
+    index.sync([
+        thumbnail('a', 'Shoes', 1),
+        thumbnail('b', 'Shoes', 2, template='template_bold.html'),
+        thumbnail('c', 'Shoes', 3),
+    ])
+    assert ids(index.search()) == ['c', 'b', 'a']
+    assert ids(index.search(sort='oldest')) == ['a', 'b', 'c']
+    assert ids(index.search(template='default.html')) == ['c', 'a']
+    assert ids(index.search('shoes', created_from=2)) == ['c', 'b']
+    assert ids(index.search(created_to=3, per_page=1, page=2)) == ['a']
+
+
+def test_library_counts_follow_moves(index):
+    thumbnails = [thumbnail(key, 'Shoes', n) for n, key in enumerate('abc')]
+    library = {
+        'folders': {'f1': {'name': 'Summer', 'created_at': 1}},
+        'items': {'a': {'folder': 'f1', 'added_at': 1}, 'b': {'folder': None, 'added_at': 2}},
+    }
+    index.sync(thumbnails, library)
+    assert index.library_counts() == {'all': 2, 'unfiled': 1}
+    assert index.library_folders() == [{'id': 'f1', 'name': 'Summer', 'count': 1}]
+
+    library['items']['b']['folder'] = 'f1'
+    library['items']['c'] = {'folder': None, 'added_at': 3}
+    del library['items']['a']
+    index.sync(thumbnails, library)
+    assert index.library_counts() == {'all': 2, 'unfiled': 1}
+    assert index.library_folders()[0]['count'] == 1
+    assert [entry['id'] for entry in index.library_page()] == ['c', 'b']
+    assert [entry['id'] for entry in index.library_page(folder='f1')] == ['b']
+    assert [entry['id'] for entry in index.library_page(folder='')] == ['c']
+
+
+def test_sync_sees_writes_from_another_process(tmp_path):
+    path = str(tmp_path / 'search_index.db')
+    first, second = SearchIndex(path), SearchIndex(path)
+    first.sync([thumbnail('a', 'Shoes', 1)])
+    second.sync([thumbnail('a', 'Shoes', 1), thumbnail('b', 'Hat', 2)])
+    # `first` last wrote only 'a'; it must reread rather than trust its cache
+    assert first.sync([thumbnail('a', 'Shoes', 1)]) == (0, 1)
+    assert not second.has_thumbnail('b')
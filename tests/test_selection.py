@@ -0,0 +1,63 @@
+from werkzeug.datastructures import MultiDict
+
+from app import parse_selection, select_thumbnails, selection_error
+
+
+def thumbnail(thumbnail_id, template='default.html', **data):
+    return {'id': thumbnail_id, 'template': template, 'data': data}
+
+
+DB = {
+    'thumbnails': [
+        thumbnail('a', badge='New', main_title='Red Shoes'),
+        thumbnail('b', badge='Sale', main_title='Blue Shoes', template='template_bold.html'),
+        thumbnail('c', badge='sale', main_title='Red Hat'),
+    ],
+    'selections': {
+        'reds': {'ids': [], 'query': {'main_title': 'red'}},
+        'picked': {'ids': ['b'], 'query': {}},
+        'empty': {'ids': [], 'query': {}},
+    },
+}
+
+
+def ids(thumbnails):
+    return [item['id'] for item in thumbnails]
+
+
+def test_parse_selection_splits_ids_and_filters():
+    spec = parse_selection(MultiDict([('ids', 'a, b'), ('ids', 'c'), ('filter_badge', ' sale '), ('filter_sub_title', '')]))
+    assert spec == {'selection': '', 'ids': ['a', 'b', 'c'], 'query': {'badge': 'sale'}, 'all': False}
+
+
+def test_parse_selection_without_fields_is_empty():
+    spec = parse_selection(MultiDict([('template', 'default.html'), ('all', '1')]))
+    assert spec == {'selection': '', 'ids': [], 'query': {}, 'all': True}
+    assert selection_error(spec) is None
+    assert selection_error(parse_selection(MultiDict())) is not None
+
+
+def test_parse_selection_rejects_blank_submitted_fields():
+    for form in ([('filter_badge', '  ')], [('ids', ' , ')], [('selection', '')]):
+        spec = parse_selection(MultiDict(form + [('all', '1')]))
+        assert spec is None
+        assert selection_error(spec) is not None
+
+
+def test_select_by_ids_and_query():
+    assert ids(select_thumbnails(DB, {'ids': ['a', 'b']})) == ['a', 'b']
+    assert ids(select_thumbnails(DB, {'query': {'badge': 'SALE'}})) == ['b', 'c']
+    assert ids(select_thumbnails(DB, {'ids': ['a', 'c'], 'query': {'badge': 'sale'}})) == ['c']
+    assert ids(select_thumbnails(DB, {'query': {'template': 'bold'}})) == ['b']
+
+
+def test_select_empty_spec_is_whole_library():
+    assert ids(select_thumbnails(DB, {})) == ['a', 'b', 'c']
+
+
+def test_select_saved_selection():
+    assert ids(select_thumbnails(DB, {'selection': 'reds'})) == ['a', 'c']
+    assert ids(select_thumbnails(DB, {'selection': 'picked'})) == ['b']
+    assert ids(select_thumbnails(DB, {'selection': 'reds', 'query': {'badge': 'new'}})) == ['a']
+    assert select_thumbnails(DB, {'selection': 'empty'}) == []
+    assert select_thumbnails(DB, {'selection': 'missing'}) is None
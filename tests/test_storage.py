@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from storage import LocalObjectClient, LocalStorage, ObjectStorage, shard_prefix
+
+
+def write(path, data=b'png'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_shard_prefix_is_stable():
+    assert shard_prefix('a.png') == shard_prefix('a.png')
+    assert len(shard_prefix('a.png')) == 2
+    assert shard_prefix('a.png', depth=2).startswith(shard_prefix('a.png') + '/')
+
+
+@pytest.mark.parametrize('depth', [1, 2])
+def test_local_storage_round_trip(tmp_path, depth):
+    store = LocalStorage(str(tmp_path / 'generated'), shard_depth=depth)
+    store.put_file('a.png', write(str(tmp_path / 'scratch.png'), b'first'))
+    assert store.exists('a.png')
+    assert store.path_for('a.png') == os.path.join(str(tmp_path / 'generated'), *store.key_for('a.png').split('/'))
+    with store.open('a.png') as f:
+        assert f.read() == b'first'
+
+    write(str(tmp_path / 'generated' / '.render-scratch.png'))
+    assert [name for name, _, _ in store.list()] == ['a.png']
+
+    store.delete('a.png')
+    store.delete('a.png')
+    assert not store.exists('a.png')
+
+
+def test_local_storage_migrates_flat_files(tmp_path):
+    root = str(tmp_path / 'generated')
+    write(os.path.join(root, 'old.png'))
+    write(os.path.join(root, 'other.png'))
+    store = LocalStorage(root)
+
+    # Touching a file moves it into its shard
+    assert store.exists('old.png')
+    assert not os.path.exists(os.path.join(root, 'old.png'))
+
+    assert store.migrate_legacy() == 1
+    assert sorted(os.listdir(root)) == sorted({shard_prefix('old.png'), shard_prefix('other.png')})
+    assert sorted(name for name, _, _ in store.list()) == ['old.png', 'other.png']
+
+
+def test_object_storage_round_trip(tmp_path):
+    client = LocalObjectClient(str(tmp_path / 'objects'))
+    store = ObjectStorage(client, 'thumbs', shard_depth=2)
+    source = write(str(tmp_path / 'scratch.png'), b'object')
+    store.put_file('a.png', source)
+    assert not os.path.exists(source)
+    assert store.exists('a.png')
+    assert os.path.isfile(client._path('thumbs', store.key_for('a.png')))
+    body = store.open('a.png')
+    assert body.read() == b'object'
+    body.close()
+    assert [name for name, _, _ in store.list()] == ['a.png']
+
+    store.delete('a.png')
+    assert not store.exists('a.png')
+
+
+def test_object_storage_migrates_legacy_files(tmp_path):
+    legacy = str(tmp_path / 'generated')
+    write(os.path.join(legacy, 'old.png'), b'legacy')
+    write(os.path.join(legacy, 'other.png'))
+    write(os.path.join(legacy, '.render-scratch.png'))
+    store = ObjectStorage(LocalObjectClient(str(tmp_path / 'objects')), 'thumbs', legacy_root=legacy)
+
+    body = store.open('old.png')
+    assert body.read() == b'legacy'
+    body.close()
+    assert not os.path.exists(os.path.join(legacy, 'old.png'))
+
+    assert store.migrate_legacy() == 1
+    assert os.listdir(legacy) == ['.render-scratch.png']
+    assert not store.exists('missing.png')
+
+
+def test_object_storage_lists_every_page():
+    class PagedClient:
+        pages = {
+            None: {'Contents': [{'Key': 'ab/a.png', 'Size': 1, 'LastModified': 1}],
+                   'IsTruncated': True, 'NextContinuationToken': 'next'},
+            'next': {'Contents': [{'Key': 'cd/b.png', 'Size': 2, 'LastModified': 2}], 'IsTruncated': False},
+        }
+
+        def list_objects_v2(self, Bucket, ContinuationToken=None):
+            return self.pages[ContinuationToken]
+
+    store = ObjectStorage(PagedClient(), 'thumbs')
+    assert list(store.list()) == [('a.png', 1, 1), ('b.png', 2, 2)]